@@ -83,6 +83,14 @@ with app.app_context():
     # Create all tables
     db.create_all()
     
+    # Indexes added to models.py after the tables were created: built by `flask create-indexes`
+    # (or here with SCHEMA_AUTO_INDEXES=true); missing ones are reported at startup
+    from utils.schema import SCHEMA_AUTO_INDEXES, ensure_indexes, report_missing_indexes
+    if SCHEMA_AUTO_INDEXES:
+        ensure_indexes()
+    else:
+        report_missing_indexes()
+    
     # Create default admin user if not exists
     admin = models.Admin.query.filter_by(username='admin').first()
     if not admin:
@@ -93,6 +101,38 @@ with app.app_context():
         db.session.add(admin)
         db.session.commit()
         logging.info("Default admin user created: admin/admin123")
+    
+    # Background ride/driver matcher (DISPATCH_MODE=batch only)
+    from utils.dispatch import batch_dispatcher, nearest_dispatcher
+    batch_dispatcher.start(app)
+    
+    # Offer expiry and re-offers without incoming_rides polls (DISPATCH_MODE=nearest only)
+    nearest_dispatcher.start(app)
+    
+    # Ride events from every worker reach this worker's indexes and streams
+    from utils.events import event_bus
+    event_bus.start(app)
+    
+    # Bulk GPS writer (GPS_INGEST_MODE=write_behind only)
+    from utils.gps_buffer import gps_buffer
+    gps_buffer.start(app)
+    
+    # Daily ride_location partitions and GPS retention
+    from utils.partitions import ride_location_partitions
+    ride_location_partitions.start(app)
+    
+    # Detour factors of the local distance estimator, recalibrated hourly off the request path
+    from utils.maps import local_estimator
+    local_estimator.start(app)
+    
+    # CLI: flask compact-trails / maintain-ride-locations / partition-ride-locations / create-indexes
+    from utils.trails import compact_trails_command
+    from utils.partitions import maintain_ride_locations_command, partition_ride_locations_command
+    from utils.schema import create_indexes_command
+    app.cli.add_command(compact_trails_command)
+    app.cli.add_command(maintain_ride_locations_command)
+    app.cli.add_command(partition_ride_locations_command)
+    app.cli.add_command(create_indexes_command)
 
 # Root route - Login-aware landing page
 @app.route('/')
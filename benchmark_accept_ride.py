@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for accept_ride
+Many drivers accept the same pending ride at the same instant, round after round, through the real
+endpoint. Every round must end with exactly one success response and the ride assigned to that
+driver. The same race is run against the previous read-check-write acceptance for comparison, and
+one driver accepting several rides at once must end up with exactly one of them.
+
+Run:
+    python benchmark_accept_ride.py --threads 32 --rounds 50
+    DATABASE_URL=postgresql://... python benchmark_accept_ride.py --threads 64 --rounds 200
+
+Without DATABASE_URL a throwaway SQLite database is used. Against an existing database the
+benchmark only touches the customers, drivers and rides it creates (phones starting with 60).
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import logging
+import numpy as np
+
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_accept.db")
+
+from app import app, db, get_ist_time
+from models import Customer, Driver, Ride
+
+BENCHMARK_PHONE_PREFIX = "60"
+
+
+def seed(threads):
+    """One customer and one online driver per thread. Returns (customer_id, [driver phones])"""
+    customer = Customer.query.filter_by(phone=BENCHMARK_PHONE_PREFIX + "00000000").first()
+    if customer is None:
+        customer = Customer(name="Benchmark Customer", phone=BENCHMARK_PHONE_PREFIX + "00000000")
+        db.session.add(customer)
+    
+    phones = []
+    for index in range(threads):
+        phone = f"{BENCHMARK_PHONE_PREFIX}{index + 1:08d}"
+        driver = Driver.query.filter_by(phone=phone).first()
+        if driver is None:
+            driver = Driver(
+                name=f"Benchmark Driver {index + 1}", phone=phone, car_type="sedan",
+                username=f"BENCH{index + 1}", is_online=True
+            )
+            db.session.add(driver)
+        driver.is_online = True
+        phones.append(phone)
+    db.session.commit()
+    return customer.id, phones
+
+
+def book(customer_id):
+    ride = Ride(
+        customer_id=customer_id, customer_phone=BENCHMARK_PHONE_PREFIX + "00000000",
+        pickup_address="Benchmark pickup", drop_address="Benchmark drop",
+        ride_type="sedan", fare_amount=100.0, status="pending"
+    )
+    db.session.add(ride)
+    db.session.commit()
+    return ride.id
+
+
+def release(ride_ids):
+    """Complete the round's rides so their drivers are free again"""
+    Ride.query.filter(Ride.id.in_(ride_ids), Ride.status == "accepted").update(
+        {"status": "completed", "completed_at": get_ist_time()}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def endpoint_accept(client, ride_id, phone):
+    response = client.post("/driver/accept_ride", json={"ride_id": ride_id, "driver_phone": phone})
+    return response.get_json()["status"] == "success"
+
+
+def legacy_accept(client, ride_id, phone):
+    """accept_ride before the conditional update: read, check in Python, write"""
+    with app.app_context():
+        try:
+            driver = Driver.query.filter_by(phone=phone).first()
+            ongoing_ride = Ride.query.filter_by(driver_id=driver.id).filter(
+                Ride.status.in_(["accepted", "arrived", "started"])
+            ).first()
+            if ongoing_ride:
+                return False
+            ride = Ride.query.filter_by(id=ride_id, status="pending", driver_id=None).first()
+            if not ride:
+                return False
+            ride.driver_id = driver.id
+            ride.status = "accepted"
+            ride.accepted_at = get_ist_time()
+            db.session.commit()
+            return True
+        except Exception:
+            db.session.rollback()
+            return False
+        finally:
+            db.session.remove()
+
+
+def race(accept, calls):
+    """
+    Run every (ride_id, phone) call on its own thread, released together by a barrier
+    Returns: (list of (ride_id, phone) that succeeded, list of latencies in ms)
+    """
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+    
+    def worker(index, ride_id, phone):
+        client = app.test_client()
+        barrier.wait()
+        started = time.perf_counter()
+        succeeded = accept(client, ride_id, phone)
+        results[index] = (succeeded, (time.perf_counter() - started) * 1000)
+    
+    workers = [
+        threading.Thread(target=worker, args=(index, ride_id, phone))
+        for index, (ride_id, phone) in enumerate(calls)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    
+    winners = [call for call, (succeeded, _) in zip(calls, results) if succeeded]
+    return winners, [latency for _, latency in results]
+
+
+def run_one_ride(name, accept, customer_id, phones, rounds):
+    """Every driver accepts the same ride"""
+    latencies = []
+    bad_rounds = double_booked = 0
+    started = time.perf_counter()
+    
+    for _ in range(rounds):
+        with app.app_context():
+            ride_id = book(customer_id)
+        
+        winners, round_latencies = race(accept, [(ride_id, phone) for phone in phones])
+        latencies.extend(round_latencies)
+        
+        with app.app_context():
+            ride = db.session.get(Ride, ride_id)
+            assigned_phone = ride.driver.phone if ride.driver else None
+            if len(winners) != 1 or assigned_phone != winners[0][1]:
+                bad_rounds += 1
+            double_booked += max(len(winners) - 1, 0)
+            release([ride_id])
+    
+    elapsed = time.perf_counter() - started
+    attempts = rounds * len(phones)
+    print(f"\n📊 {name}: {len(phones)} drivers x {rounds} rides")
+    print(f"   Rounds with exactly one winner: {rounds - bad_rounds}/{rounds}, drivers told they won a taken ride: {double_booked}")
+    print(f"   Throughput: {attempts / elapsed:.0f} accept calls/s")
+    print(f"   Latency: p50 {np.percentile(latencies, 50):.1f}ms, p99 {np.percentile(latencies, 99):.1f}ms")
+    return bad_rounds == 0
+
+
+def run_one_driver(name, accept, customer_id, phone, rides, rounds):
+    """One driver accepts several rides at once (double taps, several devices)"""
+    bad_rounds = 0
+    for _ in range(rounds):
+        with app.app_context():
+            ride_ids = [book(customer_id) for _ in range(rides)]
+        
+        winners, _ = race(accept, [(ride_id, phone) for ride_id in ride_ids])
+        
+        with app.app_context():
+            driver_id = Driver.query.filter_by(phone=phone).first().id
+            held = Ride.query.filter(Ride.id.in_(ride_ids), Ride.driver_id == driver_id).count()
+            if len(winners) != 1 or held != 1:
+                bad_rounds += 1
+            release(ride_ids)
+            Ride.query.filter(Ride.id.in_(ride_ids), Ride.status == "pending").update(
+                {"status": "cancelled", "cancelled_at": get_ist_time()}, synchronize_session=False
+            )
+            db.session.commit()
+    
+    print(f"\n📊 {name}: 1 driver x {rides} rides, {rounds} rounds")
+    print(f"   Rounds with exactly one ride held: {rounds - bad_rounds}/{rounds}")
+    return bad_rounds == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent accept_ride on one ride")
+    parser.add_argument('--threads', type=int, default=32, help="drivers racing for each ride")
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--skip-legacy', action='store_true', help="only run the current endpoint")
+    args = parser.parse_args()
+    
+    logging.getLogger().setLevel(logging.CRITICAL)
+    
+    with app.app_context():
+        print("🚕 accept_ride Concurrency Benchmark")
+        print("=" * 50)
+        print(f"Database: {db.engine.dialect.name}")
+        customer_id, phones = seed(args.threads)
+    
+    passed = run_one_ride("Conditional UPDATE (accept_ride)", endpoint_accept, customer_id, phones, args.rounds)
+    passed &= run_one_driver(
+        "Same driver, several rides (accept_ride)", endpoint_accept, customer_id, phones[0],
+        min(args.threads, 8), max(args.rounds // 5, 1)
+    )
+    if not args.skip_legacy:
+        run_one_ride("Read-check-write (previous accept_ride)", legacy_accept, customer_id, phones, args.rounds)
+    
+    print("\n" + ("✅ Exactly one winner in every round" if passed else "❌ Some rounds did not have exactly one winner"))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark for batched ride/driver assignment (DISPATCH_MODE=batch)
+Compares total pickup distance of the min-cost assignment against greedy first-come
+acceptance (each ride, in booking order, taken by the nearest free driver) on synthetic windows
+
+Run:
+    python benchmark_assignment.py --rides 200 --drivers 250 --trials 20
+
+No backend or database needed.
+"""
+
+import argparse
+import time
+import numpy as np
+
+from utils.assignment import pairwise_distance_km, solve_assignment, greedy_assignment
+
+# Roughly a 20km x 20km city centred on Bengaluru
+CITY_CENTER = (12.97, 77.59)
+CITY_SPAN_DEG = 0.18
+
+
+def random_points(rng, count, hotspots=0):
+    """Uniform points over the city, or clustered around a few hotspots (stations, malls)"""
+    if not hotspots:
+        return np.column_stack([
+            CITY_CENTER[0] + (rng.random(count) - 0.5) * CITY_SPAN_DEG,
+            CITY_CENTER[1] + (rng.random(count) - 0.5) * CITY_SPAN_DEG
+        ])
+    centers = np.column_stack([
+        CITY_CENTER[0] + (rng.random(hotspots) - 0.5) * CITY_SPAN_DEG,
+        CITY_CENTER[1] + (rng.random(hotspots) - 0.5) * CITY_SPAN_DEG
+    ])
+    return centers[rng.integers(0, hotspots, count)] + rng.normal(0, 0.01, (count, 2))
+
+
+def total_distance(cost, pairs):
+    return float(sum(cost[row, col] for row, col in pairs))
+
+
+def run_scenario(name, rng, rides, drivers, trials, radius_km, hotspots):
+    greedy_km, optimal_km = [], []
+    greedy_matched, optimal_matched = [], []
+    solve_ms = []
+    
+    for _ in range(trials):
+        cost = pairwise_distance_km(random_points(rng, rides, hotspots), random_points(rng, drivers))
+        
+        greedy = greedy_assignment(cost, max_cost=radius_km)
+        started = time.perf_counter()
+        optimal = solve_assignment(cost, max_cost=radius_km)
+        solve_ms.append((time.perf_counter() - started) * 1000)
+        
+        greedy_km.append(total_distance(cost, greedy))
+        optimal_km.append(total_distance(cost, optimal))
+        greedy_matched.append(len(greedy))
+        optimal_matched.append(len(optimal))
+    
+    greedy_total = sum(greedy_km)
+    optimal_total = sum(optimal_km)
+    greedy_avg = greedy_total / max(sum(greedy_matched), 1)
+    optimal_avg = optimal_total / max(sum(optimal_matched), 1)
+    
+    print(f"\n📊 {name}: {rides} rides x {drivers} drivers, radius {radius_km}km, {trials} windows")
+    print(f"   Greedy : {np.mean(greedy_matched):7.1f} matched, {greedy_avg:.3f} km avg pickup, {greedy_total:10.1f} km total")
+    print(f"   Optimal: {np.mean(optimal_matched):7.1f} matched, {optimal_avg:.3f} km avg pickup, {optimal_total:10.1f} km total")
+    if sum(optimal_matched) == sum(greedy_matched):
+        print(f"   Pickup distance saved: {(1 - optimal_total / greedy_total) * 100 if greedy_total else 0.0:.1f}%")
+    else:
+        # The solver matches as many rides as possible first, so totals cover different ride counts
+        extra = (sum(optimal_matched) - sum(greedy_matched)) / trials
+        print(f"   Rides matched per window: {extra:+.1f}, avg pickup {(optimal_avg / greedy_avg - 1) * 100 if greedy_avg else 0.0:+.1f}%")
+    print(f"   Solve time: p50 {np.percentile(solve_ms, 50):.1f}ms, max {max(solve_ms):.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched assignment vs greedy acceptance")
+    parser.add_argument('--rides', type=int, default=200)
+    parser.add_argument('--drivers', type=int, default=250)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--radius-km', type=float, default=5.0)
+    parser.add_argument('--hotspots', type=int, default=6, help="demand clusters for the second scenario")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(args.seed)
+    
+    print("🚕 Batched Assignment Benchmark")
+    print("=" * 50)
+    run_scenario("Uniform demand", rng, args.rides, args.drivers, args.trials, args.radius_km, 0)
+    run_scenario("Clustered demand", rng, args.rides, args.drivers, args.trials, args.radius_km, args.hotspots)
+    run_scenario("Driver shortage", rng, args.drivers, args.rides, args.trials, args.radius_km, args.hotspots)
+
+
+if __name__ == "__main__":
+    main()
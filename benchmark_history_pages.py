@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Page-depth benchmark for the history endpoints
+Reads pages of a driver's and a customer's ride history at increasing depth, once with offset/limit
+and once with cursors (utils/pagination.py), and prints the latency of each. Offset pages get slower
+the deeper they are (the skipped rows are still read); cursor pages should cost the same everywhere.
+
+Run:
+    python benchmark_history_pages.py --rides 100000
+    python benchmark_history_pages.py --database-url postgresql://.../scratch --rides 500000
+
+Without --database-url a throwaway SQLite database is used. The target database must be empty:
+the script creates the tables and seeds them (see benchmark_projections.py).
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+
+DEPTHS = (0, 10, 100, 1000, 4000)
+
+
+def offset_page(db, projection, statement, page, limit):
+    from routes.mobile import HISTORY_ORDER
+    
+    return projection.all(statement.order_by(*HISTORY_ORDER).offset(page * limit).limit(limit))
+
+
+def cursor_at(projection, statement, page, limit):
+    """Cursor of the page-th page, walked to from the first page (not timed)"""
+    from utils.pagination import completed_rides_page
+    
+    after = None
+    for _ in range(page):
+        rows, token = completed_rides_page(projection, statement, limit, after)
+        if token is None:
+            return None
+        after = (rows[-1].completed_at, rows[-1].ride_id)
+    return after
+
+
+def timed(run, repeat):
+    """p50 and p95 latency of run() in ms"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - started) * 1000)
+    return np.percentile(timings, 50), np.percentile(timings, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History page latency by depth: offset vs cursor")
+    parser.add_argument('--database-url', help="empty scratch database (default: temporary SQLite file)")
+    parser.add_argument('--rides', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=20, help="rows per page")
+    parser.add_argument('--repeat', type=int, default=20, help="timed reads per page")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    os.environ["DATABASE_URL"] = args.database_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_history.db")
+    
+    import logging
+    from app import app, db
+    from models import Ride
+    from routes.mobile import DRIVER_HISTORY, CUSTOMER_HISTORY
+    from utils.pagination import completed_rides_page
+    from benchmark_projections import seed
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    with app.app_context():
+        print("🚕 History Page Depth Benchmark")
+        print("=" * 50)
+        if Ride.query.first() is not None:
+            print("❌ The ride table is not empty - point --database-url at an empty scratch database")
+            sys.exit(1)
+        
+        driver_id, customer_phone = seed(db, args.rides, random.Random(args.seed))
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text("ANALYZE ride"))
+            db.session.commit()
+        print(f"Database: {db.engine.dialect.name}, {args.rides} rides, {args.limit}-row pages")
+        
+        for name, projection, statement in (
+            ("GET /driver/history", DRIVER_HISTORY,
+             DRIVER_HISTORY.select().where(Ride.driver_id == driver_id, Ride.status == 'completed')),
+            ("GET /customer/history", CUSTOMER_HISTORY,
+             CUSTOMER_HISTORY.select().where(Ride.customer_phone == customer_phone)),
+        ):
+            print(f"\n📊 {name}")
+            for page in DEPTHS:
+                if page * args.limit >= args.rides:
+                    break
+                after = cursor_at(projection, statement, page, args.limit)
+                assert completed_rides_page(projection, statement, args.limit, after)[0] == \
+                    offset_page(db, projection, statement, page, args.limit), f"page {page} differs"
+                offset_p50, offset_p95 = timed(lambda: offset_page(db, projection, statement, page, args.limit), args.repeat)
+                cursor_p50, cursor_p95 = timed(lambda: completed_rides_page(projection, statement, args.limit, after), args.repeat)
+                print(f"   Page {page:5d}: offset p50 {offset_p50:7.2f}ms  p95 {offset_p95:7.2f}ms | "
+                      f"cursor p50 {cursor_p50:6.2f}ms  p95 {cursor_p95:6.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Row-projection benchmark for the history endpoints
+Reads 100-row pages of a driver's and a customer's ride history twice: as full ORM Ride objects
+(the previous read path) and as column projections (utils/projections.py, what the endpoints use
+now), and prints the CPU time and memory each costs per row, serialization included.
+
+Run:
+    python benchmark_projections.py --rides 50000
+    python benchmark_projections.py --database-url postgresql://.../scratch --page 100
+
+Without --database-url a throwaway SQLite database is used. The target database must be empty:
+the script creates the tables and seeds them.
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+import numpy as np
+
+SEED_CHUNK = 10000
+
+
+def seed(db, rides, rng):
+    """One driver and one customer holding every completed ride, so each page is full"""
+    from sqlalchemy import insert
+    from app import get_ist_time
+    from models import Customer, Driver, Ride
+    
+    now = get_ist_time().replace(tzinfo=None)
+    customer = Customer(name="Benchmark Customer", phone="9000000000")
+    driver = Driver(name="Benchmark Driver", phone="8000000000", username="BENCHPROJ", car_type="sedan")
+    db.session.add_all([customer, driver])
+    db.session.commit()
+    
+    for start in range(0, rides, SEED_CHUNK):
+        rows = []
+        for _ in range(start, min(start + SEED_CHUNK, rides)):
+            created_at = now - timedelta(minutes=rng.randrange(365 * 24 * 60))
+            rows.append({
+                'customer_id': customer.id, 'customer_phone': customer.phone, 'driver_id': driver.id,
+                'pickup_address': "12, MG Road, Bengaluru", 'drop_address': "Kempegowda International Airport",
+                'pickup_lat': 12.9 + rng.random() / 10, 'pickup_lng': 77.5 + rng.random() / 10,
+                'ride_type': 'sedan', 'fare_amount': round(rng.uniform(80, 900), 2),
+                'distance_km': round(rng.uniform(2, 40), 2), 'status': 'completed',
+                'created_at': created_at, 'accepted_at': created_at,
+                'completed_at': created_at + timedelta(minutes=rng.randrange(10, 90))
+            })
+        db.session.execute(insert(Ride), rows)
+        db.session.commit()
+    return driver.id, customer.phone
+
+
+def orm_driver_history(db, driver_id, offset, limit):
+    """driver_history before projections: full Ride objects, fields copied into dicts"""
+    from models import Ride
+    
+    rides = Ride.query.filter_by(driver_id=driver_id, status='completed').order_by(
+        Ride.completed_at.desc()).offset(offset).limit(limit).all()
+    return [{
+        'ride_id': ride.id,
+        'customer_phone': ride.customer_phone,
+        'pickup_address': ride.pickup_address,
+        'drop_address': ride.drop_address,
+        'fare': ride.fare_amount,
+        'distance_km': ride.distance_km,
+        'completed_at': ride.completed_at.isoformat() if ride.completed_at else None
+    } for ride in rides]
+
+
+def projected_driver_history(db, driver_id, offset, limit):
+    from models import Ride
+    from routes.mobile import DRIVER_HISTORY
+    
+    rides = DRIVER_HISTORY.all(DRIVER_HISTORY.select().where(
+        Ride.driver_id == driver_id, Ride.status == 'completed'
+    ).order_by(Ride.completed_at.desc()).offset(offset).limit(limit))
+    history = []
+    for ride in rides:
+        ride_data = ride._asdict()
+        ride_data['completed_at'] = ride.completed_at.isoformat() if ride.completed_at else None
+        history.append(ride_data)
+    return history
+
+
+def orm_customer_history(db, phone, offset, limit):
+    """customer_history before projections: Ride objects joined to drivers, driver lazy-loaded"""
+    from models import Driver, Ride
+    
+    rides = db.session.query(Ride).join(Driver, Ride.driver_id == Driver.id, isouter=True).filter(
+        Ride.customer_phone == phone).order_by(Ride.completed_at.desc()).offset(offset).limit(limit).all()
+    return [{
+        'ride_id': ride.id,
+        'pickup_address': ride.pickup_address,
+        'drop_address': ride.drop_address,
+        'status': ride.status,
+        'fare': ride.fare_amount,
+        'distance_km': ride.distance_km,
+        'completed_at': ride.completed_at.isoformat() if ride.completed_at else None,
+        'driver_name': ride.driver.name if ride.driver else None
+    } for ride in rides]
+
+
+def projected_customer_history(db, phone, offset, limit):
+    from models import Ride
+    from routes.mobile import CUSTOMER_HISTORY
+    
+    rides = CUSTOMER_HISTORY.all(CUSTOMER_HISTORY.select().where(Ride.customer_phone == phone).order_by(Ride.completed_at.desc()).offset(offset).limit(limit))
+    history = []
+    for ride in rides:
+        ride_data = ride._asdict()
+        ride_data['completed_at'] = ride.completed_at.isoformat() if ride.completed_at else None
+        history.append(ride_data)
+    return history
+
+
+def measure(db, read, key, pages, page, rng):
+    """
+    Read random pages, each in a fresh session as a request would
+    Returns: (CPU µs per row p50, p95; peak KiB allocated per row p50)
+    """
+    cpu, memory = [], []
+    for _ in range(pages):
+        offset = rng.randrange(0, 20) * page
+        db.session.remove()
+        gc.collect()
+        
+        started = time.process_time()
+        rows = read(db, key, offset, page)
+        cpu.append((time.process_time() - started) * 1e6 / max(len(rows), 1))
+        
+        db.session.remove()
+        gc.collect()
+        tracemalloc.start()
+        rows = read(db, key, offset, page)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        memory.append(peak / 1024 / max(len(rows), 1))
+    return np.percentile(cpu, 50), np.percentile(cpu, 95), np.percentile(memory, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU and memory per row: ORM objects vs column projections")
+    parser.add_argument('--database-url', help="empty scratch database (default: temporary SQLite file)")
+    parser.add_argument('--rides', type=int, default=20000)
+    parser.add_argument('--page', type=int, default=100, help="rows per page (the endpoints allow up to 100)")
+    parser.add_argument('--pages', type=int, default=100, help="pages read per variant")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    os.environ["DATABASE_URL"] = args.database_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_projections.db")
+    
+    import logging
+    from app import app, db
+    from models import Ride
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    rng = random.Random(args.seed)
+    with app.app_context():
+        print("🚕 Row Projection Benchmark")
+        print("=" * 50)
+        if Ride.query.first() is not None:
+            print("❌ The ride table is not empty - point --database-url at an empty scratch database")
+            sys.exit(1)
+        
+        driver_id, customer_phone = seed(db, args.rides, rng)
+        print(f"Database: {db.engine.dialect.name}, {args.rides} rides, {args.page}-row pages x {args.pages}")
+        
+        for name, orm_read, projected_read, key in (
+            ("GET /driver/history", orm_driver_history, projected_driver_history, driver_id),
+            ("GET /customer/history", orm_customer_history, projected_customer_history, customer_phone),
+        ):
+            assert orm_read(db, key, 0, args.page) == projected_read(db, key, 0, args.page), f"{name}: responses differ"
+            orm = measure(db, orm_read, key, args.pages, args.page, rng)
+            projected = measure(db, projected_read, key, args.pages, args.page, rng)
+            print(f"\n📊 {name}")
+            print(f"   ORM objects : CPU p50 {orm[0]:6.1f}µs/row  p95 {orm[1]:6.1f}µs/row  peak memory {orm[2]:5.2f}KiB/row")
+            print(f"   Projection  : CPU p50 {projected[0]:6.1f}µs/row  p95 {projected[1]:6.1f}µs/row  peak memory {projected[2]:5.2f}KiB/row")
+            print(f"   Savings     : {1 - projected[0] / orm[0]:.0%} CPU, {1 - projected[2] / orm[2]:.0%} memory")
+
+
+if __name__ == "__main__":
+    main()
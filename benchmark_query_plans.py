@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Query-plan benchmark for the indexes on ride and ride_rejection
+Seeds a large dataset, then runs the main query of each hot endpoint without the indexes declared
+in models.py and again with them, printing the database's plan and the latency of each.
+
+Run:
+    python benchmark_query_plans.py --rides 200000
+    python benchmark_query_plans.py --database-url postgresql://.../scratch --rides 2000000
+
+Without --database-url a throwaway SQLite database is used. The target database must be empty:
+the script creates the tables, seeds them and drops/recreates the ride indexes.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+import numpy as np
+
+RIDE_TYPES = ('hatchback', 'sedan', 'suv')
+ACTIVE_RIDE_STATUSES = ('accepted', 'arrived', 'started')
+SEED_CHUNK = 10000
+
+
+def phone(prefix, number):
+    return f"{prefix}{number:09d}"
+
+
+def seed(db, rides, customers, drivers, rejections, rng):
+    """Rides over the last year: ~1% pending, one active ride for a tenth of the drivers, the rest finished"""
+    from sqlalchemy import insert
+    from app import get_ist_time
+    from models import Customer, Driver, Ride, RideRejection
+    
+    now = get_ist_time().replace(tzinfo=None)
+    db.session.execute(insert(Customer), [
+        {'name': f"Customer {i}", 'phone': phone(9, i), 'created_at': now} for i in range(customers)
+    ])
+    db.session.execute(insert(Driver), [
+        {'name': f"Driver {i}", 'phone': phone(8, i), 'username': f"DRV{i}", 'is_online': i % 3 == 0,
+         'car_type': RIDE_TYPES[i % len(RIDE_TYPES)], 'created_at': now} for i in range(drivers)
+    ])
+    db.session.commit()
+    
+    active_drivers = list(range(1, drivers // 10 + 1))
+    for start in range(0, rides, SEED_CHUNK):
+        rows = []
+        for index in range(start, min(start + SEED_CHUNK, rides)):
+            customer = rng.randrange(customers)
+            created_at = now - timedelta(minutes=rng.randrange(365 * 24 * 60))
+            row = {
+                'customer_id': customer + 1,
+                'customer_phone': phone(9, customer),
+                'pickup_address': "Pickup", 'drop_address': "Drop",
+                'pickup_lat': 12.9 + rng.random() / 10, 'pickup_lng': 77.5 + rng.random() / 10,
+                'ride_type': RIDE_TYPES[index % len(RIDE_TYPES)],
+                'fare_amount': 100.0, 'distance_km': 5.0,
+                'created_at': created_at,
+                'driver_id': None, 'status': 'pending',
+                'accepted_at': None, 'completed_at': None, 'cancelled_at': None
+            }
+            draw = rng.random()
+            if draw < 0.01:
+                row['created_at'] = now - timedelta(minutes=rng.randrange(30))
+            elif active_drivers and draw < 0.02:
+                row.update(driver_id=active_drivers.pop(), status=rng.choice(ACTIVE_RIDE_STATUSES),
+                           accepted_at=created_at)
+            elif draw < 0.90:
+                row.update(driver_id=rng.randrange(drivers) + 1, status='completed', accepted_at=created_at,
+                           completed_at=created_at + timedelta(minutes=rng.randrange(10, 90)))
+            else:
+                row.update(status='cancelled', cancelled_at=created_at + timedelta(minutes=rng.randrange(1, 10)))
+            rows.append(row)
+        db.session.execute(insert(Ride), rows)
+        db.session.commit()
+    
+    db.session.execute(insert(RideRejection), [
+        {'ride_id': rng.randrange(rides) + 1, 'driver_phone': phone(8, rng.randrange(drivers)), 'rejected_at': now}
+        for _ in range(rejections)
+    ])
+    db.session.commit()
+
+
+def hot_queries(db, rng, customers, drivers):
+    """(endpoint, function running its main query) - the queries the routes issue, with sample arguments"""
+    from app import get_ist_time
+    from models import Driver, Ride, RideRejection
+    from routes.driver import available_rides_query
+    
+    # Plain values: the session is cleared between runs
+    driver = SimpleNamespace(**{column: getattr(db.session.get(Driver, 1), column) for column in ('id', 'phone', 'car_type')})
+    busy_driver_id = 2
+    customer_id = rng.randrange(customers) + 1
+    customer_phone = phone(9, customer_id - 1)
+    history_driver_id = rng.randrange(drivers) + 1
+    today_start = get_ist_time().replace(hour=0, minute=0, second=0, microsecond=0)
+    pending_ride_id = db.session.query(Ride.id).filter(Ride.status == 'pending').first()[0]
+    
+    return [
+        ("GET /driver/incoming_rides", lambda: available_rides_query(driver).order_by(Ride.created_at.desc()).all()),
+        ("POST /driver/accept_ride (ongoing ride)", lambda: Ride.query.filter_by(driver_id=busy_driver_id).filter(
+            Ride.status.in_(ACTIVE_RIDE_STATUSES)).first()),
+        ("POST /driver/reject_ride (duplicate check)", lambda: RideRejection.query.filter_by(
+            ride_id=pending_ride_id, driver_phone=driver.phone).first()),
+        ("POST /driver/arrived (transition target)", lambda: db.session.query(Ride.id).filter(
+            Ride.status.in_(('accepted',)), Ride.driver_id == busy_driver_id).order_by(Ride.id).limit(1).all()),
+        ("POST /customer/book_ride (ongoing ride)", lambda: Ride.query.filter_by(customer_id=customer_id).filter(
+            Ride.status.in_(('pending',) + ACTIVE_RIDE_STATUSES)).first()),
+        ("GET /driver/history", lambda: Ride.query.filter_by(driver_id=history_driver_id, status='completed').order_by(
+            Ride.completed_at.desc()).offset(0).limit(20).all()),
+        ("GET /customer/history", lambda: Ride.query.filter(Ride.customer_phone == customer_phone).order_by(
+            Ride.completed_at.desc()).offset(0).limit(20).all()),
+        ("Dispatch sweep / batch (pending pool)", lambda: db.session.query(Ride.id, Ride.ride_type).filter(
+            Ride.status == 'pending', Ride.driver_id.is_(None), Ride.ride_type == 'sedan').order_by(Ride.created_at).all()),
+        ("Dispatch (drivers that rejected a ride)", lambda: db.session.query(RideRejection.driver_phone).filter_by(
+            ride_id=pending_ride_id).all()),
+        ("GET /admin/api/recent_rides", lambda: Ride.query.order_by(Ride.created_at.desc()).limit(10).all()),
+        ("GET /admin/api/stats (today)", lambda: Ride.query.filter(
+            Ride.created_at >= today_start, Ride.created_at < today_start + timedelta(days=1)).count()),
+    ]
+
+
+class PlanCapture:
+    """Runs EXPLAIN for every statement issued while active, with the same parameters"""
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.plans = []
+    
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == 'sqlite' else "EXPLAIN "
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        if conn.dialect.name == 'sqlite':
+            self.plans.append([row[-1] for row in rows])
+        else:
+            self.plans.append([row[0] for row in rows])
+    
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+    
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
+def measure(db, queries, repeat):
+    """{endpoint: (plan lines, p50 ms, p95 ms)}"""
+    results = {}
+    for name, run in queries:
+        db.session.rollback()
+        with PlanCapture(db.engine) as capture:
+            run()
+        timings = []
+        for _ in range(repeat):
+            db.session.expunge_all()
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) * 1000)
+        plan = [line for statement in capture.plans for line in statement]
+        results[name] = (plan, np.percentile(timings, 50), np.percentile(timings, 95))
+    return results
+
+
+def drop_indexes(db):
+    from sqlalchemy import text
+    from models import Ride, RideRejection
+    
+    names = [index.name for table in (Ride.__table__, RideRejection.__table__) for index in table.indexes]
+    for name in names:
+        db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    db.session.commit()
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN plans and latency of the hot queries without/with indexes")
+    parser.add_argument('--database-url', help="empty scratch database (default: temporary SQLite file)")
+    parser.add_argument('--rides', type=int, default=200000)
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--drivers', type=int, default=2000)
+    parser.add_argument('--rejections', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20, help="timed runs per query")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    os.environ["DATABASE_URL"] = args.database_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark_plans.db")
+    os.environ["SCHEMA_AUTO_INDEXES"] = "false"
+    
+    import logging
+    from app import app, db
+    from models import Ride
+    from utils.schema import ensure_indexes
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    rng = random.Random(args.seed)
+    with app.app_context():
+        print("🚕 Query Plan Benchmark")
+        print("=" * 50)
+        if Ride.query.first() is not None:
+            print("❌ The ride table is not empty - point --database-url at an empty scratch database")
+            sys.exit(1)
+        
+        started = time.perf_counter()
+        seed(db, args.rides, args.customers, args.drivers, args.rejections, rng)
+        print(f"Database: {db.engine.dialect.name}, seeded {args.rides} rides in {time.perf_counter() - started:.1f}s")
+        
+        names = drop_indexes(db)
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text("ANALYZE ride; ANALYZE ride_rejection"))
+            db.session.commit()
+        queries = hot_queries(db, rng, args.customers, args.drivers)
+        before = measure(db, queries, args.repeat)
+        
+        started = time.perf_counter()
+        ensure_indexes()
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+        print(f"Created {len(names)} indexes in {time.perf_counter() - started:.1f}s: {', '.join(names)}")
+        after = measure(db, queries, args.repeat)
+    
+    for name, _ in queries:
+        plan_before, p50_before, p95_before = before[name]
+        plan_after, p50_after, p95_after = after[name]
+        print(f"\n📊 {name}")
+        print(f"   Without indexes: p50 {p50_before:8.2f}ms  p95 {p95_before:8.2f}ms")
+        for line in plan_before:
+            print(f"      {line}")
+        print(f"   With indexes   : p50 {p50_after:8.2f}ms  p95 {p95_after:8.2f}ms  ({p50_before / max(p50_after, 1e-6):.0f}x)")
+        for line in plan_after:
+            print(f"      {line}")
+
+
+if __name__ == "__main__":
+    main()
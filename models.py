@@ -1,7 +1,9 @@
 from app import db, get_ist_time
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy import func, event
+from sqlalchemy.orm import joinedload
+from utils.partitions import partition_on_create
 
 class Customer(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -41,6 +43,15 @@ class Driver(UserMixin, db.Model):
     # Relationship with rides
     rides = db.relationship('Ride', backref='driver', lazy=True)
     
+    # Dispatch state (removed with the driver)
+    position = db.relationship('DriverPosition', backref='driver', uselist=False, lazy=True, cascade='all, delete-orphan')
+    offers = db.relationship('RideOffer', backref='driver', lazy=True, cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        # Admin driver listing: newest first, keyset on (created_at, id)
+        db.Index('ix_driver_created_at', 'created_at', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Driver {self.name}>'
 
@@ -89,9 +100,37 @@ class Ride(db.Model):
     completed_at = db.Column(db.DateTime, nullable=True)
     cancelled_at = db.Column(db.DateTime, nullable=True)
     
+    __table_args__ = (
+        # At most one active ride per driver, even when two accepts for different rides race
+        db.Index(
+            'uq_ride_driver_active', 'driver_id', unique=True,
+            sqlite_where=db.text("status IN ('accepted', 'arrived', 'started')"),
+            postgresql_where=db.text("status IN ('accepted', 'arrived', 'started')")
+        ),
+        # Incoming rides and dispatch: the pending pool stays small however large the table grows
+        db.Index(
+            'ix_ride_pending_type_created', 'ride_type', 'created_at',
+            sqlite_where=db.text("status = 'pending'"),
+            postgresql_where=db.text("status = 'pending'")
+        ),
+        # Active ride of a customer (booking guard, status, cancel)
+        db.Index('ix_ride_customer_status', 'customer_id', 'status'),
+        # Active ride of a driver and driver history, newest completed first
+        db.Index('ix_ride_driver_status_completed', 'driver_id', 'status', 'completed_at', 'id'),
+        # Customer history, newest completed first
+        db.Index('ix_ride_customer_phone_completed', 'customer_phone', 'completed_at', 'id'),
+        # Admin recent rides and rides booked today
+        db.Index('ix_ride_created_at', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Ride {self.id} - {self.status}>'
     
+    @classmethod
+    def with_people(cls):
+        """Loader options that fetch customer and driver in the rides' SELECT, for lists serialized with to_dict()"""
+        return (joinedload(cls.customer), joinedload(cls.driver))
+    
     def to_dict(self):
         """Convert ride to dictionary for API responses"""
         ride_data = {
@@ -144,6 +183,13 @@ class Ride(db.Model):
         return ride_data
 
 class RideRejection(db.Model):
+    __table_args__ = (
+        # Rides a driver rejected (excluded from incoming rides) and the duplicate check on reject
+        db.Index('ix_ride_rejection_driver_ride', 'driver_phone', 'ride_id'),
+        # Drivers that rejected a ride (dispatch skips them)
+        db.Index('ix_ride_rejection_ride', 'ride_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False)
     driver_phone = db.Column(db.String(10), nullable=False)
@@ -154,13 +200,19 @@ class RideRejection(db.Model):
 
 
 class RideLocation(db.Model):
-    """GPS tracking data for active rides"""
+    """GPS tracking data for active rides (partitioned by day on Postgres - see utils/partitions.py)"""
+    __table_args__ = (
+        db.Index('ix_ride_location_ride_time', 'ride_id', 'timestamp'),
+        # Retention without partitions deletes by time range
+        db.Index('ix_ride_location_timestamp', 'timestamp').ddl_if(dialect='sqlite'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=get_ist_time, nullable=False)
-    is_latest = db.Column(db.Boolean, default=False, nullable=False)  # Index for fast latest location lookup
+    is_latest = db.Column(db.Boolean, default=False, nullable=False)  # Legacy flag, no longer maintained - see RideLatestLocation
     
     # Relationships
     ride = db.relationship('Ride', backref='locations', lazy=True)
@@ -178,3 +230,63 @@ class RideLocation(db.Model):
             'timestamp': self.timestamp.isoformat(),
             'is_latest': self.is_latest
         }
+
+
+# On Postgres create_all makes ride_location a partitioned table instead
+event.listen(RideLocation.__table__, 'after_create', partition_on_create)
+
+
+class RideLatestLocation(db.Model):
+    """Latest GPS position of a ride (one row per ride, overwritten in place on every ping)"""
+    ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)  # When the point was recorded
+    updated_at = db.Column(db.DateTime, default=get_ist_time, nullable=False)
+    
+    def __repr__(self):
+        return f'<RideLatestLocation {self.ride_id}: {self.latitude}, {self.longitude}>'
+
+
+class RideTrail(db.Model):
+    """Simplified GPS trail of a finished ride as a Google encoded polyline (replaces its RideLocation rows)"""
+    ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), primary_key=True)
+    polyline = db.Column(db.Text, nullable=False)
+    point_count = db.Column(db.Integer, nullable=False)  # Points kept after simplification
+    raw_point_count = db.Column(db.Integer, nullable=False)  # Points received
+    tolerance_meters = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)  # First and last GPS point
+    ended_at = db.Column(db.DateTime, nullable=True)
+    compacted_at = db.Column(db.DateTime, default=get_ist_time, nullable=False)
+    
+    def __repr__(self):
+        return f'<RideTrail {self.ride_id}: {self.point_count}/{self.raw_point_count} points>'
+
+
+class DriverPosition(db.Model):
+    """Last reported position of a driver, used for nearest-driver dispatch (one row per driver)"""
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=get_ist_time, nullable=False)
+    
+    def __repr__(self):
+        return f'<DriverPosition {self.driver_id}: {self.latitude}, {self.longitude}>'
+
+
+class RideOffer(db.Model):
+    """Pending ride offered to one of the nearest eligible drivers"""
+    id = db.Column(db.Integer, primary_key=True)
+    ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False)
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), nullable=False)
+    distance_km = db.Column(db.Float, nullable=True)  # Straight-line distance to pickup when offered
+    offered_at = db.Column(db.DateTime, default=get_ist_time, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_ride_offer_driver_expires', 'driver_id', 'expires_at'),
+        db.Index('ix_ride_offer_ride', 'ride_id'),
+    )
+    
+    def __repr__(self):
+        return f'<RideOffer {self.ride_id} to driver {self.driver_id}>'
@@ -1,9 +1,20 @@
 from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
-from app import db, get_ist_time
-from models import Admin, Customer, Driver, Ride
+from app import db
+from models import Admin, Customer, Driver, Ride, RideOffer, RideLatestLocation, RideTrail
 from utils.validators import create_error_response, create_success_response, validate_phone, validate_required_fields
+from utils.maps import get_maps_stats
+from utils.ride_index import pending_ride_index
+from utils.dispatch import nearest_dispatcher, get_dispatch_stats
+from utils.tracking import get_gps_stats
+from utils.trails import compact_finished_ride
+from utils.streams import get_stream_stats
+from utils.events import event_bus
+from utils.ride_state import apply_transition
+from utils.stats import dashboard_stats, ACTIVE_RIDE_STATUSES
+from utils.projections import Projection
+from utils.pagination import validate_cursor, keyset_page
 import logging
 import random
 import string
@@ -11,6 +22,31 @@ from datetime import datetime, timedelta
 
 admin_bp = Blueprint('admin', __name__)
 
+# Page size of the admin list APIs
+ADMIN_API_PAGE_LIMIT = 100
+ADMIN_API_MAX_LIMIT = 500
+
+DRIVER_API_COLUMNS = (
+    'id', 'name', 'phone', 'username', 'is_online', 'car_make', 'car_model', 'car_year', 'car_number',
+    'car_type', 'license_number', 'profile_photo_url', 'aadhaar_url', 'license_url', 'rcbook_url', 'created_at'
+)
+
+RECENT_RIDE = Projection(
+    'RecentRideRow',
+    id=Ride.id, customer_phone=Ride.customer_phone, pickup_address=Ride.pickup_address, status=Ride.status,
+    fare_amount=Ride.fare_amount, created_at=Ride.created_at,
+    customer_name=db.select(Customer.name).where(Customer.id == Ride.customer_id).scalar_subquery(),
+    driver_name=db.select(Driver.name).where(Driver.id == Ride.driver_id).scalar_subquery(),
+    driver_phone=db.select(Driver.phone).where(Driver.id == Ride.driver_id).scalar_subquery()
+)
+# Per-customer ride totals for the customers page
+CUSTOMER_RIDES = Projection(
+    'CustomerRidesRow',
+    customer_id=Ride.customer_id, total_rides=db.func.count(Ride.id),
+    active_rides=db.func.count(Ride.id).filter(Ride.status.in_(('pending',) + ACTIVE_RIDE_STATUSES)),
+    last_ride_at=db.func.max(Ride.created_at)
+)
+
 def generate_driver_username():
     """Generate unique driver username in format DRVAB12CD"""
     while True:
@@ -70,37 +106,11 @@ def landing():
 def dashboard():
     """Admin dashboard"""
     try:
-        # Get statistics
-        total_customers = Customer.query.count()
-        total_drivers = Driver.query.count()
-        total_rides = Ride.query.count()
-        
-        # Get rides by status
-        pending_rides = Ride.query.filter_by(status='pending').count()
-        active_rides = Ride.query.filter(Ride.status.in_(['accepted', 'arrived', 'started'])).count()
-        completed_rides = Ride.query.filter_by(status='completed').count()
-        cancelled_rides = Ride.query.filter_by(status='cancelled').count()
+        # Get statistics (shared short-TTL cache, same numbers as /api/stats)
+        stats = dashboard_stats.get()
         
         # Get recent rides (last 10)
-        recent_rides = Ride.query.order_by(Ride.created_at.desc()).limit(10).all()
-        
-        # Get today's stats
-        today = datetime.now().date()
-        today_rides = Ride.query.filter(
-            db.func.date(Ride.created_at) == today
-        ).count()
-        
-        stats = {
-            'total_customers': total_customers,
-            'total_drivers': total_drivers,
-            'total_rides': total_rides,
-            'pending_rides': pending_rides,
-            'active_rides': active_rides,
-            'completed_rides': completed_rides,
-            'cancelled_rides': cancelled_rides,
-            'today_rides': today_rides,
-            'recent_rides': recent_rides
-        }
+        stats['recent_rides'] = Ride.query.options(*Ride.with_people()).order_by(Ride.created_at.desc()).limit(10).all()
         
         return render_template('admin/dashboard.html', stats=stats)
         
@@ -120,7 +130,7 @@ def rides():
         per_page = 20
         
         # Build query
-        query = Ride.query
+        query = Ride.query.options(*Ride.with_people())
         
         if status_filter != 'all':
             query = query.filter_by(status=status_filter)
@@ -149,7 +159,12 @@ def customers():
             page=page, per_page=per_page, error_out=False
         )
         
-        return render_template('admin/customers.html', customers=customers)
+        # Ride totals for the page in one grouped query
+        ride_totals = {row.customer_id: row for row in CUSTOMER_RIDES.all(CUSTOMER_RIDES.select().where(
+            Ride.customer_id.in_([customer.id for customer in customers.items])
+        ).group_by(Ride.customer_id))}
+        
+        return render_template('admin/customers.html', customers=customers, ride_totals=ride_totals)
         
     except Exception as e:
         logging.error(f"Error in admin customers: {str(e)}")
@@ -164,11 +179,17 @@ def drivers():
         page = request.args.get('page', 1, type=int)
         per_page = 20
         
-        drivers = Driver.query.order_by(Driver.created_at.desc()).paginate(
+        # Same order as api_drivers, so the table refresh shows the same first page
+        drivers = Driver.query.order_by(Driver.created_at.desc().nulls_last(), Driver.id.desc()).paginate(
             page=page, per_page=per_page, error_out=False
         )
         
-        return render_template('admin/drivers.html', drivers=drivers)
+        # Ride counts for the page in one grouped query
+        ride_counts = dict(db.session.query(Ride.driver_id, db.func.count(Ride.id)).filter(
+            Ride.driver_id.in_([driver.id for driver in drivers.items])
+        ).group_by(Ride.driver_id).all())
+        
+        return render_template('admin/drivers.html', drivers=drivers, ride_counts=ride_counts)
         
     except Exception as e:
         logging.error(f"Error in admin drivers: {str(e)}")
@@ -183,9 +204,14 @@ def clear_logs():
         # Get count of all rides before deletion
         total_rides = Ride.query.count()
         
-        # Delete all rides
+        # Delete all rides (and the dispatch offers, latest positions and trails that reference them)
+        RideOffer.query.delete()
+        RideLatestLocation.query.delete()
+        RideTrail.query.delete()
         Ride.query.delete()
         db.session.commit()
+        pending_ride_index.clear()
+        dashboard_stats.invalidate()
         
         logging.info(f"Cleared {total_rides} rides")
         flash(f'Cleared {total_rides} rides successfully', 'success')
@@ -202,52 +228,81 @@ def clear_logs():
 def api_stats():
     """API endpoint for dashboard stats"""
     try:
-        # Get real-time statistics
-        from datetime import datetime, timedelta
-        from app import get_ist_time
-        
-        # Calculate today's rides (rides created today in IST)
-        today_start = get_ist_time().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = today_start + timedelta(days=1)
-        
-        stats = {
-            'total_customers': Customer.query.count(),
-            'total_drivers': Driver.query.count(),
-            'total_rides': Ride.query.count(),
-            'today_rides': Ride.query.filter(Ride.created_at >= today_start, Ride.created_at < today_end).count(),
-            'pending_rides': Ride.query.filter_by(status='pending').count(),
-            'active_rides': Ride.query.filter(Ride.status.in_(['accepted', 'arrived', 'started'])).count(),
-            'completed_rides': Ride.query.filter_by(status='completed').count(),
-            'cancelled_rides': Ride.query.filter_by(status='cancelled').count(),
-        }
-        
-        return jsonify(stats)
+        # Counts at most ADMIN_STATS_TTL_SECONDS old, computed once per worker for every open tab
+        return jsonify(dashboard_stats.get())
         
     except Exception as e:
         logging.error(f"Error in api_stats: {str(e)}")
         return jsonify({'error': 'Error loading stats'}), 500
 
+@admin_bp.route('/api/maps_stats')
+@login_required
+def api_maps_stats():
+    """API endpoint for Google Maps cache and client statistics (per worker)"""
+    try:
+        return jsonify(get_maps_stats())
+        
+    except Exception as e:
+        logging.error(f"Error in api_maps_stats: {str(e)}")
+        return jsonify({'error': 'Error loading maps stats'}), 500
+
+@admin_bp.route('/api/dispatch_stats')
+@login_required
+def api_dispatch_stats():
+    """API endpoint for dispatch settings, indexed drivers and batch matching results (per worker)"""
+    try:
+        return jsonify(get_dispatch_stats())
+        
+    except Exception as e:
+        logging.error(f"Error in api_dispatch_stats: {str(e)}")
+        return jsonify({'error': 'Error loading dispatch stats'}), 500
+
+@admin_bp.route('/api/gps_stats')
+@login_required
+def api_gps_stats():
+    """API endpoint for GPS write-behind buffer and movement filter statistics (per worker)"""
+    try:
+        return jsonify(get_gps_stats())
+        
+    except Exception as e:
+        logging.error(f"Error in api_gps_stats: {str(e)}")
+        return jsonify({'error': 'Error loading GPS stats'}), 500
+
+@admin_bp.route('/api/stream_stats')
+@login_required
+def api_stream_stats():
+    """API endpoint for open streaming connections and pushed events (per worker)"""
+    try:
+        return jsonify(get_stream_stats())
+        
+    except Exception as e:
+        logging.error(f"Error in api_stream_stats: {str(e)}")
+        return jsonify({'error': 'Error loading stream stats'}), 500
+
+@admin_bp.route('/api/event_stats')
+@login_required
+def api_event_stats():
+    """API endpoint for the cross-worker event bus (per worker)"""
+    try:
+        return jsonify(event_bus.stats())
+        
+    except Exception as e:
+        logging.error(f"Error in api_event_stats: {str(e)}")
+        return jsonify({'error': 'Error loading event stats'}), 500
+
 @admin_bp.route('/api/recent_rides')
 @login_required
 def api_recent_rides():
     """API endpoint for recent rides data"""
     try:
         # Get recent rides (last 10)
-        recent_rides = Ride.query.order_by(Ride.created_at.desc()).limit(10).all()
+        recent_rides = RECENT_RIDE.all(RECENT_RIDE.select().order_by(Ride.created_at.desc()).limit(10))
         
         rides_data = []
         for ride in recent_rides:
-            ride_data = {
-                'id': ride.id,
-                'customer_name': ride.customer.name if ride.customer else 'Unknown',
-                'customer_phone': ride.customer_phone,
-                'driver_name': ride.driver.name if ride.driver else None,
-                'driver_phone': ride.driver.phone if ride.driver else None,
-                'pickup_address': ride.pickup_address,
-                'status': ride.status,
-                'fare_amount': ride.fare_amount,
-                'created_at': ride.created_at.strftime('%Y-%m-%d %H:%M')
-            }
+            ride_data = ride._asdict()
+            ride_data['customer_name'] = ride.customer_name or 'Unknown'
+            ride_data['created_at'] = ride.created_at.strftime('%Y-%m-%d %H:%M')
             rides_data.append(ride_data)
         
         return jsonify({'rides': rides_data})
@@ -259,35 +314,47 @@ def api_recent_rides():
 @admin_bp.route('/api/drivers')
 @login_required
 def api_drivers():
-    """API endpoint for drivers data"""
+    """
+    API endpoint for drivers data, newest first
+    Query: is_online (true/false), car_type, limit (default 100, max 500), cursor (next_cursor of the previous page)
+    """
     try:
-        # Get all drivers
-        drivers = Driver.query.order_by(Driver.created_at.desc()).all()
+        limit = min(max(request.args.get('limit', ADMIN_API_PAGE_LIMIT, type=int), 1), ADMIN_API_MAX_LIMIT)
+        cursor = request.args.get('cursor')
+        is_online = request.args.get('is_online')
+        car_type = request.args.get('car_type')
+        
+        after = None
+        if cursor:
+            valid, after = validate_cursor(cursor)
+            if not valid:
+                return jsonify({'error': after}), 400
+        
+        # Counted per row from the ride indexes (driver_id leads them), never by loading ride histories
+        total_rides = db.session.query(db.func.count(Ride.id)).filter(
+            Ride.driver_id == Driver.id
+        ).correlate(Driver).scalar_subquery().label('total_rides')
+        
+        query = db.session.query(*[getattr(Driver, column) for column in DRIVER_API_COLUMNS], total_rides)
+        if is_online is not None:
+            query = query.filter(Driver.is_online == (is_online.lower() == 'true'))
+        if car_type:
+            query = query.filter(Driver.car_type == car_type)
+        
+        # The cursor carries the last driver's (created_at, id), so deleting that driver cannot end the listing
+        rows, next_cursor = keyset_page(lambda page: page.all(), query, Driver.created_at, Driver.id,
+                                        lambda row: (row.created_at, row.id), limit, after)
         
         drivers_data = []
-        for driver in drivers:
-            driver_data = {
-                'id': driver.id,
-                'name': driver.name,
-                'phone': driver.phone,
-                'username': driver.username,
-                'is_online': driver.is_online,
-                'car_make': driver.car_make,
-                'car_model': driver.car_model,
-                'car_year': driver.car_year,
-                'car_number': driver.car_number,
-                'car_type': driver.car_type,
-                'license_number': driver.license_number,
-                'profile_photo_url': driver.profile_photo_url,
-                'aadhaar_url': driver.aadhaar_url,
-                'license_url': driver.license_url,
-                'rcbook_url': driver.rcbook_url,
-                'total_rides': len(driver.rides),
-                'created_at': driver.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            }
+        for row in rows:
+            driver_data = row._asdict()
+            driver_data['created_at'] = row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else None
             drivers_data.append(driver_data)
         
-        return jsonify({'drivers': drivers_data})
+        return jsonify({
+            'drivers': drivers_data,
+            'next_cursor': next_cursor
+        })
         
     except Exception as e:
         logging.error(f"Error in api_drivers: {str(e)}")
@@ -298,15 +365,14 @@ def api_drivers():
 def cancel_ride_admin(ride_id):
     """Cancel a ride from admin panel"""
     try:
-        ride = Ride.query.get_or_404(ride_id)
-        
-        if ride.status in ['completed', 'cancelled']:
+        ride = apply_transition('force_cancel', ride_id=ride_id)
+        if not ride:
+            Ride.query.get_or_404(ride_id)
             return jsonify({'error': 'Ride cannot be cancelled'}), 400
         
-        ride.status = 'cancelled'
-        ride.cancelled_at = get_ist_time()
-        
         db.session.commit()
+        nearest_dispatcher.withdraw(ride.id)
+        compact_finished_ride(ride.id)
         
         logging.info(f"Ride {ride_id} cancelled by admin")
         return jsonify({'message': 'Ride cancelled successfully'})
@@ -455,6 +521,8 @@ def update_driver():
         # Update basic information
         driver.name = request.form.get('name', driver.name)
         driver.is_online = request.form.get('is_online', 'false').lower() == 'true'
+        if not driver.is_online:
+            nearest_dispatcher.driver_offline(driver.id)
         
         # Update vehicle information
         driver.car_make = request.form.get('car_make') or None
@@ -517,6 +585,7 @@ def delete_driver():
         driver_name = driver.name
         db.session.delete(driver)
         db.session.commit()
+        nearest_dispatcher.positions.remove(driver.id)
         
         logging.info(f"Admin deleted driver: {driver_name} (ID: {driver_id})")
         
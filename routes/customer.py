@@ -1,9 +1,15 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, Response, request, jsonify, session
 from flask_login import login_user, logout_user, login_required, current_user
 from app import db, get_ist_time
-from models import Customer, Ride, RideLocation
+from models import Customer, Ride
 from utils.validators import validate_phone, validate_required_fields, validate_ride_type, create_error_response, create_success_response
 from utils.maps import get_distance_and_fare
+from utils.dispatch import nearest_dispatcher
+from utils.tracking import get_latest_location
+from utils.trails import compact_finished_ride
+from utils.streams import ride_stream_hub, location_event, is_ride_finished
+from utils.events import publish_ride_event
+from utils.ride_state import apply_transition
 import logging
 
 customer_bp = Blueprint('customer', __name__)
@@ -142,7 +148,9 @@ def book_ride():
         )
         
         db.session.add(ride)
+        publish_ride_event('created', ride, broadcast=not nearest_dispatcher.targets(ride))
         db.session.commit()
+        nearest_dispatcher.dispatch(ride)
         
         logging.info(f"Ride booked: {ride.id} for customer {customer.name} - {ride_type}")
         return create_success_response({
@@ -224,21 +232,14 @@ def cancel_ride():
         if not customer:
             return create_error_response("Customer not found")
         
-        # Find active ride
-        active_ride = Ride.query.filter_by(
-            customer_id=customer.id
-        ).filter(
-            Ride.status.in_(['pending', 'accepted'])
-        ).first()
-        
+        # Cancel the pending/accepted ride
+        active_ride = apply_transition('cancel', customer_id=customer.id)
         if not active_ride:
             return create_error_response("No cancellable ride found")
         
-        # Cancel the ride
-        active_ride.status = 'cancelled'
-        active_ride.cancelled_at = get_ist_time()
-        
         db.session.commit()
+        nearest_dispatcher.withdraw(active_ride.id)
+        compact_finished_ride(active_ride.id)
         
         logging.info(f"Ride cancelled: {active_ride.id} by customer {customer.name}")
         return create_success_response({
@@ -341,11 +342,8 @@ def get_driver_location(ride_id):
         if ride.status not in ['accepted', 'arrived', 'started']:
             return jsonify({'error': 'Location tracking only available for active rides'}), 400
         
-        # Get latest location for this ride
-        latest_location = RideLocation.query.filter_by(
-            ride_id=ride_id,
-            is_latest=True
-        ).first()
+        # Get latest location for this ride (one row per ride)
+        latest_location = get_latest_location(ride_id)
         
         if not latest_location:
             return jsonify({'error': 'No location data available'}), 404
@@ -368,6 +366,42 @@ def get_driver_location(ride_id):
         return jsonify({'error': 'Error retrieving location'}), 500
 
 
+@customer_bp.route('/driver_location/<int:ride_id>/stream', methods=['GET'])
+def stream_driver_location(ride_id):
+    """Server-Sent Events stream of driver positions and status changes for a ride"""
+    try:
+        # Subscribe before reading the snapshot so nothing published in between is missed
+        subscriber = ride_stream_hub.subscribe(ride_id)
+        try:
+            ride = db.session.get(Ride, ride_id)
+            if not ride:
+                ride_stream_hub.unsubscribe(ride_id, subscriber)
+                return jsonify({'error': 'Ride not found'}), 404
+            
+            initial_events = [('status', ride.to_dict())]
+            latest_location = get_latest_location(ride_id)
+            if latest_location and ride.status in ['accepted', 'arrived', 'started']:
+                initial_events.append(('location', location_event(
+                    ride_id, latest_location.latitude, latest_location.longitude, latest_location.timestamp
+                )))
+        except Exception:
+            ride_stream_hub.unsubscribe(ride_id, subscriber)
+            raise
+        finally:
+            # The stream itself never touches the database
+            db.session.remove()
+        
+        return Response(
+            ride_stream_hub.stream([ride_id], subscriber, initial_events, is_final=is_ride_finished),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        logging.error(f"Error opening driver location stream: {str(e)}")
+        return jsonify({'error': 'Error opening location stream'}), 500
+
+
 @customer_bp.route('/logout', methods=['POST'])
 def logout():
     """Logout customer"""
@@ -1,14 +1,31 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, Response, request, jsonify, session
 from flask_login import login_user, logout_user, login_required, current_user
 from app import db, get_ist_time
-from models import Driver, Ride, RideRejection, RideLocation
+from models import Driver, Ride, RideRejection
 from utils.validators import validate_phone, validate_required_fields, create_error_response, create_success_response
-from utils.maps import get_distance_to_pickup
+from utils.maps import get_distances_to_pickups
+from utils.estimator import parse_location
+from utils.ride_index import pending_ride_index
+from utils.dispatch import nearest_dispatcher, accept_pending_ride
+from utils.tracking import record_location, record_locations, parse_points, GPS_BATCH_MAX_POINTS
+from utils.trails import compact_finished_ride
+from utils.streams import offer_stream_hub, ride_type_key, driver_key, is_driver_offline
+from utils.events import event_bus, publish_location_event
+from utils.ride_state import apply_transition
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import check_password_hash
 import logging
+import os
 
 driver_bp = Blueprint('driver', __name__)
 
+# Default search radius for incoming_rides when the driver sends driver_location (0 = whole city)
+INCOMING_RIDES_RADIUS_KM = float(os.environ.get("INCOMING_RIDES_RADIUS_KM", 0))
+INCOMING_RIDES_LIMIT = int(os.environ.get("INCOMING_RIDES_LIMIT", 50))
+# Larger requested radii are clamped to this
+INCOMING_RIDES_MAX_RADIUS_KM = float(os.environ.get("INCOMING_RIDES_MAX_RADIUS_KM", 50))
+
 @driver_bp.route('/login', methods=['POST'])
 def login():
     """Driver login with username and password"""
@@ -65,6 +82,28 @@ def login():
 
 
 
+def available_rides_query(driver):
+    """Pending, unassigned rides of the driver's vehicle type that the driver has not rejected"""
+    # First get ride IDs rejected by this driver
+    rejected_ride_ids = db.session.query(RideRejection.ride_id).filter_by(driver_phone=driver.phone)
+    
+    # Query for available rides excluding rejected ones and matching vehicle type
+    rides_query = Ride.query.filter(
+        Ride.status == 'pending',
+        Ride.driver_id.is_(None),
+        ~Ride.id.in_(rejected_ride_ids),
+        Ride.ride_type == driver.car_type  # Only show rides matching driver's vehicle type
+    ).options(*Ride.with_people())
+    
+    if nearest_dispatcher.enabled:
+        # Only rides offered to this driver, plus address-only rides that cannot be dispatched by distance
+        rides_query = rides_query.filter(or_(
+            Ride.id.in_(nearest_dispatcher.offered_ride_ids(driver.id)),
+            Ride.pickup_lat.is_(None),
+            Ride.pickup_lng.is_(None)
+        ))
+    return rides_query
+
 @driver_bp.route('/incoming_rides', methods=['GET'])
 def incoming_rides():
     """Get available rides for driver"""
@@ -92,35 +131,36 @@ def incoming_rides():
                 'count': 0
             }, "Driver is offline. No rides available.")
         
-        # Get available rides (pending status, not assigned to any driver, not rejected by this driver, matching vehicle type)
-        # First get ride IDs rejected by this driver
-        rejected_ride_ids = db.session.query(RideRejection.ride_id).filter_by(driver_phone=phone)
-        
-        # Query for available rides excluding rejected ones and matching vehicle type
-        available_rides = Ride.query.filter(
-            Ride.status == 'pending',
-            Ride.driver_id.is_(None),
-            ~Ride.id.in_(rejected_ride_ids),
-            Ride.ride_type == driver.car_type  # Only show rides matching driver's vehicle type
-        ).order_by(Ride.created_at.desc()).all()
+        # Re-offer rides whose offers expired (nearest mode only)
+        nearest_dispatcher.sweep()
+        rides_query = available_rides_query(driver)
+        
+        driver_location = request.args.get('driver_location')
+        driver_point = parse_location(driver_location)
+        radius_km = min(request.args.get('radius_km', INCOMING_RIDES_RADIUS_KM, type=float), INCOMING_RIDES_MAX_RADIUS_KM)
+        
+        if driver_point and radius_km > 0:
+            # Only rides near the driver, nearest first - candidates come from the in-memory index
+            # and are re-checked against the database
+            nearby = pending_ride_index.nearby(
+                driver.car_type, driver_point[0], driver_point[1], radius_km, limit=INCOMING_RIDES_LIMIT
+            )
+            ride_ids = [ride_id for _, ride_id in nearby]
+            rides_by_id = {ride.id: ride for ride in rides_query.filter(Ride.id.in_(ride_ids)).all()} if ride_ids else {}
+            available_rides = [rides_by_id[ride_id] for ride_id in ride_ids if ride_id in rides_by_id]
+        else:
+            available_rides = rides_query.order_by(Ride.created_at.desc()).all()
         
         # Convert to list of dictionaries
-        rides_data = []
-        for ride in available_rides:
-            ride_dict = ride.to_dict()
-            
-            # Add distance to pickup if driver location is provided
-            driver_location = request.args.get('driver_location')
-            if driver_location:
-                success, distance_km, error_msg = get_distance_to_pickup(
-                    driver_location, ride.pickup_address, ride.pickup_lat, ride.pickup_lng
-                )
-                if success:
-                    ride_dict['distance_to_pickup_km'] = distance_km
-                else:
-                    ride_dict['distance_to_pickup_km'] = None
-            
-            rides_data.append(ride_dict)
+        rides_data = [ride.to_dict() for ride in available_rides]
+        
+        # Add distance to pickup if driver location is provided (one batched lookup for all rides)
+        if driver_location and available_rides:
+            distances = get_distances_to_pickups(driver_location, [
+                (ride.pickup_address, ride.pickup_lat, ride.pickup_lng) for ride in available_rides
+            ])
+            for ride_dict, distance_km in zip(rides_data, distances):
+                ride_dict['distance_to_pickup_km'] = distance_km
         
         return create_success_response({
             'rides': rides_data,
@@ -159,27 +199,35 @@ def accept_ride():
         if not driver:
             return create_error_response("Driver not found")
         
-        # Check if driver has any ongoing ride
-        ongoing_ride = Ride.query.filter_by(
-            driver_id=driver.id
-        ).filter(
-            Ride.status.in_(['accepted', 'arrived', 'started'])
-        ).first()
-        
-        if ongoing_ride:
+        # One conditional UPDATE decides the winner when several drivers accept at once
+        try:
+            ride = accept_pending_ride(
+                ride_id, driver.id, get_ist_time(), offered_only=nearest_dispatcher.enabled
+            )
+        except IntegrityError:
+            # Another accept by this driver committed first (uq_ride_driver_active)
+            db.session.rollback()
             return create_error_response("You already have an ongoing ride")
         
-        # Find the ride and check if it's still available
-        ride = Ride.query.filter_by(id=ride_id, status='pending', driver_id=None).first()
-        if not ride:
+        if ride is None:
+            db.session.rollback()
+            
+            # Only losers pay for working out why
+            ongoing_ride = Ride.query.filter_by(
+                driver_id=driver.id
+            ).filter(
+                Ride.status.in_(['accepted', 'arrived', 'started'])
+            ).first()
+            if ongoing_ride:
+                return create_error_response("You already have an ongoing ride")
+            
+            ride = Ride.query.filter_by(id=ride_id, status='pending', driver_id=None).first()
+            if ride and not nearest_dispatcher.can_accept(ride, driver.id):
+                return create_error_response("Ride was not offered to you")
             return create_error_response("Ride not available or already accepted")
         
-        # Assign ride to driver
-        ride.driver_id = driver.id
-        ride.status = 'accepted'
-        ride.accepted_at = get_ist_time()
-        
         db.session.commit()
+        nearest_dispatcher.withdraw(ride.id)
         
         logging.info(f"Ride accepted: {ride.id} by driver {driver.name}")
         return create_success_response({
@@ -239,8 +287,16 @@ def reject_ride():
             rejected_at=get_ist_time()
         )
         db.session.add(rejection)
+        
+        # Gone from this driver's offer stream
+        driver_id = db.session.query(Driver.id).filter_by(phone=phone).scalar()
+        if driver_id is not None:
+            event_bus.publish('offer.removed', {'driver_id': driver_id, 'ride_id': ride.id, 'reason': 'rejected'})
         db.session.commit()
         
+        # Next nearest driver gets the offer
+        nearest_dispatcher.decline(ride, phone)
+        
         logging.info(f"Driver {phone} rejected ride {ride_id}")
         
         return create_success_response({
@@ -277,19 +333,11 @@ def arrived():
         if not driver:
             return create_error_response("Driver not found")
         
-        # Find accepted ride
-        ride = Ride.query.filter_by(
-            driver_id=driver.id,
-            status='accepted'
-        ).first()
-        
+        # Mark the accepted ride as arrived
+        ride = apply_transition('arrive', driver_id=driver.id)
         if not ride:
             return create_error_response("No accepted ride found")
         
-        # Mark as arrived
-        ride.status = 'arrived'
-        ride.arrived_at = get_ist_time()
-        
         db.session.commit()
         
         logging.info(f"Driver arrived: {driver.name} for ride {ride.id}")
@@ -327,19 +375,11 @@ def start_ride():
         if not driver:
             return create_error_response("Driver not found")
         
-        # Find arrived ride
-        ride = Ride.query.filter_by(
-            driver_id=driver.id,
-            status='arrived'
-        ).first()
-        
+        # Start the arrived ride
+        ride = apply_transition('start', driver_id=driver.id)
         if not ride:
             return create_error_response("No arrived ride found")
         
-        # Start the ride
-        ride.status = 'started'
-        ride.started_at = get_ist_time()
-        
         db.session.commit()
         
         logging.info(f"Ride started: {ride.id} by driver {driver.name}")
@@ -377,21 +417,16 @@ def complete_ride():
         if not driver:
             return create_error_response("Driver not found")
         
-        # Find started ride
-        ride = Ride.query.filter_by(
-            driver_id=driver.id,
-            status='started'
-        ).first()
-        
+        # Complete the started ride
+        ride = apply_transition('complete', driver_id=driver.id)
         if not ride:
             return create_error_response("No started ride found")
         
-        # Complete the ride
-        ride.status = 'completed'
-        ride.completed_at = get_ist_time()
-        
         db.session.commit()
         
+        # Raw GPS points -> one simplified trail
+        compact_finished_ride(ride.id)
+        
         logging.info(f"Ride completed: {ride.id} by driver {driver.name}")
         return create_success_response({
             'ride_id': ride.id,
@@ -428,24 +463,19 @@ def cancel_ride():
         if not driver:
             return create_error_response("Driver not found")
         
-        # Find cancellable ride
-        ride = Ride.query.filter_by(
-            driver_id=driver.id
-        ).filter(
-            Ride.status.in_(['accepted', 'arrived'])
-        ).first()
-        
+        # Cancel and reset the accepted/arrived ride: it is back in the pending pool
+        ride = apply_transition(
+            'requeue', driver_id=driver.id,
+            event_data=lambda ride: {'broadcast': not nearest_dispatcher.targets(ride)}
+        )
         if not ride:
             return create_error_response("No cancellable ride found")
         
-        # Cancel and reset ride
-        ride.status = 'pending'
-        ride.driver_id = None
-        ride.accepted_at = None
-        ride.arrived_at = None
-        
         db.session.commit()
         
+        nearest_dispatcher.withdraw(ride.id)
+        nearest_dispatcher.dispatch(ride, exclude_driver_ids=[driver.id])
+        
         logging.info(f"Ride cancelled: {ride.id} by driver {driver.name}")
         return create_success_response({
             'ride_id': ride.id,
@@ -457,6 +487,66 @@ def cancel_ride():
         db.session.rollback()
         return create_error_response("Internal server error")
 
+@driver_bp.route('/offers/stream', methods=['GET'])
+def stream_offers():
+    """Server-Sent Events stream of rides becoming available to / taken from an online driver"""
+    try:
+        phone = request.args.get('phone')
+        if not phone:
+            return create_error_response("Phone number is required")
+        
+        # Validate phone number
+        valid, phone_or_error = validate_phone(phone)
+        if not valid:
+            return create_error_response(phone_or_error)
+        
+        phone = phone_or_error
+        
+        # Find driver
+        driver = Driver.query.filter_by(phone=phone).first()
+        if not driver:
+            return create_error_response("Driver not found. Please login first.")
+        
+        if not driver.is_online:
+            return create_error_response("Driver is offline. Go online to receive rides.")
+        
+        # Subscribe before the snapshot so nothing published in between is missed
+        keys = [ride_type_key(driver.car_type), driver_key(driver.id)]
+        subscriber = offer_stream_hub.subscribe(keys[0])
+        offer_stream_hub.subscribe(keys[1], subscriber)
+        try:
+            rides = available_rides_query(driver).order_by(Ride.created_at.desc()).all()
+            # Rides this driver rejected can come back to the pool when another driver cancels
+            rejected = {row[0] for row in db.session.query(RideRejection.ride_id).join(
+                Ride, Ride.id == RideRejection.ride_id
+            ).filter(RideRejection.driver_phone == phone, Ride.status == 'pending').all()}
+            initial_events = [('snapshot', {
+                'rides': [ride.to_dict() for ride in rides],
+                'count': len(rides)
+            })]
+        except Exception:
+            for key in keys:
+                offer_stream_hub.unsubscribe(key, subscriber)
+            raise
+        finally:
+            # The stream itself never touches the database
+            db.session.remove()
+        
+        def accept(event, data):
+            if event == 'ride_removed' and data.get('reason') == 'rejected':
+                rejected.add(data['ride_id'])
+            return not (event == 'ride_added' and data.get('id') in rejected)
+        
+        return Response(
+            offer_stream_hub.stream(keys, subscriber, initial_events, is_final=is_driver_offline, accept=accept),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        logging.error(f"Error opening offers stream: {str(e)}")
+        return create_error_response("Internal server error")
+
 @driver_bp.route('/current_ride', methods=['GET'])
 def current_ride():
     """Get current ride for driver"""
@@ -549,6 +639,8 @@ def update_status():
         
         # Update driver status
         driver.is_online = is_online
+        if not is_online:
+            nearest_dispatcher.driver_offline(driver.id)
         db.session.commit()
         
         status_text = "online" if is_online else "offline"
@@ -598,6 +690,60 @@ def get_status():
         return create_error_response("Internal server error")
 
 
+@driver_bp.route('/position', methods=['POST'])
+def update_position():
+    """Report an idle driver's position for nearest-driver dispatch"""
+    try:
+        data = request.get_json()
+        if not data:
+            return create_error_response("Invalid JSON data")
+        
+        # Validate required fields
+        valid, error = validate_required_fields(data, ['driver_phone', 'latitude', 'longitude'])
+        if not valid:
+            return create_error_response(error)
+        
+        # Validate phone number
+        valid, phone_or_error = validate_phone(data['driver_phone'])
+        if not valid:
+            return create_error_response(phone_or_error)
+        
+        phone = phone_or_error
+        
+        try:
+            latitude = float(data['latitude'])
+            longitude = float(data['longitude'])
+        except (ValueError, TypeError):
+            return create_error_response("Invalid latitude or longitude format")
+        
+        # Validate coordinates
+        if not (-90 <= latitude <= 90):
+            return create_error_response("Invalid latitude. Must be between -90 and 90")
+        if not (-180 <= longitude <= 180):
+            return create_error_response("Invalid longitude. Must be between -180 and 180")
+        
+        # Find driver
+        driver = Driver.query.filter_by(phone=phone).first()
+        if not driver:
+            return create_error_response("Driver not found")
+        
+        if not driver.is_online:
+            return create_error_response("Driver is offline")
+        
+        nearest_dispatcher.record_position(driver, latitude, longitude)
+        
+        return create_success_response({
+            'driver_id': driver.id,
+            'latitude': latitude,
+            'longitude': longitude
+        }, "Position updated")
+    
+    except Exception as e:
+        logging.error(f"Error updating driver position: {str(e)}")
+        db.session.rollback()
+        return create_error_response("Internal server error")
+
+
 @driver_bp.route('/update_location', methods=['POST'])
 def update_location():
     """Update driver's GPS location for active ride"""
@@ -646,18 +792,9 @@ def update_location():
         if ride.status not in ['accepted', 'arrived', 'started']:
             return create_error_response("Can only update location for active rides")
         
-        # Mark all previous locations as not latest for this ride
-        RideLocation.query.filter_by(ride_id=ride_id).update({'is_latest': False})
-        
-        # Create new location entry
-        new_location = RideLocation(
-            ride_id=ride_id,
-            latitude=latitude,
-            longitude=longitude,
-            is_latest=True
-        )
-        
-        db.session.add(new_location)
+        # Append to history and overwrite the ride's latest position
+        new_location = record_location(ride.id, latitude, longitude)
+        publish_location_event(ride.id, new_location.latitude, new_location.longitude, new_location.timestamp)
         db.session.commit()
         
         logging.info(f"GPS location updated for ride {ride_id}: {latitude}, {longitude}")
@@ -673,3 +810,73 @@ def update_location():
         logging.error(f"Error updating location: {str(e)}")
         db.session.rollback()
         return create_error_response("Internal server error")
+
+
+@driver_bp.route('/update_locations', methods=['POST'])
+def update_locations():
+    """Upload a batch of buffered GPS points for an active ride"""
+    try:
+        data = request.get_json()
+        if not data:
+            return create_error_response("Invalid JSON data")
+        
+        # Validate required fields
+        valid, error = validate_required_fields(data, ['driver_phone', 'ride_id', 'points'])
+        if not valid:
+            return create_error_response(error)
+        
+        points = data['points']
+        if not isinstance(points, list) or not points:
+            return create_error_response("points must be a non-empty list of {lat, lng, ts}")
+        if len(points) > GPS_BATCH_MAX_POINTS:
+            return create_error_response(f"Too many points. Maximum is {GPS_BATCH_MAX_POINTS} per request")
+        
+        # Validate phone number
+        valid, phone_or_error = validate_phone(data['driver_phone'])
+        if not valid:
+            return create_error_response(phone_or_error)
+        
+        phone = phone_or_error
+        ride_id = data['ride_id']
+        
+        # Find driver
+        driver = Driver.query.filter_by(phone=phone).first()
+        if not driver:
+            return create_error_response("Driver not found")
+        
+        # Verify ride exists and belongs to this driver
+        ride = Ride.query.filter_by(id=ride_id, driver_id=driver.id).first()
+        if not ride:
+            return create_error_response("Ride not found or not assigned to you")
+        
+        # Only allow location updates for active rides
+        if ride.status not in ['accepted', 'arrived', 'started']:
+            return create_error_response("Can only update location for active rides")
+        
+        latitudes, longitudes, timestamps, rejected = parse_points(points)
+        if len(latitudes) == 0:
+            return create_error_response("No valid points in batch")
+        
+        # One bulk INSERT, one latest-position upsert, one commit
+        (latitude, longitude, timestamp), stored, queued = record_locations(ride.id, latitudes, longitudes, timestamps)
+        publish_location_event(ride.id, latitude, longitude, timestamp)
+        db.session.commit()
+        
+        logging.info(f"GPS batch for ride {ride.id}: {len(latitudes)} points accepted, {stored} stored, "
+                     f"{queued} queued, {rejected} rejected")
+        
+        return create_success_response({
+            'ride_id': ride.id,
+            'accepted': len(latitudes),
+            'stored': stored,
+            'queued': queued,
+            'rejected': rejected,
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': timestamp.isoformat()
+        }, "Locations updated successfully")
+    
+    except Exception as e:
+        logging.error(f"Error updating locations: {str(e)}")
+        db.session.rollback()
+        return create_error_response("Internal server error")
@@ -1,12 +1,33 @@
 from flask import Blueprint, request, jsonify
 from models import db, Driver, Customer, Ride
 from utils.validators import validate_phone, create_error_response, create_success_response
+from utils.trails import get_trail
+from utils.projections import Projection
+from utils.pagination import validate_cursor, completed_rides_page
 from sqlalchemy import func, extract
 from datetime import datetime, timedelta
 import logging
 
 mobile_bp = Blueprint('mobile', __name__)
 
+# Columns the history endpoints return, read without building Ride objects
+DRIVER_HISTORY = Projection(
+    'DriverHistoryRow',
+    ride_id=Ride.id, customer_phone=Ride.customer_phone, pickup_address=Ride.pickup_address,
+    drop_address=Ride.drop_address, fare=Ride.fare_amount, distance_km=Ride.distance_km,
+    completed_at=Ride.completed_at
+)
+CUSTOMER_HISTORY = Projection(
+    'CustomerHistoryRow',
+    ride_id=Ride.id, pickup_address=Ride.pickup_address, drop_address=Ride.drop_address, status=Ride.status,
+    fare=Ride.fare_amount, distance_km=Ride.distance_km, completed_at=Ride.completed_at,
+    # Looked up only for the rows returned, unlike a join evaluated for every row OFFSET skips
+    driver_name=db.select(Driver.name).where(Driver.id == Ride.driver_id).scalar_subquery()
+)
+# Offset pages in the cursor pages' order (completed_rides_page): rides without completed_at come
+# last on every database, instead of first on Postgres where NULLs sort high
+HISTORY_ORDER = (Ride.completed_at.desc().nulls_last(), Ride.id.desc())
+
 # DRIVER ENDPOINTS
 
 @mobile_bp.route('/driver/profile', methods=['GET'])
@@ -56,13 +77,21 @@ def driver_history():
         if not username:
             return create_error_response("Username is required", 400)
         
-        # Get pagination parameters
+        # Get pagination parameters (cursor mode when cursor is given, empty for the first page)
+        cursor = request.args.get('cursor')
         offset = int(request.args.get('offset', 0))
         limit = int(request.args.get('limit', 20))
         
         # Validate pagination parameters
         if offset < 0 or limit < 1 or limit > 100:
             return create_error_response("Invalid pagination parameters", 400)
+        if cursor is not None and 'offset' in request.args:
+            return create_error_response("Use either cursor or offset", 400)
+        after = None
+        if cursor:
+            valid, after = validate_cursor(cursor)
+            if not valid:
+                return create_error_response(after, 400)
         
         # Find driver by username
         driver = Driver.query.filter_by(username=username).first()
@@ -70,31 +99,33 @@ def driver_history():
             return create_error_response("Driver not found", 404)
         
         # Get completed rides for this driver
-        rides = Ride.query.filter_by(
-            driver_id=driver.id,
-            status='completed'
-        ).order_by(Ride.completed_at.desc()).offset(offset).limit(limit).all()
+        statement = DRIVER_HISTORY.select().where(
+            Ride.driver_id == driver.id,
+            Ride.status == 'completed'
+        )
+        if cursor is not None:
+            rides, next_cursor = completed_rides_page(DRIVER_HISTORY, statement, limit, after)
+        else:
+            rides = DRIVER_HISTORY.all(statement.order_by(*HISTORY_ORDER).offset(offset).limit(limit))
         
         # Format ride data
         ride_history = []
         for ride in rides:
-            ride_data = {
-                'ride_id': ride.id,
-                'customer_phone': ride.customer_phone,
-                'pickup_address': ride.pickup_address,
-                'drop_address': ride.drop_address,
-                'fare': ride.fare_amount,
-                'distance_km': ride.distance_km,
-                'completed_at': ride.completed_at.isoformat() if ride.completed_at else None
-            }
+            ride_data = ride._asdict()
+            ride_data['completed_at'] = ride.completed_at.isoformat() if ride.completed_at else None
             ride_history.append(ride_data)
         
-        return create_success_response({
+        history_data = {
             'rides': ride_history,
-            'offset': offset,
             'limit': limit,
             'count': len(ride_history)
-        }, "Driver history retrieved successfully")
+        }
+        if cursor is not None:
+            history_data['next_cursor'] = next_cursor
+        else:
+            history_data['offset'] = offset
+        
+        return create_success_response(history_data, "Driver history retrieved successfully")
     
     except Exception as e:
         logging.error(f"Error retrieving driver history: {str(e)}")
@@ -199,13 +230,21 @@ def customer_history():
         if not validate_phone(phone):
             return create_error_response("Invalid phone number format", 400)
         
-        # Get pagination parameters
+        # Get pagination parameters (cursor mode when cursor is given, empty for the first page)
+        cursor = request.args.get('cursor')
         offset = int(request.args.get('offset', 0))
         limit = int(request.args.get('limit', 20))
         
         # Validate pagination parameters
         if offset < 0 or limit < 1 or limit > 100:
             return create_error_response("Invalid pagination parameters", 400)
+        if cursor is not None and 'offset' in request.args:
+            return create_error_response("Use either cursor or offset", 400)
+        after = None
+        if cursor:
+            valid, after = validate_cursor(cursor)
+            if not valid:
+                return create_error_response(after, 400)
         
         # Find customer by phone
         customer = Customer.query.filter_by(phone=phone).first()
@@ -213,33 +252,32 @@ def customer_history():
             return create_error_response("Customer not found", 404)
         
         # Get rides for this customer with driver details
-        rides = db.session.query(Ride).join(
-            Driver, Ride.driver_id == Driver.id, isouter=True
-        ).filter(
+        statement = CUSTOMER_HISTORY.select().where(
             Ride.customer_phone == phone
-        ).order_by(Ride.completed_at.desc()).offset(offset).limit(limit).all()
+        )
+        if cursor is not None:
+            rides, next_cursor = completed_rides_page(CUSTOMER_HISTORY, statement, limit, after)
+        else:
+            rides = CUSTOMER_HISTORY.all(statement.order_by(*HISTORY_ORDER).offset(offset).limit(limit))
         
         # Format ride data
         ride_history = []
         for ride in rides:
-            ride_data = {
-                'ride_id': ride.id,
-                'pickup_address': ride.pickup_address,
-                'drop_address': ride.drop_address,
-                'status': ride.status,
-                'fare': ride.fare_amount,
-                'distance_km': ride.distance_km,
-                'completed_at': ride.completed_at.isoformat() if ride.completed_at else None,
-                'driver_name': ride.driver.name if ride.driver else None
-            }
+            ride_data = ride._asdict()
+            ride_data['completed_at'] = ride.completed_at.isoformat() if ride.completed_at else None
             ride_history.append(ride_data)
         
-        return create_success_response({
+        history_data = {
             'rides': ride_history,
-            'offset': offset,
             'limit': limit,
             'count': len(ride_history)
-        }, "Customer history retrieved successfully")
+        }
+        if cursor is not None:
+            history_data['next_cursor'] = next_cursor
+        else:
+            history_data['offset'] = offset
+        
+        return create_success_response(history_data, "Customer history retrieved successfully")
     
     except Exception as e:
         logging.error(f"Error retrieving customer history: {str(e)}")
@@ -302,4 +340,33 @@ def customer_total_spent():
     
     except Exception as e:
         logging.error(f"Error retrieving customer spending: {str(e)}")
-        return create_error_response("Internal server error", 500)
\ No newline at end of file
+        return create_error_response("Internal server error", 500)
+
+# RIDE ENDPOINTS
+
+@mobile_bp.route('/ride/<int:ride_id>/trail', methods=['GET'])
+def ride_trail(ride_id):
+    """Get the GPS trail of a ride for history views"""
+    try:
+        ride = db.session.get(Ride, ride_id)
+        if not ride:
+            return create_error_response("Ride not found", 404)
+        
+        trail = get_trail(ride_id)
+        if trail is None:
+            return create_error_response("No GPS trail for this ride", 404)
+        
+        polyline, points, compacted = trail
+        
+        return create_success_response({
+            'ride_id': ride_id,
+            'status': ride.status,
+            'polyline': polyline,
+            'points': [[lat, lng] for lat, lng in points],
+            'point_count': len(points),
+            'compacted': compacted
+        }, "Ride trail retrieved successfully")
+    
+    except Exception as e:
+        logging.error(f"Error retrieving ride trail: {str(e)}")
+        return create_error_response("Internal server error", 500)
@@ -2,6 +2,10 @@
 """
 Test script for GPS tracking system
 Tests the complete flow of location updates and retrieval
+
+Booking needs Distance Matrix answers. To run without the real Google API,
+start the stand-in (python -m utils.maps_stub --port 8765) and run the backend with
+GOOGLE_MAPS_BASE_URL=http://localhost:8765/maps/api/distancematrix/json GOOGLE_MAPS_API_KEY=stub
 """
 
 import requests
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Query-count check for the endpoints that list rides
+Runs the app in-process on a throwaway SQLite database, calls each endpoint with a few rides and
+again with many more, and fails if the number of SQL statements grows with the number of rides
+(a relationship lazy-loaded per ride instead of loaded with the list).
+
+Run:
+    python test_query_counts.py
+"""
+
+import os
+import sys
+import tempfile
+import logging
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_query_counts.db")
+
+from sqlalchemy import event
+from app import app, db
+from models import Customer, Driver, Ride
+from utils.stats import dashboard_stats
+
+DRIVER_PHONE = "8000000000"
+
+ENDPOINTS = [
+    ("GET /driver/incoming_rides", f"/driver/incoming_rides?phone={DRIVER_PHONE}"),
+    ("GET /admin/api/recent_rides", "/admin/api/recent_rides"),
+    ("GET /admin/rides", "/admin/rides"),
+    ("GET /admin/dashboard", "/admin/dashboard"),
+    ("GET /admin/customers", "/admin/customers"),
+]
+
+
+def add_rides(count, start):
+    """count rides, each booked by its own customer; every other one accepted by its own driver"""
+    for index in range(start, start + count):
+        customer = Customer(name=f"Customer {index}", phone=f"9{index:09d}")
+        db.session.add(customer)
+        db.session.flush()
+        ride = Ride(
+            customer_id=customer.id, customer_phone=customer.phone,
+            pickup_address="Pickup", drop_address="Drop",
+            ride_type="sedan", fare_amount=100.0, status="pending"
+        )
+        if index % 2:
+            driver = Driver(name=f"Driver {index}", phone=f"7{index:09d}", username=f"QC{index}",
+                            car_type="sedan", is_online=False)
+            db.session.add(driver)
+            db.session.flush()
+            ride.driver_id = driver.id
+            ride.status = "accepted"
+        db.session.add(ride)
+    db.session.commit()
+
+
+def count_queries(client, url):
+    """Number of SQL statements issued while serving url"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    
+    with app.app_context():
+        dashboard_stats.invalidate()
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200, f"{url} returned {response.status_code}"
+    return len(statements)
+
+
+def test_list_endpoints_query_count():
+    """Each endpoint issues the same number of statements for 4 rides as for 20"""
+    with app.app_context():
+        db.session.add(Driver(name="Query Count Driver", phone=DRIVER_PHONE, username="QCDRIVER",
+                              car_type="sedan", is_online=True))
+        db.session.commit()
+        add_rides(4, 0)
+    
+    client = app.test_client()
+    client.post("/admin/login", data={"username": "admin", "password": "admin123"})
+    
+    few = {name: count_queries(client, url) for name, url in ENDPOINTS}
+    with app.app_context():
+        add_rides(16, 4)
+    many = {name: count_queries(client, url) for name, url in ENDPOINTS}
+    
+    failed = []
+    for name, _ in ENDPOINTS:
+        grows = many[name] != few[name]
+        print(f"{'❌' if grows else '✅'} {name}: {few[name]} queries with 4 rides, {many[name]} with 20")
+        if grows:
+            failed.append(name)
+    assert not failed, f"Query count grows with the number of rides: {', '.join(failed)}"
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    print("🔎 Query Count Check")
+    print("=" * 50)
+    try:
+        test_list_endpoints_query_count()
+    except AssertionError as e:
+        print(f"\n❌ {e}")
+        sys.exit(1)
+    print("\n🎉 No endpoint issues more statements as rows are added")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Trail compaction check
+Simplifies synthetic GPS trails (straight, out-and-back, loop) and compacts a ride whose late points
+arrive after its trail was stored, on a throwaway SQLite database, and fails if a leg of the route
+is dropped or the merged trail is out of time order.
+
+Run:
+    python test_trails.py
+"""
+
+import os
+import sys
+import tempfile
+import logging
+from datetime import timedelta
+import numpy as np
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_trails.db")
+
+from app import app, db, get_ist_time
+from models import Customer, Ride, RideLocation
+from utils.trails import simplify_trail, compact_ride_trail, decode_polyline
+
+# ~1.1m per 0.00001 degree of latitude
+START_LAT, START_LNG = 12.9716, 77.5946
+
+
+def leg(from_offset, to_offset, points):
+    """points evenly spaced due north, offsets in degrees of latitude from START_LAT"""
+    return [(START_LAT + offset, START_LNG) for offset in np.linspace(from_offset, to_offset, points)]
+
+
+def kept_points(points):
+    latitudes, longitudes = zip(*points)
+    keep = simplify_trail(latitudes, longitudes, tolerance_meters=5)
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def test_straight_trail_keeps_ends():
+    assert len(kept_points(leg(0, 0.01, 20))) == 2
+
+
+def test_out_and_back_trail_keeps_turnaround():
+    """~1km out and back along the same road: the far end lies on the start-end line but not on the chord"""
+    points = leg(0, 0.009, 20) + leg(0.009, 0.0005, 19)[1:]
+    kept = kept_points(points)
+    assert (START_LAT + 0.009, START_LNG) in kept, kept
+    assert len(kept) == 3, kept
+
+
+def test_loop_trail_keeps_corners():
+    """Square loop back to the start: every corner is kept"""
+    side = 0.005
+    corners = [(0, 0), (side, 0), (side, side), (0, side), (0, 0)]
+    points = []
+    for (lat0, lng0), (lat1, lng1) in zip(corners, corners[1:]):
+        for fraction in np.linspace(0, 1, 10)[:-1]:
+            points.append((START_LAT + lat0 + (lat1 - lat0) * fraction, START_LNG + lng0 + (lng1 - lng0) * fraction))
+    points.append((START_LAT, START_LNG))
+    kept = kept_points(points)
+    for lat, lng in corners:
+        assert any(abs(k[0] - START_LAT - lat) < 1e-9 and abs(k[1] - START_LNG - lng) < 1e-9 for k in kept), (lat, lng, kept)
+
+
+def test_late_points_merge_in_time_order():
+    """Points reported late for the middle of a ride land in the middle of its trail"""
+    # Recent, so that ride_location retention leaves the raw points alone
+    started_at = get_ist_time().replace(tzinfo=None, microsecond=0) - timedelta(hours=1)
+    with app.app_context():
+        customer = Customer(name="Trail Customer", phone="9111111111")
+        db.session.add(customer)
+        db.session.flush()
+        ride = Ride(customer_id=customer.id, customer_phone=customer.phone, pickup_address="Pickup",
+                    drop_address="Drop", ride_type="sedan", fare_amount=100.0, status="completed",
+                    created_at=started_at, completed_at=started_at + timedelta(minutes=20))
+        db.session.add(ride)
+        db.session.flush()
+        
+        # Straight north for 20 minutes, compacted to its two ends
+        for minute, (lat, lng) in enumerate(leg(0, 0.02, 21)):
+            db.session.add(RideLocation(ride_id=ride.id, latitude=lat, longitude=lng,
+                                        timestamp=started_at + timedelta(minutes=minute)))
+        db.session.commit()
+        assert compact_ride_trail(ride.id).point_count == 2
+        
+        # A detour ~100m east at minute 10, uploaded after the compaction
+        detour = (START_LAT + 0.01, START_LNG + 0.001)
+        db.session.add(RideLocation(ride_id=ride.id, latitude=detour[0], longitude=detour[1],
+                                    timestamp=started_at + timedelta(minutes=10)))
+        db.session.commit()
+        trail = compact_ride_trail(ride.id)
+        
+        points = decode_polyline(trail.polyline)
+        assert len(points) == 3, points
+        assert abs(points[1][0] - detour[0]) < 1e-5 and abs(points[1][1] - detour[1]) < 1e-5, points
+        assert points[0][0] < points[1][0] < points[2][0], points
+        assert trail.raw_point_count == 22
+        assert trail.started_at == started_at and trail.ended_at == started_at + timedelta(minutes=20)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    print("🗺️  Trail Compaction Check")
+    print("=" * 50)
+    failed = False
+    for name, test in [(name, test) for name, test in globals().items() if name.startswith("test_")]:
+        try:
+            test()
+            print(f"✅ {name}")
+        except AssertionError as e:
+            print(f"❌ {name}: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
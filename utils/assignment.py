@@ -0,0 +1,170 @@
+import numpy as np
+from utils.estimator import EARTH_RADIUS_KM
+
+
+def pairwise_distance_km(origins, destinations):
+    """
+    Haversine distance matrix between two sets of points
+    origins: (n, 2) array of lat/lng, destinations: (m, 2) array of lat/lng
+    Returns: (n, m) array of kilometers
+    """
+    origins = np.radians(np.asarray(origins, dtype=float).reshape(-1, 2))
+    destinations = np.radians(np.asarray(destinations, dtype=float).reshape(-1, 2))
+    lat1 = origins[:, 0][:, None]
+    lng1 = origins[:, 1][:, None]
+    lat2 = destinations[:, 0][None, :]
+    lng2 = destinations[:, 1][None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def independent_groups(feasible):
+    """
+    Split a bipartite feasibility matrix into connected components: groups of rows and columns
+    with no feasible pair between different groups, so each can be matched on its own
+    Rows and columns without any feasible pair are left out
+    Returns: list of (row indices, column indices) arrays
+    """
+    n_rows, n_cols = feasible.shape
+    unassigned = feasible.any(axis=1)
+    groups = []
+    while unassigned.any():
+        rows = np.zeros(n_rows, dtype=bool)
+        rows[np.flatnonzero(unassigned)[0]] = True
+        cols = np.zeros(n_cols, dtype=bool)
+        while True:
+            new_cols = feasible[rows].any(axis=0) & ~cols
+            if not new_cols.any():
+                break
+            cols |= new_cols
+            new_rows = feasible[:, new_cols].any(axis=1) & ~rows
+            if not new_rows.any():
+                break
+            rows |= new_rows
+        unassigned &= ~rows
+        groups.append((np.flatnonzero(rows), np.flatnonzero(cols)))
+    return groups
+
+
+def solve_assignment(cost, max_cost=None):
+    """
+    Minimum total cost matching between rows (rides) and columns (drivers)
+    
+    The feasible pairs are first split into independent groups (independent_groups), which
+    are solved one by one: a window spread over a city rarely needs one large matrix.
+    Rectangular matrices are fine: the most pairs possible are matched, at the least cost.
+    Entries that are not finite or exceed max_cost are never matched.
+    Returns: list of (row, col) pairs
+    """
+    cost = np.array(cost, dtype=float)
+    if cost.ndim != 2 or cost.size == 0:
+        return []
+    
+    feasible = np.isfinite(cost)
+    if max_cost is not None:
+        feasible &= cost <= max_cost
+    
+    pairs = []
+    for rows, cols in independent_groups(feasible):
+        group = np.ix_(rows, cols)
+        pairs.extend((rows[row], cols[col]) for row, col in _solve_group(cost[group], feasible[group]))
+    pairs = [(int(row), int(col)) for row, col in pairs]
+    pairs.sort()
+    return pairs
+
+
+def _solve_group(cost, feasible):
+    """
+    Shortest augmenting path Hungarian algorithm with potentials, O(n^2 m) with the inner
+    loop over columns vectorized. Every row is matched when there are at least as many
+    columns, otherwise every column is; infeasible pairs are dropped from the result.
+    Returns: list of (row, col) pairs
+    """
+    # Infeasible pairs get a cost larger than any complete feasible matching, then are dropped
+    penalty = (np.abs(cost[feasible]).max() + 1.0) * (min(cost.shape) + 1)
+    cost = np.where(feasible, cost, penalty)
+    
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+        feasible = feasible.T
+    n_rows, n_cols = cost.shape
+    
+    # Warm start: row reduction, then each row takes its cheapest column if still free. Reduced
+    # costs stay >= 0 and v stays 0, so only the rows left over need an augmenting path
+    u = cost.min(axis=1)
+    v = np.zeros(n_cols)
+    row_of_col = np.full(n_cols, -1, dtype=np.int64)
+    col_of_row = np.full(n_rows, -1, dtype=np.int64)
+    for row, col in enumerate(cost.argmin(axis=1)):
+        if row_of_col[col] < 0:
+            row_of_col[col] = row
+            col_of_row[row] = col
+    
+    for start in np.flatnonzero(col_of_row < 0):
+        # Dijkstra over columns on reduced costs; potentials are updated once the path is found
+        path_cost = np.full(n_cols, np.inf)
+        previous_row = np.full(n_cols, -1, dtype=np.int64)
+        remaining = np.ones(n_cols, dtype=bool)
+        visited_rows = [start]
+        visited_cols = []
+        shortest = 0.0
+        row = start
+        while True:
+            reduced = shortest + cost[row] - u[row] - v
+            improved = remaining & (reduced < path_cost)
+            path_cost[improved] = reduced[improved]
+            previous_row[improved] = row
+            
+            col = int(np.argmin(np.where(remaining, path_cost, np.inf)))
+            shortest = path_cost[col]
+            remaining[col] = False
+            visited_cols.append(col)
+            if row_of_col[col] < 0:
+                break
+            row = row_of_col[col]
+            visited_rows.append(row)
+        
+        u[start] += shortest
+        others = np.array(visited_rows[1:], dtype=np.int64)
+        u[others] += shortest - path_cost[col_of_row[others]]
+        cols = np.array(visited_cols, dtype=np.int64)
+        v[cols] -= shortest - path_cost[cols]
+        
+        # Flip the augmenting path back to the start row
+        while True:
+            row = previous_row[col]
+            row_of_col[col] = row
+            col, col_of_row[row] = col_of_row[row], col
+            if row == start:
+                break
+    
+    pairs = []
+    for col in range(n_cols):
+        row = row_of_col[col]
+        if row < 0 or not feasible[row, col]:
+            continue
+        pairs.append((col, row) if transposed else (row, col))
+    return pairs
+
+
+def greedy_assignment(cost, max_cost=None):
+    """
+    First-come matching for comparison: rows in order, each takes the cheapest free column
+    Returns: list of (row, col) pairs
+    """
+    cost = np.array(cost, dtype=float)
+    if cost.ndim != 2 or cost.size == 0:
+        return []
+    
+    taken = np.zeros(cost.shape[1], dtype=bool)
+    pairs = []
+    for row in range(cost.shape[0]):
+        candidates = np.where(taken, np.inf, cost[row])
+        col = int(np.argmin(candidates))
+        best = candidates[col]
+        if not np.isfinite(best) or (max_cost is not None and best > max_cost):
+            continue
+        taken[col] = True
+        pairs.append((row, col))
+    return pairs
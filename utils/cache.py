@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCacheBackend:
+    """In-process LRU store with per-entry expiry (one per gunicorn worker)"""
+    
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return cached value or None if missing/expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds, evicting least recently used entries when full"""
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """File-backed LRU store shared by all worker processes on the same host"""
+    
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_last_used ON cache_entry (last_used)")
+        conn.commit()
+    
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key):
+        """Return cached value or None if missing/expired"""
+        try:
+            conn = self._connection()
+            now = time.time()
+            row = conn.execute(
+                "SELECT value FROM cache_entry WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE cache_entry SET last_used = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            logging.error(f"Cache read failed: {str(e)}")
+            return None
+    
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds, trimming least recently used entries periodically"""
+        try:
+            conn = self._connection()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entry (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now)
+            )
+            
+            # Trim every 100 writes rather than on every insert
+            self._writes += 1
+            if self._writes % 100 == 0:
+                conn.execute("DELETE FROM cache_entry WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM cache_entry WHERE key IN ("
+                    "SELECT key FROM cache_entry ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Cache write failed: {str(e)}")
+    
+    def delete(self, key):
+        try:
+            self._connection().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logging.error(f"Cache delete failed: {str(e)}")
+    
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM cache_entry")
+        except sqlite3.Error as e:
+            logging.error(f"Cache clear failed: {str(e)}")
+    
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0]
+
+
+class TTLCache:
+    """Cache front-end with hit/miss accounting over a pluggable backend"""
+    
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, self.ttl if ttl is None else ttl)
+    
+    def delete(self, key):
+        self.backend.delete(key)
+    
+    def clear(self):
+        self.backend.clear()
+    
+    def stats(self):
+        """Hit/miss counters for this worker"""
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'ttl_seconds': self.ttl
+        }
+
+
+def create_cache(prefix, default_ttl, default_max_entries=10000):
+    """
+    Build a cache configured from <PREFIX>_CACHE_* environment variables
+    <PREFIX>_CACHE_BACKEND: memory (default), sqlite (shared across workers) or none
+    Returns: TTLCache, or None when caching is disabled
+    """
+    backend_name = os.environ.get(f"{prefix}_CACHE_BACKEND", "memory").lower()
+    ttl = float(os.environ.get(f"{prefix}_CACHE_TTL", default_ttl))
+    max_entries = int(os.environ.get(f"{prefix}_CACHE_MAX_ENTRIES", default_max_entries))
+    
+    if backend_name == 'none':
+        return None
+    
+    if backend_name == 'sqlite':
+        path = os.environ.get(f"{prefix}_CACHE_PATH", f"/tmp/taxibook_{prefix.lower()}_cache.db")
+        try:
+            return TTLCache(SQLiteCacheBackend(path, max_entries), ttl)
+        except sqlite3.Error as e:
+            logging.error(f"Shared cache unavailable at {path}, using in-process cache: {str(e)}")
+    
+    return TTLCache(MemoryCacheBackend(max_entries), ttl)
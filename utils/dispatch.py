@@ -0,0 +1,601 @@
+import os
+import threading
+import time
+import logging
+from datetime import timedelta
+import numpy as np
+from sqlalchemy import select, exists, or_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from utils.geo_index import GridIndex
+from utils.assignment import pairwise_distance_km, solve_assignment
+from utils.events import event_bus
+from utils.ride_state import apply_transition
+
+# broadcast: every online driver of the ride type sees every pending ride (original behaviour)
+# nearest: each ride is offered to the DISPATCH_TOP_K nearest idle drivers only
+# batch: every DISPATCH_BATCH_WINDOW_SECONDS pending rides are matched to idle drivers with a
+#        min-cost assignment on pickup distance; first-come acceptance keeps working alongside
+DISPATCH_MODE = os.environ.get("DISPATCH_MODE", "broadcast").lower()
+DISPATCH_TOP_K = int(os.environ.get("DISPATCH_TOP_K", 3))
+DISPATCH_RADIUS_KM = float(os.environ.get("DISPATCH_RADIUS_KM", 5))
+DISPATCH_OFFER_SECONDS = float(os.environ.get("DISPATCH_OFFER_SECONDS", 30))
+# How often a worker re-offers rides whose offers all expired or were declined
+DISPATCH_SWEEP_SECONDS = float(os.environ.get("DISPATCH_SWEEP_SECONDS", 5))
+DISPATCH_BATCH_WINDOW_SECONDS = float(os.environ.get("DISPATCH_BATCH_WINDOW_SECONDS", 2))
+DISPATCH_BATCH_MAX_RIDES = int(os.environ.get("DISPATCH_BATCH_MAX_RIDES", 1000))
+
+# Drivers that stop reporting drop out of dispatch after this long
+DRIVER_POSITION_MAX_AGE_SECONDS = float(os.environ.get("DRIVER_POSITION_MAX_AGE_SECONDS", 120))
+# Each worker keeps its own copy, refreshed from the driver_position table
+DRIVER_INDEX_REFRESH_SECONDS = float(os.environ.get("DRIVER_INDEX_REFRESH_SECONDS", 10))
+
+ACTIVE_RIDE_STATUSES = ('accepted', 'arrived', 'started')
+
+# Expired offers are kept for a while so the next round goes to different drivers
+OFFER_HISTORY_SECONDS = 3600
+
+# Postgres advisory lock so only one worker runs each batch window
+BATCH_DISPATCH_LOCK_ID = 720801
+
+
+def _age_seconds(timestamp, now):
+    """Seconds between a stored timestamp and now (naive columns read back without tzinfo)"""
+    if timestamp.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return (now - timestamp).total_seconds()
+
+
+def accept_pending_ride(ride_id, driver_id, accepted_at, offered_only=False):
+    """
+    Assign a ride to a driver with the accept transition (no commit): one conditional UPDATE that
+    also requires the driver to have no active ride. Of any number of concurrent callers exactly one
+    gets the row. Two accepts by the same driver for different rides can both pass the NOT EXISTS
+    check on PostgreSQL; the uq_ride_driver_active index then fails the second with an IntegrityError.
+    offered_only: rides with pickup coordinates also need an offer to this driver (nearest mode)
+    Returns: the accepted Ride (ride.accepted event published), or None if this call lost
+    """
+    from models import Ride, RideOffer
+    
+    active_ride = aliased(Ride)
+    conditions = [
+        ~exists().where(
+            active_ride.driver_id == driver_id,
+            active_ride.status.in_(ACTIVE_RIDE_STATUSES)
+        )
+    ]
+    if offered_only:
+        # An offer that expired while the driver was tapping accept still counts
+        conditions.append(or_(
+            Ride.pickup_lat.is_(None),
+            Ride.pickup_lng.is_(None),
+            exists().where(RideOffer.ride_id == Ride.id, RideOffer.driver_id == driver_id)
+        ))
+    
+    return apply_transition(
+        'accept', ride_id=ride_id, conditions=conditions, values={'driver_id': driver_id}, now=accepted_at
+    )
+
+
+class DriverPositionIndex:
+    """Last reported positions of online drivers keyed by grid cell, partitioned by car_type"""
+    
+    def __init__(self, cell_size_deg=0.01, max_age_seconds=DRIVER_POSITION_MAX_AGE_SECONDS,
+                 refresh_seconds=DRIVER_INDEX_REFRESH_SECONDS):
+        self.grid = GridIndex(cell_size_deg)
+        self.max_age_seconds = max_age_seconds
+        self.refresh_seconds = refresh_seconds
+        self.loaded_at = None
+        self._reported_at = {}  # driver_id -> time.time() of the last report
+        self._lock = threading.Lock()
+    
+    def update(self, driver_id, car_type, lat, lng, reported_at=None):
+        if not car_type:
+            self.remove(driver_id)
+            return
+        with self._lock:
+            self.grid.upsert(car_type, driver_id, lat, lng)
+            self._reported_at[driver_id] = reported_at or time.time()
+    
+    def remove(self, driver_id):
+        with self._lock:
+            self.grid.remove(driver_id)
+            self._reported_at.pop(driver_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self.grid.clear()
+            self._reported_at.clear()
+    
+    def load(self):
+        """Rebuild from the database (requires app context)"""
+        from app import db, get_ist_time
+        from models import Driver, DriverPosition
+        
+        now = get_ist_time()
+        rows = db.session.query(
+            DriverPosition.driver_id, Driver.car_type, DriverPosition.latitude,
+            DriverPosition.longitude, DriverPosition.updated_at
+        ).join(Driver, Driver.id == DriverPosition.driver_id).filter(
+            Driver.is_online.is_(True),
+            Driver.car_type.isnot(None),
+            DriverPosition.updated_at >= now - timedelta(seconds=self.max_age_seconds)
+        ).all()
+        
+        with self._lock:
+            self.grid.clear()
+            self._reported_at.clear()
+            for driver_id, car_type, lat, lng, updated_at in rows:
+                self.grid.upsert(car_type, driver_id, lat, lng)
+                self._reported_at[driver_id] = time.time() - _age_seconds(updated_at, now)
+            self.loaded_at = time.time()
+        
+        logging.debug(f"Driver position index loaded with {len(rows)} drivers")
+    
+    def ensure_fresh(self):
+        if self.loaded_at is None or time.time() - self.loaded_at >= self.refresh_seconds:
+            self.load()
+    
+    def nearby(self, car_type, lat, lng, radius_km, limit=None):
+        """
+        Drivers of a car_type with a recent position within radius_km, nearest first
+        Returns: list of (distance_km, driver_id)
+        """
+        self.ensure_fresh()
+        cutoff = time.time() - self.max_age_seconds
+        with self._lock:
+            results = [
+                (distance_km, driver_id)
+                for distance_km, driver_id in self.grid.nearby(car_type, lat, lng, radius_km)
+                if self._reported_at.get(driver_id, 0) >= cutoff
+            ]
+        if limit is not None:
+            results = results[:limit]
+        return results
+    
+    def __len__(self):
+        return len(self.grid)
+
+
+class NearestDriverDispatcher:
+    """
+    Offers each pending ride to the top-K nearest eligible drivers (online, matching car_type,
+    no active ride, not rejected). Offers live in the ride_offer table so every worker sees them;
+    declined or expired rounds move on to the next nearest drivers.
+    
+    record_position/driver_offline raise like any other route code. The other hooks run after
+    the route has committed its own change, so they log and roll back instead of raising -
+    anything they miss is picked up by the next sweep.
+    """
+    
+    def __init__(self, mode=DISPATCH_MODE, top_k=DISPATCH_TOP_K, radius_km=DISPATCH_RADIUS_KM,
+                 offer_seconds=DISPATCH_OFFER_SECONDS, sweep_seconds=DISPATCH_SWEEP_SECONDS):
+        self.mode = mode
+        self.top_k = top_k
+        self.radius_km = radius_km
+        self.offer_seconds = offer_seconds
+        self.sweep_seconds = sweep_seconds
+        self.positions = DriverPositionIndex()
+        self.swept_at = None
+        # Offers expiring after this instant have not been reported to streaming drivers yet
+        self.expired_until = None
+        self._sweep_lock = threading.Lock()
+        self._thread = None
+    
+    @property
+    def enabled(self):
+        return self.mode == 'nearest'
+    
+    def start(self, app):
+        """Sweep in the background so offers expire and move on without incoming_rides polls (nearest mode only)"""
+        if not self.enabled:
+            return
+        with self._sweep_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='dispatch-sweep', daemon=True)
+            self._thread.start()
+    
+    def _run(self, app):
+        from app import db
+        
+        while True:
+            time.sleep(self.sweep_seconds)
+            with app.app_context():
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logging.error(f"Error in dispatch sweep loop: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+    
+    def targets(self, ride):
+        """True when a ride reaches drivers only through offers rather than being shown to every driver of its type"""
+        return self.enabled and ride.pickup_lat is not None and ride.pickup_lng is not None
+    
+    def record_position(self, driver, lat, lng):
+        """Store an idle driver's position (caller handles errors)"""
+        from app import db, get_ist_time
+        from models import DriverPosition
+        
+        db.session.merge(DriverPosition(driver_id=driver.id, latitude=lat, longitude=lng, updated_at=get_ist_time()))
+        db.session.commit()
+        self.positions.update(driver.id, driver.car_type, lat, lng)
+    
+    def driver_offline(self, driver_id):
+        """Forget a driver's position and hand their open offers to other drivers (caller commits)"""
+        from models import DriverPosition, RideOffer
+        
+        DriverPosition.query.filter_by(driver_id=driver_id).delete(synchronize_session=False)
+        if self.enabled:
+            RideOffer.query.filter_by(driver_id=driver_id).delete(synchronize_session=False)
+        self.positions.remove(driver_id)
+        event_bus.publish('driver.offline', {'driver_id': driver_id})
+    
+    def dispatch(self, ride, exclude_driver_ids=()):
+        """
+        Offer a pending ride to the nearest eligible drivers, topping up to top_k live offers
+        Returns: list of driver ids that received a new offer
+        """
+        if not self.enabled or ride.pickup_lat is None or ride.pickup_lng is None or not ride.ride_type:
+            return []
+        
+        from app import db, get_ist_time
+        from models import Driver, Ride, RideOffer, RideRejection
+        
+        try:
+            candidates = self.positions.nearby(
+                ride.ride_type, ride.pickup_lat, ride.pickup_lng, self.radius_km, limit=self.top_k * 10
+            )
+            if not candidates:
+                return []
+            
+            driver_ids = [driver_id for _, driver_id in candidates]
+            now = get_ist_time()
+            
+            # Eligibility is always re-checked against the database
+            online = dict(db.session.query(Driver.id, Driver.phone).filter(
+                Driver.id.in_(driver_ids),
+                Driver.is_online.is_(True)
+            ).all())
+            busy = {row[0] for row in db.session.query(Ride.driver_id).filter(
+                Ride.driver_id.in_(driver_ids),
+                Ride.status.in_(ACTIVE_RIDE_STATUSES)
+            ).all()}
+            rejected_phones = {row[0] for row in db.session.query(RideRejection.driver_phone).filter_by(ride_id=ride.id).all()}
+            offers = db.session.query(RideOffer.driver_id, RideOffer.expires_at > now).filter_by(ride_id=ride.id).all()
+            live = {driver_id for driver_id, is_live in offers if is_live}
+            previously_offered = {driver_id for driver_id, _ in offers}
+            
+            slots = self.top_k - len(live)
+            if slots <= 0:
+                return []
+            
+            eligible = [
+                (distance_km, driver_id) for distance_km, driver_id in candidates
+                if driver_id in online
+                and driver_id not in busy
+                and driver_id not in live
+                and driver_id not in exclude_driver_ids
+                and online[driver_id] not in rejected_phones
+            ]
+            # Prefer drivers who have not seen this ride yet; once everyone nearby has had a turn, start over
+            fresh = [candidate for candidate in eligible if candidate[1] not in previously_offered]
+            chosen = (fresh or eligible)[:slots]
+            if not chosen:
+                return []
+            
+            expires_at = now + timedelta(seconds=self.offer_seconds)
+            db.session.add_all([
+                RideOffer(ride_id=ride.id, driver_id=driver_id, distance_km=round(distance_km, 3),
+                          offered_at=now, expires_at=expires_at)
+                for distance_km, driver_id in chosen
+            ])
+            event_bus.publish('offer.created', {
+                'ride': ride.to_dict(),
+                'offers': [(driver_id, round(distance_km, 3), expires_at.isoformat()) for distance_km, driver_id in chosen]
+            })
+            db.session.commit()
+            
+            offered_ids = [driver_id for _, driver_id in chosen]
+            logging.info(f"Ride {ride.id} offered to drivers {offered_ids}")
+            return offered_ids
+        
+        except Exception as e:
+            logging.error(f"Error dispatching ride {ride.id}: {str(e)}")
+            db.session.rollback()
+            return []
+    
+    def decline(self, ride, driver_phone):
+        """Drop a driver's offer after a rejection and offer the ride to the next nearest driver"""
+        if not self.enabled:
+            return
+        
+        from app import db
+        from models import Driver, RideOffer
+        
+        try:
+            driver_ids = select(Driver.id).where(Driver.phone == driver_phone)
+            RideOffer.query.filter(
+                RideOffer.ride_id == ride.id,
+                RideOffer.driver_id.in_(driver_ids)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Error withdrawing offer for ride {ride.id}: {str(e)}")
+            db.session.rollback()
+            return
+        
+        self.dispatch(ride)
+    
+    def withdraw(self, ride_id):
+        """Remove every offer for a ride that was accepted or cancelled"""
+        if not self.enabled:
+            return
+        
+        from app import db
+        from models import RideOffer
+        
+        try:
+            RideOffer.query.filter_by(ride_id=ride_id).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Error withdrawing offers for ride {ride_id}: {str(e)}")
+            db.session.rollback()
+    
+    def offered_ride_ids(self, driver_id):
+        """Select of ride ids with a live offer for a driver, for use in Ride.id.in_()"""
+        from app import get_ist_time
+        from models import RideOffer
+        
+        return select(RideOffer.ride_id).where(
+            RideOffer.driver_id == driver_id,
+            RideOffer.expires_at > get_ist_time()
+        )
+    
+    def can_accept(self, ride, driver_id):
+        """Rides placed on the map can only be accepted by drivers they were offered to"""
+        if not self.enabled or ride.pickup_lat is None or ride.pickup_lng is None:
+            return True
+        
+        from models import RideOffer
+        
+        # An offer that expired while the driver was tapping accept still counts
+        return RideOffer.query.filter_by(ride_id=ride.id, driver_id=driver_id).first() is not None
+    
+    def sweep(self):
+        """Re-offer pending rides without a live offer; runs at most once per sweep_seconds per worker"""
+        if not self.enabled:
+            return
+        
+        with self._sweep_lock:
+            if self.swept_at is not None and time.time() - self.swept_at < self.sweep_seconds:
+                return
+            self.swept_at = time.time()
+        
+        from app import db, get_ist_time
+        from models import Ride, RideOffer
+        
+        try:
+            now = get_ist_time()
+            # Offers that ran out since the last sweep disappear from the drivers' streams
+            expired_query = db.session.query(RideOffer.driver_id, RideOffer.ride_id).filter(RideOffer.expires_at <= now)
+            if self.expired_until is not None:
+                expired_query = expired_query.filter(RideOffer.expires_at > self.expired_until)
+            for driver_id, ride_id in expired_query.all():
+                event_bus.publish('offer.removed', {'driver_id': driver_id, 'ride_id': ride_id, 'reason': 'expired'})
+            self.expired_until = now
+            
+            live_ride_ids = select(RideOffer.ride_id).where(RideOffer.expires_at > now)
+            rides = Ride.query.filter(
+                Ride.status == 'pending',
+                Ride.driver_id.is_(None),
+                Ride.pickup_lat.isnot(None),
+                Ride.pickup_lng.isnot(None),
+                ~Ride.id.in_(live_ride_ids)
+            ).order_by(Ride.created_at).limit(100).all()
+            
+            RideOffer.query.filter(
+                RideOffer.expires_at < now - timedelta(seconds=OFFER_HISTORY_SECONDS)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Error in dispatch sweep: {str(e)}")
+            db.session.rollback()
+            return
+        
+        for ride in rides:
+            self.dispatch(ride)
+    
+    def stats(self):
+        return {
+            'top_k': self.top_k,
+            'radius_km': self.radius_km,
+            'offer_seconds': self.offer_seconds,
+            'indexed_drivers': len(self.positions)
+        }
+
+
+
+class BatchDispatcher:
+    """
+    Collects pending rides and idle drivers over a short window and assigns them all at once,
+    minimizing total pickup distance per ride type. Matches are written in one transaction with
+    the same conditional update accept_ride relies on, so a ride or driver taken by first-come
+    acceptance in the meantime is simply skipped.
+    """
+    
+    def __init__(self, mode=DISPATCH_MODE, window_seconds=DISPATCH_BATCH_WINDOW_SECONDS,
+                 radius_km=DISPATCH_RADIUS_KM, max_rides=DISPATCH_BATCH_MAX_RIDES,
+                 position_max_age_seconds=DRIVER_POSITION_MAX_AGE_SECONDS):
+        self.mode = mode
+        self.window_seconds = window_seconds
+        self.radius_km = radius_km
+        self.max_rides = max_rides
+        self.position_max_age_seconds = position_max_age_seconds
+        self.batches = 0
+        self.matched = 0
+        self.last_batch = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.mode == 'batch'
+    
+    def start(self, app):
+        """Start the background matcher (no-op unless DISPATCH_MODE=batch)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='batch-dispatch', daemon=True)
+            self._thread.start()
+        logging.info(f"Batch dispatch running every {self.window_seconds}s")
+    
+    def _run(self, app):
+        from app import db
+        
+        while True:
+            time.sleep(self.window_seconds)
+            with app.app_context():
+                try:
+                    self.run_batch()
+                except Exception as e:
+                    logging.error(f"Error in batch dispatch: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+    
+    def run_batch(self):
+        """
+        Match everything currently waiting (requires app context)
+        Returns: list of (ride_id, driver_id, pickup_distance_km) written to the database
+        """
+        from app import db, get_ist_time
+        from models import Driver, DriverPosition, Ride, RideRejection
+        
+        started = time.perf_counter()
+        
+        if db.engine.dialect.name == 'postgresql':
+            got_lock = db.session.execute(
+                text("SELECT pg_try_advisory_xact_lock(:lock_id)"), {'lock_id': BATCH_DISPATCH_LOCK_ID}
+            ).scalar()
+            if not got_lock:
+                db.session.rollback()
+                return []
+        
+        rides = db.session.query(Ride.id, Ride.ride_type, Ride.pickup_lat, Ride.pickup_lng).filter(
+            Ride.status == 'pending',
+            Ride.driver_id.is_(None),
+            Ride.ride_type.isnot(None),
+            Ride.pickup_lat.isnot(None),
+            Ride.pickup_lng.isnot(None)
+        ).order_by(Ride.created_at).limit(self.max_rides).all()
+        if not rides:
+            db.session.rollback()
+            return []
+        
+        now = get_ist_time()
+        active_ride = aliased(Ride)
+        drivers = db.session.query(
+            Driver.id, Driver.phone, Driver.car_type, DriverPosition.latitude, DriverPosition.longitude
+        ).join(DriverPosition, DriverPosition.driver_id == Driver.id).filter(
+            Driver.is_online.is_(True),
+            Driver.car_type.in_(sorted({ride.ride_type for ride in rides})),
+            DriverPosition.updated_at >= now - timedelta(seconds=self.position_max_age_seconds),
+            ~exists().where(
+                active_ride.driver_id == Driver.id,
+                active_ride.status.in_(ACTIVE_RIDE_STATUSES)
+            )
+        ).all()
+        if not drivers:
+            db.session.rollback()
+            return []
+        
+        rejected = set(db.session.query(RideRejection.ride_id, RideRejection.driver_phone).filter(
+            RideRejection.ride_id.in_([ride.id for ride in rides])
+        ).all())
+        
+        matches = []
+        for ride_type in {ride.ride_type for ride in rides}:
+            type_rides = [ride for ride in rides if ride.ride_type == ride_type]
+            type_drivers = [driver for driver in drivers if driver.car_type == ride_type]
+            if not type_drivers:
+                continue
+            
+            cost = pairwise_distance_km(
+                [(ride.pickup_lat, ride.pickup_lng) for ride in type_rides],
+                [(driver.latitude, driver.longitude) for driver in type_drivers]
+            )
+            for row, ride in enumerate(type_rides):
+                for col, driver in enumerate(type_drivers):
+                    if (ride.id, driver.phone) in rejected:
+                        cost[row, col] = np.inf
+            
+            for row, col in solve_assignment(cost, max_cost=self.radius_km):
+                matches.append((type_rides[row].id, type_drivers[col].id, round(float(cost[row, col]), 3)))
+        
+        # Same accept transition as accept_ride: a ride or driver taken in the meantime is skipped
+        written = []
+        for ride_id, driver_id, distance_km in matches:
+            try:
+                with db.session.begin_nested():
+                    ride = accept_pending_ride(ride_id, driver_id, now)
+            except IntegrityError:
+                # Driver accepted another ride concurrently
+                ride = None
+            if ride is not None:
+                written.append((ride_id, driver_id, distance_km))
+        
+        # ride.accepted events for the matches are delivered with the commit
+        db.session.commit()
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.batches += 1
+        self.matched += len(written)
+        self.last_batch = {
+            'rides': len(rides),
+            'drivers': len(drivers),
+            'matched': len(written),
+            'pickup_km': round(sum(distance_km for _, _, distance_km in written), 3),
+            'elapsed_ms': round(elapsed_ms, 1)
+        }
+        if written:
+            logging.info(
+                f"Batch dispatch matched {len(written)} of {len(rides)} rides to {len(drivers)} drivers in {elapsed_ms:.0f}ms"
+            )
+        return written
+    
+    def stats(self):
+        return {
+            'window_seconds': self.window_seconds,
+            'radius_km': self.radius_km,
+            'batches': self.batches,
+            'matched': self.matched,
+            'last_batch': self.last_batch
+        }
+
+
+nearest_dispatcher = NearestDriverDispatcher()
+batch_dispatcher = BatchDispatcher()
+
+
+def get_dispatch_stats():
+    """Dispatch mode and per-worker dispatcher statistics"""
+    return {
+        'mode': DISPATCH_MODE,
+        'nearest': nearest_dispatcher.stats(),
+        'batch': batch_dispatcher.stats()
+    }
+
+
+def on_driver_event(topic, payload):
+    """Drivers who went offline in any worker leave this worker's position index right away"""
+    if topic == 'driver.offline':
+        nearest_dispatcher.positions.remove(payload['driver_id'])
+
+
+event_bus.subscribe('driver.', on_driver_event)
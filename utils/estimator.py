@@ -0,0 +1,170 @@
+import math
+import os
+import threading
+import time
+import logging
+from flask import has_app_context
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometers"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (float(lat1), float(lng1), float(lat2), float(lng2)))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def parse_location(location):
+    """Parse a "lat,lng" string into floats. Returns (lat, lng) or None for plain addresses"""
+    if location is None:
+        return None
+    parts = str(location).split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        lat, lng = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90) or not (-180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+class LocalDistanceEstimator:
+    """
+    Road distance estimate from coordinates alone: haversine distance times a detour factor
+    
+    The factor is calibrated per area (pickup rounded to LOCAL_AREA_PRECISION decimals,
+    1 = ~11km cells) from completed Ride.distance_km values already in the database
+    """
+    
+    def __init__(self, default_factor=None, area_precision=None, min_samples=None, refresh_seconds=None):
+        self.default_factor = default_factor or float(os.environ.get("LOCAL_DETOUR_FACTOR", 1.3))
+        self.area_precision = area_precision if area_precision is not None else int(os.environ.get("LOCAL_AREA_PRECISION", 1))
+        self.min_samples = min_samples or int(os.environ.get("LOCAL_CALIBRATION_MIN_SAMPLES", 20))
+        self.refresh_seconds = refresh_seconds or float(os.environ.get("LOCAL_CALIBRATION_REFRESH_SECONDS", 3600))
+        
+        self.global_factor = self.default_factor
+        self.area_factors = {}
+        self.calibrated_at = None
+        self.sample_count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self, app):
+        """Calibrate now and then every refresh_seconds in the background, off the request path"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='distance-calibration', daemon=True)
+            self._thread.start()
+    
+    def _run(self, app):
+        from app import db
+        
+        while True:
+            with app.app_context():
+                try:
+                    self.calibrate()
+                except Exception as e:
+                    logging.error(f"Local distance calibration failed: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            time.sleep(self.refresh_seconds)
+    
+    def area_key(self, lat, lng):
+        return (round(float(lat), self.area_precision), round(float(lng), self.area_precision))
+    
+    def calibrate(self):
+        """Fit detour factors from historical rides (median of road/straight-line ratio per area)"""
+        from app import db
+        from models import Ride
+        
+        rows = db.session.query(
+            Ride.pickup_lat, Ride.pickup_lng, Ride.drop_lat, Ride.drop_lng, Ride.distance_km
+        ).filter(
+            Ride.pickup_lat.isnot(None),
+            Ride.pickup_lng.isnot(None),
+            Ride.drop_lat.isnot(None),
+            Ride.drop_lng.isnot(None),
+            Ride.distance_km > 0
+        ).order_by(Ride.id.desc()).limit(50000).all()
+        
+        ratios_by_area = {}
+        all_ratios = []
+        for pickup_lat, pickup_lng, drop_lat, drop_lng, distance_km in rows:
+            straight_km = haversine_km(pickup_lat, pickup_lng, drop_lat, drop_lng)
+            # Very short hops are dominated by GPS noise and one-way streets
+            if straight_km < 0.3:
+                continue
+            ratio = distance_km / straight_km
+            # Discard obvious outliers (bad coordinates, round trips)
+            if not (1.0 <= ratio <= 3.0):
+                continue
+            all_ratios.append(ratio)
+            ratios_by_area.setdefault(self.area_key(pickup_lat, pickup_lng), []).append(ratio)
+        
+        with self._lock:
+            self.sample_count = len(all_ratios)
+            self.global_factor = _median(all_ratios) if len(all_ratios) >= self.min_samples else self.default_factor
+            self.area_factors = {
+                area: _median(ratios) for area, ratios in ratios_by_area.items() if len(ratios) >= self.min_samples
+            }
+            self.calibrated_at = time.time()
+        
+        logging.info(
+            f"Local distance estimator calibrated from {len(all_ratios)} rides: "
+            f"global factor {self.global_factor:.3f}, {len(self.area_factors)} area factors"
+        )
+    
+    def _refresh_if_stale(self):
+        # Processes that never called start() (scripts, CLI) calibrate lazily instead
+        if self._thread is not None:
+            return
+        if self.calibrated_at is not None and time.time() - self.calibrated_at < self.refresh_seconds:
+            return
+        if not has_app_context():
+            return
+        from app import db
+        
+        try:
+            self.calibrate()
+        except Exception as e:
+            logging.error(f"Local distance calibration failed: {str(e)}")
+            # Leave the caller's session usable (on Postgres the failed statement aborts its transaction)
+            db.session.rollback()
+            # Do not retry on every request
+            self.calibrated_at = time.time()
+    
+    def detour_factor(self, lat, lng):
+        self._refresh_if_stale()
+        return self.area_factors.get(self.area_key(lat, lng), self.global_factor)
+    
+    def estimate_km(self, pickup_lat, pickup_lng, drop_lat, drop_lng):
+        """Estimated road distance in kilometers between two coordinates"""
+        factor = self.detour_factor(pickup_lat, pickup_lng)
+        return round(haversine_km(pickup_lat, pickup_lng, drop_lat, drop_lng) * factor, 3)
+    
+    def estimate(self, origin, destination):
+        """Estimate between two "lat,lng" strings. Returns distance_km or None for addresses"""
+        origin_point = parse_location(origin)
+        destination_point = parse_location(destination)
+        if origin_point is None or destination_point is None:
+            return None
+        return self.estimate_km(*origin_point, *destination_point)
+    
+    def stats(self):
+        return {
+            'global_factor': round(self.global_factor, 4),
+            'area_factors': len(self.area_factors),
+            'samples': self.sample_count,
+            'calibrated_at': self.calibrated_at
+        }
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
@@ -0,0 +1,270 @@
+import os
+import json
+import fcntl
+import time
+import select
+import logging
+import tempfile
+import threading
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+# auto: postgres on PostgreSQL, local otherwise
+# postgres: LISTEN/NOTIFY, every worker on every node receives every event
+# file: workers on one machine share an append-only JSON lines file (multi-worker SQLite)
+# local: this worker only
+EVENT_BUS = os.environ.get("EVENT_BUS", "auto").lower()
+EVENT_BUS_CHANNEL = os.environ.get("EVENT_BUS_CHANNEL", "taxibook_events")
+# Outside the working directory (the checkout); named after the channel so deployments on one host stay apart
+EVENT_BUS_FILE = os.environ.get("EVENT_BUS_FILE", os.path.join(tempfile.gettempdir(), f"{EVENT_BUS_CHANNEL}.jsonl"))
+EVENT_BUS_POLL_MS = float(os.environ.get("EVENT_BUS_POLL_MS", 100))
+# Past this size the file is rotated: renamed to <file>.1 and started afresh
+EVENT_BUS_FILE_MAX_BYTES = int(os.environ.get("EVENT_BUS_FILE_MAX_BYTES", 10 * 1024 * 1024))
+
+# NOTIFY payloads must stay below 8000 bytes
+NOTIFY_MAX_BYTES = 7900
+LISTEN_RECONNECT_SECONDS = 5
+
+
+class EventBus:
+    """
+    Publish/subscribe for ride lifecycle changes across workers.
+    
+    publish() is transactional: the event is delivered when the session that published it commits
+    and dropped if it rolls back, so subscribers never see a change that was not stored. Every
+    worker, including the publishing one, receives events through the same path and dispatches
+    them to handlers registered with subscribe(). Handlers run on the bus thread and must not
+    rely on a request or app context.
+    """
+    
+    def __init__(self, backend=EVENT_BUS, channel=EVENT_BUS_CHANNEL, path=EVENT_BUS_FILE):
+        self.backend = backend
+        self.channel = channel
+        self.path = path
+        self._handlers = []        # (topic prefix, handler)
+        self._thread = None
+        self._lock = threading.Lock()
+        
+        self.published = 0
+        self.received = 0
+        self.handler_errors = 0
+        self.dropped = 0
+        self.reconnects = 0
+    
+    def start(self, app):
+        """Resolve the backend and start receiving (call once per worker after handlers are registered)"""
+        from app import db
+        
+        if self.backend == 'auto':
+            self.backend = 'postgres' if db.engine.dialect.name == 'postgresql' else 'local'
+        
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self.backend == 'postgres':
+                self._thread = threading.Thread(target=self._listen_postgres, args=(db.engine,), name='event-bus', daemon=True)
+            elif self.backend == 'file':
+                self._thread = threading.Thread(target=self._tail_file, name='event-bus', daemon=True)
+            else:
+                return
+            self._thread.start()
+        logging.info(f"Event bus using {self.backend} backend")
+    
+    def subscribe(self, prefix, handler):
+        """Call handler(topic, payload) for every event whose topic starts with prefix"""
+        self._handlers.append((prefix, handler))
+    
+    def publish(self, topic, payload, session=None):
+        """Queue an event in the current transaction; it is delivered on commit"""
+        from app import db
+        
+        session = session or db.session
+        message = json.dumps({'topic': topic, 'payload': payload}, default=str)
+        
+        if self.backend == 'postgres':
+            if len(message.encode()) > NOTIFY_MAX_BYTES:
+                logging.error(f"Event {topic} too large for NOTIFY ({len(message)} bytes), dropped")
+                self.dropped += 1
+                return
+            session.execute(text("SELECT pg_notify(:channel, :message)"), {'channel': self.channel, 'message': message})
+        else:
+            session.info.setdefault('pending_events', []).append(message)
+        self.published += 1
+    
+    def dispatch(self, message):
+        """Run the handlers for one serialized event"""
+        try:
+            event_data = json.loads(message)
+        except ValueError:
+            logging.error(f"Malformed event on bus: {message[:200]}")
+            return
+        
+        self.received += 1
+        topic = event_data.get('topic', '')
+        for prefix, handler in self._handlers:
+            if topic.startswith(prefix):
+                try:
+                    handler(topic, event_data.get('payload') or {})
+                except Exception as e:
+                    self.handler_errors += 1
+                    logging.error(f"Error handling event {topic}: {str(e)}")
+    
+    def _after_commit(self, session):
+        messages = session.info.pop('pending_events', None)
+        if not messages:
+            return
+        if self.backend == 'file':
+            self._append(messages)
+        else:
+            for message in messages:
+                self.dispatch(message)
+    
+    def _after_rollback(self, session):
+        session.info.pop('pending_events', None)
+    
+    def _append(self, messages):
+        data = ''.join(message + '\n' for message in messages).encode()
+        try:
+            # Appends and rotation are serialized across every process on the host by a lock file
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if os.path.exists(self.path) and os.path.getsize(self.path) > EVENT_BUS_FILE_MAX_BYTES:
+                    # Rotate by rename: readers finish the old file through their open handle
+                    os.replace(self.path, self.path + '.1')
+                # One write per commit with O_APPEND so lines are never interleaved
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+        except OSError as e:
+            self.dropped += len(messages)
+            logging.error(f"Error appending to event file {self.path}: {str(e)}")
+    
+    def _dispatch_lines(self, data):
+        """Dispatch the complete lines of data. Returns the trailing partial line"""
+        lines = data.split(b'\n')
+        for line in lines[:-1]:
+            if line:
+                self.dispatch(line.decode())
+        return lines[-1]
+    
+    def _tail_file(self):
+        """
+        Follow the file through an open handle. Rotation is detected by the path pointing at another
+        inode; the handle keeps that inode alive, so the comparison cannot be fooled by reuse. The old
+        file is complete by then (writers rotate under the lock), so it is read to its end before the
+        new one is opened from the start
+        """
+        handle = None
+        partial = b''
+        if os.path.exists(self.path):
+            handle = open(self.path, 'rb')
+            handle.seek(0, os.SEEK_END)
+        while True:
+            time.sleep(EVENT_BUS_POLL_MS / 1000.0)
+            try:
+                if handle is None:
+                    if not os.path.exists(self.path):
+                        continue
+                    handle, partial = open(self.path, 'rb'), b''
+                
+                partial = self._dispatch_lines(partial + handle.read())
+                try:
+                    following = open(self.path, 'rb')
+                except FileNotFoundError:
+                    continue
+                reading, current = os.fstat(handle.fileno()), os.fstat(following.fileno())
+                if (current.st_dev, current.st_ino) == (reading.st_dev, reading.st_ino):
+                    following.close()
+                    continue
+                
+                # Rotated since the read above: finish the old file, then follow the new one
+                self._dispatch_lines(partial + handle.read())
+                handle.close()
+                try:
+                    with open(self.path + '.1', 'rb') as rotated:
+                        between = os.fstat(rotated.fileno())
+                        if (between.st_dev, between.st_ino) not in ((reading.st_dev, reading.st_ino), (current.st_dev, current.st_ino)):
+                            # Rotated more than once between polls: the file in between is <file>.1
+                            logging.warning(f"Event file {self.path} rotated twice between polls, reading {self.path}.1")
+                            self._dispatch_lines(rotated.read())
+                except FileNotFoundError:
+                    pass
+                handle = following
+                partial = self._dispatch_lines(handle.read())
+            except Exception as e:
+                logging.error(f"Error reading event file {self.path}: {str(e)}")
+    
+    def _listen_postgres(self, engine):
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.set_session(autocommit=True)
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f'LISTEN "{self.channel}"')
+                while True:
+                    if select.select([dbapi_connection], [], [], LISTEN_RECONNECT_SECONDS) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        self.dispatch(dbapi_connection.notifies.pop(0).payload)
+            except Exception as e:
+                self.reconnects += 1
+                logging.error(f"Event bus connection lost, reconnecting: {str(e)}")
+                time.sleep(LISTEN_RECONNECT_SECONDS)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.invalidate()
+                    except Exception:
+                        pass
+    
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'channel': self.channel if self.backend == 'postgres' else None,
+            'file': self.path if self.backend == 'file' else None,
+            'handlers': len(self._handlers),
+            'published': self.published,
+            'received': self.received,
+            'handler_errors': self.handler_errors,
+            'dropped': self.dropped,
+            'reconnects': self.reconnects
+        }
+
+
+event_bus = EventBus()
+
+
+@event.listens_for(Session, 'after_commit')
+def _deliver_after_commit(session):
+    event_bus._after_commit(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        event_bus._after_rollback(session)
+
+
+def publish_ride_event(action, ride, **extra):
+    """ride.<action> event carrying the ride as returned by the ride status endpoint (call before commit)"""
+    from app import db
+    
+    db.session.flush()
+    payload = {'ride': ride.to_dict(), 'driver_id': ride.driver_id}
+    payload.update(extra)
+    event_bus.publish(f"ride.{action}", payload)
+
+
+def publish_location_event(ride_id, latitude, longitude, timestamp):
+    """location.updated event for a new driver position (call before commit)"""
+    event_bus.publish('location.updated', {
+        'ride_id': ride_id,
+        'latitude': latitude,
+        'longitude': longitude,
+        'timestamp': timestamp.isoformat() if hasattr(timestamp, 'isoformat') else timestamp
+    })
@@ -0,0 +1,106 @@
+import math
+import threading
+from utils.estimator import haversine_km
+
+KM_PER_DEGREE_LAT = 111.32
+
+
+class GridIndex:
+    """
+    In-memory spatial index: points bucketed into lat/lng grid cells, partitioned by category
+    (e.g. ride_type or car_type). Radius queries only visit the cells the circle overlaps,
+    so their cost follows local density rather than the total number of points
+    """
+    
+    def __init__(self, cell_size_deg=0.01):
+        # 0.01 degrees is ~1.1km of latitude
+        self.cell_size_deg = cell_size_deg
+        self._cells = {}        # (category, cell_lat, cell_lng) -> {item_id: (lat, lng)}
+        self._items = {}        # item_id -> (category, cell_key)
+        self._lock = threading.RLock()
+    
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_size_deg), math.floor(lng / self.cell_size_deg))
+    
+    def upsert(self, category, item_id, lat, lng):
+        """Insert or move an item"""
+        with self._lock:
+            self.remove(item_id)
+            cell_lat, cell_lng = self._cell(lat, lng)
+            key = (category, cell_lat, cell_lng)
+            self._cells.setdefault(key, {})[item_id] = (lat, lng)
+            self._items[item_id] = (category, key)
+    
+    def remove(self, item_id):
+        """Remove an item if present. Returns True if it was indexed"""
+        with self._lock:
+            entry = self._items.pop(item_id, None)
+            if entry is None:
+                return False
+            _, key = entry
+            bucket = self._cells.get(key)
+            if bucket is not None:
+                bucket.pop(item_id, None)
+                if not bucket:
+                    del self._cells[key]
+            return True
+    
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._items.clear()
+    
+    def get(self, item_id):
+        """Returns (category, lat, lng) or None"""
+        with self._lock:
+            entry = self._items.get(item_id)
+            if entry is None:
+                return None
+            category, key = entry
+            lat, lng = self._cells[key][item_id]
+            return category, lat, lng
+    
+    def __contains__(self, item_id):
+        return item_id in self._items
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def nearby(self, category, lat, lng, radius_km, limit=None):
+        """
+        Items of a category within radius_km of (lat, lng), nearest first
+        Returns: list of (distance_km, item_id)
+        """
+        lat_span = radius_km / KM_PER_DEGREE_LAT
+        lng_span = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+        min_cell_lat, min_cell_lng = self._cell(lat - lat_span, lng - lng_span)
+        max_cell_lat, max_cell_lng = self._cell(lat + lat_span, lng + lng_span)
+        cell_count = (max_cell_lat - min_cell_lat + 1) * (max_cell_lng - min_cell_lng + 1)
+        
+        results = []
+        with self._lock:
+            if cell_count > len(self._cells):
+                # A radius spanning more cells than are occupied: walk the occupied cells instead
+                buckets = [
+                    bucket for (cell_category, cell_lat, cell_lng), bucket in self._cells.items()
+                    if cell_category == category
+                    and min_cell_lat <= cell_lat <= max_cell_lat and min_cell_lng <= cell_lng <= max_cell_lng
+                ]
+            else:
+                buckets = [
+                    self._cells.get((category, cell_lat, cell_lng))
+                    for cell_lat in range(min_cell_lat, max_cell_lat + 1)
+                    for cell_lng in range(min_cell_lng, max_cell_lng + 1)
+                ]
+            for bucket in buckets:
+                if not bucket:
+                    continue
+                for item_id, (item_lat, item_lng) in bucket.items():
+                    distance_km = haversine_km(lat, lng, item_lat, item_lng)
+                    if distance_km <= radius_km:
+                        results.append((distance_km, item_id))
+        
+        results.sort()
+        if limit is not None:
+            results = results[:limit]
+        return results
@@ -0,0 +1,261 @@
+import atexit
+import os
+import threading
+import time
+import logging
+from collections import deque
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from utils.tracking import LocationPoint, naive_timestamp, upsert_latest_location
+
+# direct: every ping is its own transaction (original behaviour)
+# write_behind: pings are acknowledged once queued and flushed in bulk by a background thread
+GPS_INGEST_MODE = os.environ.get("GPS_INGEST_MODE", "direct").lower()
+GPS_FLUSH_INTERVAL_MS = float(os.environ.get("GPS_FLUSH_INTERVAL_MS", 500))
+GPS_FLUSH_MAX_POINTS = int(os.environ.get("GPS_FLUSH_MAX_POINTS", 500))
+# Points beyond this are dropped (and counted) rather than growing the worker without bound
+GPS_BUFFER_MAX_POINTS = int(os.environ.get("GPS_BUFFER_MAX_POINTS", 50000))
+# A point that failed to write this many times is logged and discarded
+GPS_FLUSH_MAX_ATTEMPTS = int(os.environ.get("GPS_FLUSH_MAX_ATTEMPTS", 5))
+
+# Latest positions not refreshed for this long are forgotten (ride over or driver gone quiet)
+LATEST_RETENTION_SECONDS = 600
+
+
+class GpsWriteBehindBuffer:
+    """
+    In-process queue of GPS points. The latest position per ride is served from memory right away;
+    the points are written to ride_location with one executemany INSERT every flush_interval_ms or
+    as soon as flush_max_points are waiting, and once more when the worker exits.
+    
+    The latest-position map is per worker - other workers see the position after the next flush.
+    """
+    
+    def __init__(self, mode=GPS_INGEST_MODE, flush_interval_ms=GPS_FLUSH_INTERVAL_MS,
+                 flush_max_points=GPS_FLUSH_MAX_POINTS, max_points=GPS_BUFFER_MAX_POINTS,
+                 max_attempts=GPS_FLUSH_MAX_ATTEMPTS):
+        self.mode = mode
+        self.flush_interval_ms = flush_interval_ms
+        self.flush_max_points = flush_max_points
+        self.max_points = max_points
+        self.max_attempts = max_attempts
+        
+        self._queue = deque()   # (row, store_history, failed attempts)
+        self._latest = {}       # ride_id -> (LocationPoint, time.time() of the update)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._app = None
+        
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = None
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+    
+    @property
+    def enabled(self):
+        return self.mode == 'write_behind'
+    
+    def start(self, app):
+        """Start the flush thread and register the shutdown flush (no-op unless GPS_INGEST_MODE=write_behind)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._app = app
+            self._thread = threading.Thread(target=self._run, name='gps-write-behind', daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+        logging.info(f"GPS write-behind buffer flushing every {self.flush_interval_ms:.0f}ms or {self.flush_max_points} points")
+    
+    def add_many(self, ride_id, points, store_history=None):
+        """
+        Queue (latitude, longitude, timestamp) points of one ride, oldest first.
+        Points whose store_history flag is False only move the latest position
+        Returns: number of points dropped because the buffer is full
+        """
+        store_history = store_history if store_history is not None else [True] * len(points)
+        dropped = 0
+        with self._lock:
+            for (latitude, longitude, timestamp), store in zip(points, store_history):
+                if len(self._queue) >= self.max_points:
+                    dropped += 1
+                    continue
+                self._queue.append(({
+                    'ride_id': ride_id,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'timestamp': timestamp,
+                    'is_latest': False
+                }, store, 0))
+                self.enqueued += 1
+            
+            # The customer sees the newest point even if it could not be queued
+            if points:
+                latitude, longitude, timestamp = points[-1]
+                current = self._latest.get(ride_id)
+                if current is None or naive_timestamp(current[0].timestamp) <= naive_timestamp(timestamp):
+                    self._latest[ride_id] = (LocationPoint(latitude, longitude, timestamp), time.time())
+            
+            self.dropped += dropped
+            depth = len(self._queue)
+        
+        if dropped:
+            logging.warning(f"GPS buffer full, dropped {dropped} points for ride {ride_id}")
+        if depth >= self.flush_max_points:
+            self._wakeup.set()
+        return dropped
+    
+    def latest(self, ride_id):
+        """Latest buffered position of a ride in this worker, or None"""
+        with self._lock:
+            entry = self._latest.get(ride_id)
+        return entry[0] if entry else None
+    
+    def forget(self, ride_id):
+        with self._lock:
+            self._latest.pop(ride_id, None)
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval_ms / 1000.0)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error in GPS buffer flush loop: {str(e)}")
+    
+    def flush(self):
+        """Write everything queued so far. Returns the number of points written"""
+        if self._app is None:
+            return 0
+        
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._queue)
+                self._queue.clear()
+                self._prune_latest()
+            if not rows:
+                return 0
+            
+            started = time.perf_counter()
+            with self._app.app_context():
+                from app import db
+                
+                try:
+                    self._write(rows)
+                    written = len(rows)
+                except Exception as e:
+                    logging.error(f"Error flushing {len(rows)} GPS points: {str(e)}")
+                    db.session.rollback()
+                    self.failed_flushes += 1
+                    if isinstance(e, OperationalError) or len(rows) == 1:
+                        # Database unreachable: nothing to single out, try the whole batch again later
+                        self._requeue(rows)
+                        return 0
+                    # Most likely a bad row: write the batch point by point so only the bad ones stay behind
+                    written, failed = self._write_each(rows)
+                    self._requeue(failed)
+                finally:
+                    db.session.remove()
+            
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed += written
+            self.last_flush_ms = round(elapsed_ms, 2)
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            return written
+    
+    def _write(self, rows):
+        """Insert the history points of rows and move each ride's latest position, in one transaction"""
+        from app import db
+        from models import RideLocation
+        
+        history = [row for row, store, _ in rows if store]
+        if history:
+            db.session.execute(insert(RideLocation), history)
+        
+        newest = {}
+        for row, _, _ in rows:
+            current = newest.get(row['ride_id'])
+            if current is None or naive_timestamp(current['timestamp']) <= naive_timestamp(row['timestamp']):
+                newest[row['ride_id']] = row
+        for row in newest.values():
+            upsert_latest_location(row['ride_id'], row['latitude'], row['longitude'], row['timestamp'])
+        
+        db.session.commit()
+    
+    def _write_each(self, rows):
+        """Write rows one at a time after a failed batch. Returns (points written, entries that failed)"""
+        from app import db
+        
+        written = 0
+        failed = []
+        for entry in rows:
+            try:
+                self._write([entry])
+                written += 1
+            except Exception as e:
+                db.session.rollback()
+                if isinstance(e, OperationalError):
+                    # Lost the database midway: keep the rest for the next flush as they are
+                    return written, failed + rows[written + len(failed):]
+                logging.warning(f"Could not write GPS point {entry[0]}: {str(e)}")
+                failed.append(entry)
+        return written, failed
+    
+    def _requeue(self, rows):
+        """
+        Put failed entries back in front of newer points with one more failed attempt. Entries out of
+        attempts are discarded, and what no longer fits is dropped
+        """
+        retry = []
+        for row, store, attempts in rows:
+            if attempts + 1 >= self.max_attempts:
+                logging.error(f"Discarding GPS point after {attempts + 1} failed writes: {row}")
+                self.discarded += 1
+            else:
+                retry.append((row, store, attempts + 1))
+        with self._lock:
+            room = max(self.max_points - len(self._queue), 0)
+            kept = retry[len(retry) - room:] if room < len(retry) else retry
+            self._queue.extendleft(reversed(kept))
+            self.dropped += len(retry) - len(kept)
+    
+    def _prune_latest(self):
+        cutoff = time.time() - LATEST_RETENTION_SECONDS
+        for ride_id in [ride_id for ride_id, (_, updated) in self._latest.items() if updated < cutoff]:
+            del self._latest[ride_id]
+    
+    def stats(self):
+        with self._lock:
+            depth = len(self._queue)
+            tracked_rides = len(self._latest)
+        return {
+            'mode': self.mode,
+            'queue_depth': depth,
+            'tracked_rides': tracked_rides,
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'discarded': self.discarded,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else None,
+            'flush_interval_ms': self.flush_interval_ms,
+            'flush_max_points': self.flush_max_points,
+            'max_points': self.max_points
+        }
+
+
+gps_buffer = GpsWriteBehindBuffer()
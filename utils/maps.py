@@ -1,19 +1,278 @@
 import os
+import random
+import threading
+import time
 import requests
 import logging
+from requests.adapters import HTTPAdapter
 from utils.validators import create_error_response
+from utils.cache import create_cache
+from utils.estimator import LocalDistanceEstimator, parse_location
 
-def get_distance_and_fare(pickup_address, drop_address, pickup_lat=None, pickup_lng=None, drop_lat=None, drop_lng=None):
+# GOOGLE_MAPS_BASE_URL overrides this, e.g. to point at the local stand-in (python -m utils.maps_stub)
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+# Distance Matrix accepts at most 25 destinations per request
+MAX_DESTINATIONS_PER_REQUEST = 25
+
+# Top-level statuses that mean Google is struggling rather than the request being bad
+RETRYABLE_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+# Distance cache - coordinates are rounded to this many decimals (4 = ~11m) before keying
+MAPS_CACHE_PRECISION = int(os.environ.get("MAPS_CACHE_PRECISION", 4))
+distance_cache = create_cache("MAPS", default_ttl=300)
+
+def _location_key(location):
+    """Quantize a "lat,lng" location, or normalize an address, so nearby lookups share a cache entry"""
+    text = str(location).strip()
+    
+    # "lat,lng" strings (e.g. driver_location) are quantized like coordinates
+    parts = text.split(',')
+    if len(parts) == 2:
+        try:
+            return f"{float(parts[0]):.{MAPS_CACHE_PRECISION}f},{float(parts[1]):.{MAPS_CACHE_PRECISION}f}"
+        except ValueError:
+            pass
+    
+    return ' '.join(text.lower().replace(',', ' ').split())
+
+def _cache_get(origin_key, destination_key):
+    if distance_cache is None:
+        return None
+    return distance_cache.get(f"route:{origin_key}|{destination_key}")
+
+def _cache_set(origin_key, destination_key, distance_km):
+    if distance_cache is not None:
+        distance_cache.set(f"route:{origin_key}|{destination_key}", distance_km)
+
+def get_cache_stats():
+    """Hit/miss counts for the distance cache in this worker"""
+    if distance_cache is None:
+        return {'backend': None}
+    return distance_cache.stats()
+
+def calculate_fare(distance_km):
+    """Calculate fare: ₹12 base + ₹11/km"""
+    base_fare = 12
+    per_km_rate = 11
+    fare_amount = base_fare + (distance_km * per_km_rate)
+    return round(fare_amount, 2)
+
+
+class MapsError(Exception):
+    """Distance Matrix request failed"""
+    
+    def __init__(self, message, retryable=False, invalid_request=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.invalid_request = invalid_request
+
+
+class MapsUnavailable(MapsError):
+    """Request was not attempted (circuit open, concurrency cap or deadline spent)"""
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures, then lets one probe through after a cool-down"""
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+    
+    def allow_request(self):
+        """True if a request may go upstream right now"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                # Single trial request decides whether to close again
+                self._probing = True
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    logging.warning(f"Google Maps circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self):
+        """Give back a half-open probe slot that never reached upstream, without counting a failure"""
+        with self._lock:
+            self._probing = False
+
+
+class MapsClient:
     """
-    Calculate distance and fare using Google Maps Distance Matrix API
-    Returns: (success, distance_km, fare_amount, error_message)
+    Distance Matrix client with pooled keep-alive connections, bounded retries,
+    per-call deadlines, a circuit breaker and a cap on concurrent upstream calls
+    
+    fallback: optional callable(origin, destination) -> distance_km or None, used
+    whenever Google cannot be asked (circuit open, capacity, deadline) or fails
     """
-    api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
-    if not api_key:
-        logging.error("Google Maps API key not found in environment variables")
-        return False, None, None, "Google Maps API configuration error"
     
-    try:
+    def __init__(self, api_key=None, base_url=None, timeout=None, deadline=None, max_retries=None,
+                 max_concurrent=None, breaker_threshold=None, breaker_reset=None, fallback=None):
+        self._api_key = api_key
+        self.base_url = base_url or os.environ.get("GOOGLE_MAPS_BASE_URL", DISTANCE_MATRIX_URL)
+        self.timeout = timeout or float(os.environ.get("MAPS_TIMEOUT_SECONDS", 3))
+        self.deadline = deadline or float(os.environ.get("MAPS_DEADLINE_SECONDS", 5))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("MAPS_MAX_RETRIES", 2))
+        self.max_concurrent = max_concurrent or int(os.environ.get("MAPS_MAX_CONCURRENT", 8))
+        self.fallback = fallback
+        
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_threshold or int(os.environ.get("MAPS_BREAKER_THRESHOLD", 5)),
+            reset_timeout=breaker_reset or float(os.environ.get("MAPS_BREAKER_RESET_SECONDS", 30))
+        )
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        
+        # Keep-alive pool sized to the concurrency cap
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrent)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        self._stats_lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+        self.rejected = 0
+        self.fallbacks = 0
+    
+    @property
+    def api_key(self):
+        return self._api_key or os.environ.get("GOOGLE_MAPS_API_KEY")
+    
+    def stats(self):
+        return {
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'requests_sent': self.requests_sent,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'fallbacks': self.fallbacks
+        }
+    
+    def _request_matrix(self, origins, destinations, deadline):
+        """
+        Run one Distance Matrix request within the deadline (time.monotonic() value)
+        Returns: parsed JSON with status OK; raises MapsError otherwise
+        """
+        if not self.breaker.allow_request():
+            with self._stats_lock:
+                self.rejected += 1
+            raise MapsUnavailable("circuit open")
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            with self._stats_lock:
+                self.rejected += 1
+            # Local overload says nothing about Google: free a half-open probe, do not count a failure
+            self.breaker.release_probe()
+            raise MapsUnavailable("too many concurrent Maps requests")
+        
+        try:
+            params = {
+                'origins': origins,
+                'destinations': destinations,
+                'key': self.api_key,
+                'units': 'metric'
+            }
+            
+            attempt = 0
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if attempt:
+                        # Only the retries of an upstream error used up the deadline
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.release_probe()
+                    raise MapsUnavailable("deadline exceeded")
+                
+                try:
+                    with self._stats_lock:
+                        self.requests_sent += 1
+                    response = self.session.get(self.base_url, params=params, timeout=min(self.timeout, remaining))
+                    if response.status_code >= 500 or response.status_code == 429:
+                        raise MapsError(f"HTTP {response.status_code}", retryable=True)
+                    response.raise_for_status()
+                    
+                    data = response.json()
+                    status = data.get('status')
+                    if status in RETRYABLE_STATUSES:
+                        raise MapsError(status, retryable=True)
+                    
+                    # Google answered - even an invalid-request status means it is healthy
+                    self.breaker.record_success()
+                    if status != 'OK':
+                        raise MapsError(status, invalid_request=True)
+                    return data
+                
+                except MapsError as e:
+                    if not e.retryable:
+                        raise
+                    error = e
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                    error = MapsError(str(e), retryable=True)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    # 4xx or unparseable body - retrying will not help
+                    self.breaker.record_failure()
+                    raise MapsError(str(e))
+                
+                if attempt >= self.max_retries:
+                    self.breaker.record_failure()
+                    raise error
+                
+                # Exponential backoff with full jitter, never past the deadline
+                attempt += 1
+                with self._stats_lock:
+                    self.retries += 1
+                backoff = random.uniform(0, 0.1 * (2 ** attempt))
+                time.sleep(min(backoff, max(0, deadline - time.monotonic())))
+        finally:
+            self._slots.release()
+    
+    def _fallback_distance(self, origin, destination):
+        if self.fallback is None:
+            return None
+        try:
+            distance_km = self.fallback(origin, destination)
+        except Exception as e:
+            logging.error(f"Fallback distance estimate failed: {str(e)}")
+            return None
+        if distance_km is not None:
+            with self._stats_lock:
+                self.fallbacks += 1
+        return distance_km
+    
+    def distance_and_fare(self, pickup_address, drop_address, pickup_lat=None, pickup_lng=None, drop_lat=None, drop_lng=None):
+        """
+        Calculate distance and fare using Google Maps Distance Matrix API
+        Returns: (success, distance_km, fare_amount, error_message)
+        """
         # Use coordinates if available, otherwise use addresses
         if pickup_lat and pickup_lng and drop_lat and drop_lng:
             origins = f"{pickup_lat},{pickup_lng}"
@@ -22,104 +281,237 @@ def get_distance_and_fare(pickup_address, drop_address, pickup_lat=None, pickup_
             origins = pickup_address
             destinations = drop_address
         
-        # Make API request
-        url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-        params = {
-            'origins': origins,
-            'destinations': destinations,
-            'key': api_key,
-            'units': 'metric'
-        }
+        # Estimate followed by booking usually asks for the same route within seconds
+        origin_key = _location_key(origins)
+        destination_key = _location_key(destinations)
+        distance_km = _cache_get(origin_key, destination_key)
+        if distance_km is not None:
+            return True, distance_km, calculate_fare(distance_km), None
         
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
+        if not self.api_key:
+            logging.error("Google Maps API key not found in environment variables")
+            distance_km = self._fallback_distance(origins, destinations)
+            if distance_km is not None:
+                return True, distance_km, calculate_fare(distance_km), None
+            return False, None, None, "Google Maps API configuration error"
         
-        data = response.json()
+        try:
+            data = self._request_matrix(origins, destinations, time.monotonic() + self.deadline)
+            
+            # Extract distance information
+            rows = data.get('rows', [])
+            if not rows or not rows[0].get('elements'):
+                return False, None, None, "Could not calculate distance - no route found"
+            
+            element = rows[0]['elements'][0]
+            if element.get('status') != 'OK':
+                logging.error(f"Google Maps API element error: {element.get('status')}")
+                return False, None, None, "Could not calculate distance - no route available"
+            
+            # Get distance in kilometers
+            distance_meters = element['distance']['value']
+            distance_km = distance_meters / 1000
+            
+            _cache_set(origin_key, destination_key, distance_km)
+            
+            # Calculate fare: ₹12 base + ₹11/km
+            fare_amount = calculate_fare(distance_km)
+            
+            logging.info(f"Distance calculated: {distance_km}km, Fare: ₹{fare_amount}")
+            return True, distance_km, fare_amount, None
         
-        # Check API response status
-        if data.get('status') != 'OK':
-            logging.error(f"Google Maps API error: {data.get('status')}")
-            return False, None, None, "Could not calculate distance - invalid location"
+        except MapsError as e:
+            if e.invalid_request:
+                logging.error(f"Google Maps API error: {str(e)}")
+                return False, None, None, "Could not calculate distance - invalid location"
+            
+            logging.error(f"Google Maps API request failed: {str(e)}")
+            distance_km = self._fallback_distance(origins, destinations)
+            if distance_km is not None:
+                return True, distance_km, calculate_fare(distance_km), None
+            return False, None, None, "Could not calculate distance - network error"
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Google Maps API request failed: {str(e)}")
+            return False, None, None, "Could not calculate distance - network error"
+        except Exception as e:
+            logging.error(f"Unexpected error in distance calculation: {str(e)}")
+            return False, None, None, "Could not calculate distance - system error"
+    
+    def distance_to_pickup(self, driver_location, pickup_address, pickup_lat=None, pickup_lng=None):
+        """
+        Calculate distance from driver to pickup location
+        Returns: (success, distance_km, error_message)
+        """
+        distance_km = self.distances_to_pickups(driver_location, [(pickup_address, pickup_lat, pickup_lng)])[0]
+        if distance_km is None:
+            return False, None, "Could not calculate distance to pickup"
+        return True, distance_km, None
+    
+    def distances_to_pickups(self, driver_location, pickups):
+        """
+        Calculate distances from driver to many pickup locations with batched API calls
+        pickups: list of (pickup_address, pickup_lat, pickup_lng) tuples
+        Returns: list of distance_km in the same order as pickups (None where unavailable)
+        """
+        distances = [None] * len(pickups)
         
-        # Extract distance information
-        rows = data.get('rows', [])
-        if not rows or not rows[0].get('elements'):
-            return False, None, None, "Could not calculate distance - no route found"
+        if not pickups:
+            return distances
         
-        element = rows[0]['elements'][0]
-        if element.get('status') != 'OK':
-            logging.error(f"Google Maps API element error: {element.get('status')}")
-            return False, None, None, "Could not calculate distance - no route available"
+        # Use coordinates if available, otherwise use address - only cache misses go to the API
+        origin_key = _location_key(driver_location)
+        destinations = []
+        for index, (pickup_address, pickup_lat, pickup_lng) in enumerate(pickups):
+            if pickup_lat and pickup_lng:
+                destination = f"{pickup_lat},{pickup_lng}"
+            else:
+                destination = pickup_address
+            
+            cached = _cache_get(origin_key, _location_key(destination))
+            if cached is not None:
+                distances[index] = cached
+            else:
+                destinations.append((index, destination))
         
-        # Get distance in kilometers
-        distance_meters = element['distance']['value']
-        distance_km = distance_meters / 1000
+        # One deadline covers every chunk of the batch
+        deadline = time.monotonic() + self.deadline
         
-        # Calculate fare: ₹12 base + ₹11/km
-        base_fare = 12
-        per_km_rate = 11
-        fare_amount = base_fare + (distance_km * per_km_rate)
-        fare_amount = round(fare_amount, 2)
+        # One origin, many destinations - split at the per-request destination limit
+        for start in range(0, len(destinations), MAX_DESTINATIONS_PER_REQUEST):
+            chunk = destinations[start:start + MAX_DESTINATIONS_PER_REQUEST]
+            try:
+                if not self.api_key:
+                    raise MapsUnavailable("Google Maps API key not configured")
+                
+                data = self._request_matrix(
+                    driver_location, '|'.join(destination for _, destination in chunk), deadline
+                )
+                
+                rows = data.get('rows', [])
+                if not rows:
+                    continue
+                
+                # Elements come back in destination order
+                for (index, destination), element in zip(chunk, rows[0].get('elements', [])):
+                    if element.get('status') == 'OK':
+                        distances[index] = element['distance']['value'] / 1000
+                        _cache_set(origin_key, _location_key(destination), distances[index])
+            
+            except MapsError as e:
+                logging.error(f"Error calculating distances to pickups: {str(e)}")
+                if not e.invalid_request:
+                    for index, destination in chunk:
+                        distances[index] = self._fallback_distance(driver_location, destination)
+            except Exception as e:
+                logging.error(f"Error calculating distances to pickups: {str(e)}")
         
-        logging.info(f"Distance calculated: {distance_km}km, Fare: ₹{fare_amount}")
-        return True, distance_km, fare_amount, None
+        return distances
+
+
+class LocalMapsProvider:
+    """Coordinate-only provider backed by the calibrated local estimator (no API calls)"""
+    
+    def __init__(self, estimator):
+        self.estimator = estimator
+    
+    def distance_and_fare(self, pickup_address, drop_address, pickup_lat=None, pickup_lng=None, drop_lat=None, drop_lng=None):
+        """
+        Estimate distance and fare from coordinates
+        Returns: (success, distance_km, fare_amount, error_message)
+        """
+        if not (pickup_lat and pickup_lng and drop_lat and drop_lng):
+            return False, None, None, "Could not calculate distance - coordinates required"
+        
+        distance_km = self.estimator.estimate_km(pickup_lat, pickup_lng, drop_lat, drop_lng)
+        return True, distance_km, calculate_fare(distance_km), None
+    
+    def distance_to_pickup(self, driver_location, pickup_address, pickup_lat=None, pickup_lng=None):
+        """
+        Estimate distance from driver to pickup location
+        Returns: (success, distance_km, error_message)
+        """
+        distance_km = self.distances_to_pickups(driver_location, [(pickup_address, pickup_lat, pickup_lng)])[0]
+        if distance_km is None:
+            return False, None, "Could not calculate distance to pickup"
+        return True, distance_km, None
+    
+    def distances_to_pickups(self, driver_location, pickups):
+        """
+        Estimate distances from driver to many pickup locations
+        Returns: list of distance_km in the same order as pickups (None where coordinates are missing)
+        """
+        driver_point = parse_location(driver_location)
+        if driver_point is None:
+            return [None] * len(pickups)
         
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Google Maps API request failed: {str(e)}")
-        return False, None, None, "Could not calculate distance - network error"
-    except Exception as e:
-        logging.error(f"Unexpected error in distance calculation: {str(e)}")
-        return False, None, None, "Could not calculate distance - system error"
+        return [
+            self.estimator.estimate_km(driver_point[0], driver_point[1], pickup_lat, pickup_lng)
+            if pickup_lat and pickup_lng else None
+            for _, pickup_lat, pickup_lng in pickups
+        ]
+    
+    def stats(self):
+        return {'provider': 'local'}
+
+
+# Provider selection
+# MAPS_PROVIDER: google (default) or local - local never calls the API
+# MAPS_FALLBACK: local (default) or none - estimate used while Google is unavailable
+# MAPS_PREFILTER_LIMIT: when > 0, only the N nearest pickups (by local estimate) get a paid lookup
+local_estimator = LocalDistanceEstimator()
+local_provider = LocalMapsProvider(local_estimator)
+
+MAPS_PROVIDER = os.environ.get("MAPS_PROVIDER", "google").lower()
+MAPS_FALLBACK = os.environ.get("MAPS_FALLBACK", "local").lower()
+MAPS_PREFILTER_LIMIT = int(os.environ.get("MAPS_PREFILTER_LIMIT", 0))
+
+# Shared client for the worker - one keep-alive pool and one breaker per process
+maps_client = MapsClient(fallback=local_estimator.estimate if MAPS_FALLBACK == 'local' else None)
+maps_provider = local_provider if MAPS_PROVIDER == 'local' else maps_client
+
+def get_maps_stats():
+    """Cache, client and estimator counters for this worker"""
+    return {
+        'provider': MAPS_PROVIDER,
+        'cache': get_cache_stats(),
+        'client': maps_client.stats(),
+        'estimator': local_estimator.stats()
+    }
+
+def get_distance_and_fare(pickup_address, drop_address, pickup_lat=None, pickup_lng=None, drop_lat=None, drop_lng=None):
+    """
+    Calculate distance and fare using Google Maps Distance Matrix API
+    Returns: (success, distance_km, fare_amount, error_message)
+    """
+    return maps_provider.distance_and_fare(pickup_address, drop_address, pickup_lat, pickup_lng, drop_lat, drop_lng)
 
 def get_distance_to_pickup(driver_location, pickup_address, pickup_lat=None, pickup_lng=None):
     """
     Calculate distance from driver to pickup location
     Returns: (success, distance_km, error_message)
     """
-    api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
-    if not api_key:
-        return False, None, "Google Maps API configuration error"
-    
-    try:
-        # Use coordinates if available, otherwise use address
-        if pickup_lat and pickup_lng:
-            destinations = f"{pickup_lat},{pickup_lng}"
-        else:
-            destinations = pickup_address
-        
-        # Make API request
-        url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-        params = {
-            'origins': driver_location,
-            'destinations': destinations,
-            'key': api_key,
-            'units': 'metric'
-        }
-        
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        
-        # Check API response status
-        if data.get('status') != 'OK':
-            return False, None, "Could not calculate distance to pickup"
-        
-        # Extract distance information
-        rows = data.get('rows', [])
-        if not rows or not rows[0].get('elements'):
-            return False, None, "Could not calculate distance to pickup"
-        
-        element = rows[0]['elements'][0]
-        if element.get('status') != 'OK':
-            return False, None, "Could not calculate distance to pickup"
-        
-        # Get distance in kilometers
-        distance_meters = element['distance']['value']
-        distance_km = distance_meters / 1000
-        
-        return True, distance_km, None
-        
-    except Exception as e:
-        logging.error(f"Error calculating distance to pickup: {str(e)}")
-        return False, None, "Could not calculate distance to pickup"
+    return maps_provider.distance_to_pickup(driver_location, pickup_address, pickup_lat, pickup_lng)
+
+def get_distances_to_pickups(driver_location, pickups):
+    """
+    Calculate distances from driver to many pickup locations with batched API calls
+    pickups: list of (pickup_address, pickup_lat, pickup_lng) tuples
+    Returns: list of distance_km in the same order as pickups (None where unavailable)
+    """
+    if maps_provider is local_provider or MAPS_PREFILTER_LIMIT <= 0 or len(pickups) <= MAPS_PREFILTER_LIMIT:
+        return maps_provider.distances_to_pickups(driver_location, pickups)
+    
+    # Rank by local estimate first and only pay for the nearest pickups
+    estimates = local_provider.distances_to_pickups(driver_location, pickups)
+    ranked = sorted(
+        (index for index, estimate in enumerate(estimates) if estimate is not None),
+        key=lambda index: estimates[index]
+    )
+    unranked = [index for index, estimate in enumerate(estimates) if estimate is None]
+    lookup_indexes = (ranked + unranked)[:MAPS_PREFILTER_LIMIT]
+    
+    looked_up = maps_provider.distances_to_pickups(driver_location, [pickups[index] for index in lookup_indexes])
+    for index, distance_km in zip(lookup_indexes, looked_up):
+        if distance_km is not None:
+            estimates[index] = distance_km
+    return estimates
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Google Distance Matrix API, for offline benchmarking
+
+Run:
+    python -m utils.maps_stub --port 8765 --p50 0.08 --p99 0.6 --timeout-rate 0.01
+
+Point the backend at it:
+    GOOGLE_MAPS_BASE_URL=http://localhost:8765/maps/api/distancematrix/json
+    GOOGLE_MAPS_API_KEY=stub
+
+Distances are deterministic: coordinates use haversine distance times a fixed
+detour factor, addresses use a stable hash of the address pair.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from utils.estimator import haversine_km, parse_location
+
+# Same order of magnitude as Indian city road networks
+STUB_DETOUR_FACTOR = 1.35
+STUB_SPEED_KMPH = 25
+
+# z-score of the 99th percentile of a standard normal distribution
+Z_99 = 2.3263
+
+
+class LatencyProfile:
+    """Lognormal latency fitted to p50/p99 plus injected timeouts and error statuses"""
+    
+    def __init__(self, p50=0.0, p99=0.0, timeout_rate=0.0, hang_seconds=30.0,
+                 over_query_limit_rate=0.0, server_error_rate=0.0, seed=None):
+        self.p50 = p50
+        self.p99 = max(p99, p50)
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.over_query_limit_rate = over_query_limit_rate
+        self.server_error_rate = server_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        
+        # p99 = p50 * exp(Z_99 * sigma)
+        self.sigma = math.log(self.p99 / self.p50) / Z_99 if self.p50 > 0 and self.p99 > self.p50 else 0.0
+    
+    def draw(self):
+        """
+        Pick the outcome of one request
+        Returns: (delay_seconds, outcome) where outcome is 'ok', 'timeout', 'over_query_limit' or 'server_error'
+        """
+        with self._lock:
+            roll = self._random.random()
+            if self.p50 > 0:
+                delay = self.p50 * math.exp(self.sigma * self._random.gauss(0, 1))
+            else:
+                delay = 0.0
+        
+        if roll < self.timeout_rate:
+            return self.hang_seconds, 'timeout'
+        roll -= self.timeout_rate
+        if roll < self.over_query_limit_rate:
+            return delay, 'over_query_limit'
+        roll -= self.over_query_limit_rate
+        if roll < self.server_error_rate:
+            return delay, 'server_error'
+        return delay, 'ok'
+
+
+def stub_distance_km(origin, destination):
+    """Deterministic road distance for an origin/destination pair"""
+    origin_point = parse_location(origin)
+    destination_point = parse_location(destination)
+    if origin_point and destination_point:
+        return haversine_km(*origin_point, *destination_point) * STUB_DETOUR_FACTOR
+    
+    # Addresses: stable 1-30km distance derived from the normalized pair
+    key = f"{origin.strip().lower()}|{destination.strip().lower()}".encode('utf-8')
+    digest = int(hashlib.sha256(key).hexdigest()[:8], 16)
+    return 1 + (digest % 29000) / 1000
+
+
+def build_matrix_response(origins, destinations):
+    """Distance Matrix JSON body for '|'-separated origins and destinations"""
+    origin_list = origins.split('|') if origins else []
+    destination_list = destinations.split('|') if destinations else []
+    if not origin_list or not destination_list:
+        return {'status': 'INVALID_REQUEST', 'rows': []}
+    if len(origin_list) > 25 or len(destination_list) > 25 or len(origin_list) * len(destination_list) > 100:
+        return {'status': 'MAX_ELEMENTS_EXCEEDED', 'rows': []}
+    
+    rows = []
+    for origin in origin_list:
+        elements = []
+        for destination in destination_list:
+            if not origin.strip() or not destination.strip():
+                elements.append({'status': 'NOT_FOUND'})
+                continue
+            distance_km = stub_distance_km(origin, destination)
+            duration_seconds = distance_km / STUB_SPEED_KMPH * 3600
+            elements.append({
+                'status': 'OK',
+                'distance': {'text': f"{distance_km:.1f} km", 'value': int(round(distance_km * 1000))},
+                'duration': {'text': f"{int(duration_seconds // 60)} mins", 'value': int(duration_seconds)}
+            })
+        rows.append({'elements': elements})
+    
+    return {
+        'status': 'OK',
+        'origin_addresses': origin_list,
+        'destination_addresses': destination_list,
+        'rows': rows
+    }
+
+
+class MatrixStubHandler(BaseHTTPRequestHandler):
+    profile = LatencyProfile()
+    stats = {'requests': 0, 'ok': 0, 'timeout': 0, 'over_query_limit': 0, 'server_error': 0}
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self._send_json(200, self.stats)
+        if not url.path.endswith('/distancematrix/json'):
+            return self._send_json(404, {'status': 'NOT_FOUND'})
+        
+        params = parse_qs(url.query)
+        delay, outcome = self.profile.draw()
+        self.stats['requests'] += 1
+        self.stats[outcome] += 1
+        if delay > 0:
+            time.sleep(delay)
+        
+        if outcome == 'timeout':
+            # Client should have given up long ago - drop the connection without a response
+            self.close_connection = True
+            return
+        if outcome == 'server_error':
+            return self._send_json(500, {'status': 'UNKNOWN_ERROR'})
+        if outcome == 'over_query_limit':
+            return self._send_json(200, {'status': 'OVER_QUERY_LIMIT', 'rows': []})
+        
+        body = build_matrix_response(params.get('origins', [''])[0], params.get('destinations', [''])[0])
+        self._send_json(200, body)
+    
+    def _send_json(self, status_code, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    def log_message(self, format, *args):
+        logging.debug(f"maps stub: {format % args}")
+
+
+def create_server(host='127.0.0.1', port=8765, profile=None):
+    """Build (but do not start) a stand-in server; use port=0 to pick a free port"""
+    handler = type('ConfiguredMatrixStubHandler', (MatrixStubHandler,), {
+        'profile': profile or LatencyProfile(),
+        'stats': {'requests': 0, 'ok': 0, 'timeout': 0, 'over_query_limit': 0, 'server_error': 0}
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Distance Matrix stand-in server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--p50', type=float, default=0.0, help="median latency in seconds")
+    parser.add_argument('--p99', type=float, default=0.0, help="99th percentile latency in seconds")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="fraction of requests that hang")
+    parser.add_argument('--hang-seconds', type=float, default=30.0, help="how long hanging requests stall")
+    parser.add_argument('--over-query-limit-rate', type=float, default=0.0)
+    parser.add_argument('--server-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    
+    profile = LatencyProfile(
+        p50=args.p50, p99=args.p99, timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds,
+        over_query_limit_rate=args.over_query_limit_rate, server_error_rate=args.server_error_rate, seed=args.seed
+    )
+    server = create_server(args.host, args.port, profile)
+    print(f"Distance Matrix stub listening on http://{args.host}:{server.server_port}/maps/api/distancematrix/json")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import json
+import base64
+from datetime import datetime
+from sqlalchemy import tuple_
+
+
+def encode_cursor(sort_value, row_id):
+    """Opaque token for the position after the row (sort_value, id); sort_value is a datetime or None"""
+    payload = json.dumps([sort_value.isoformat() if sort_value else None, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def validate_cursor(token):
+    """Decode a cursor from encode_cursor(). Returns (True, (sort_value, row_id)) or (False, error)"""
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_value, row_id = json.loads(payload)
+        return True, (datetime.fromisoformat(sort_value) if sort_value else None, int(row_id))
+    except (ValueError, TypeError):
+        return False, "Invalid cursor"
+
+
+def keyset_page(fetch, statement, column, id_column, position, limit, after=None):
+    """
+    One keyset page ordered by (column DESC NULLS LAST, id DESC): rows with a value by
+    (column, id), then rows where it is NULL by id. Each part is a range scan of a
+    (..., column, id) index, so every page costs the same however deep it is.
+    
+    fetch: runs the statement (a select or a Query) and returns its rows
+    position: row -> (column value, id) of that row, for the next cursor
+    after: validated cursor of the previous page, or None for the first page
+    Returns: (rows, next cursor or None on the last page)
+    """
+    rows = []
+    if after is None or after[0] is not None:
+        valued = statement.where(column.isnot(None))
+        if after is not None:
+            valued = valued.where(tuple_(column, id_column) < tuple_(*after))
+        rows = fetch(valued.order_by(column.desc(), id_column.desc()).limit(limit + 1))
+    
+    if len(rows) <= limit:
+        # Rows with a value exhausted within this page: continue with the NULL ones
+        unvalued = statement.where(column.is_(None))
+        if after is not None and after[0] is None:
+            unvalued = unvalued.where(id_column < after[1])
+        rows += fetch(unvalued.order_by(id_column.desc()).limit(limit + 1 - len(rows)))
+    
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*position(rows[-1]))
+
+
+def completed_rides_page(projection, statement, limit, after=None):
+    """
+    One keyset page of rides, most recently completed first: rides with completed_at by
+    (completed_at DESC, id DESC), then rides not completed (yet) by id DESC. Rides completed
+    meanwhile do not shift the pages after them.
+    
+    statement: projection.select() with the endpoint's filters; its records need completed_at and ride_id
+    after: validated cursor of the previous page, or None for the first page
+    Returns: (records, next cursor or None on the last page)
+    """
+    from models import Ride
+    
+    return keyset_page(projection.all, statement, Ride.completed_at, Ride.id,
+                       lambda row: (row.completed_at, row.ride_id), limit, after)
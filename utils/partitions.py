@@ -0,0 +1,373 @@
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+# Raw GPS points older than this are removed (finished rides are compacted into ride_trail first). 0 = keep forever
+RIDE_LOCATION_RETENTION_DAYS = int(os.environ.get("RIDE_LOCATION_RETENTION_DAYS", 30))
+# Daily partitions are created this many days ahead so writes never wait on DDL
+RIDE_LOCATION_PREMAKE_DAYS = int(os.environ.get("RIDE_LOCATION_PREMAKE_DAYS", 3))
+PARTITION_MAINTENANCE_SECONDS = float(os.environ.get("PARTITION_MAINTENANCE_SECONDS", 3600))
+
+# Postgres advisory lock so only one worker runs maintenance at a time
+PARTITION_MAINTENANCE_LOCK_ID = 720802
+# SQLite fallback deletes expired rows in chunks to keep write locks short
+SQLITE_DELETE_BATCH = 5000
+
+PARENT_TABLE = 'ride_location'
+LEGACY_PARTITION = 'ride_location_legacy'
+DEFAULT_PARTITION = 'ride_location_default'
+
+PARTITIONED_COLUMNS = """
+    ride_id INTEGER NOT NULL REFERENCES ride (id),
+    latitude DOUBLE PRECISION NOT NULL,
+    longitude DOUBLE PRECISION NOT NULL,
+    "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    is_latest BOOLEAN NOT NULL,
+    PRIMARY KEY (id, "timestamp")
+"""
+# No IF NOT EXISTS: a clash with an index of the old table must fail rather than leave the parent without it
+PARENT_INDEXES = (
+    "CREATE INDEX ix_ride_location_ride_time ON ride_location (ride_id, \"timestamp\")",
+)
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def partition_name(day):
+    return f"{PARENT_TABLE}_p{day:%Y%m%d}"
+
+
+def _today():
+    from app import get_ist_time
+    return get_ist_time().date()
+
+
+def _naive(timestamp):
+    return timestamp.replace(tzinfo=None) if timestamp.tzinfo is not None else timestamp
+
+
+def is_partitioned(connection):
+    """True when ride_location is a native Postgres partitioned table"""
+    if connection.dialect.name != 'postgresql':
+        return False
+    return bool(connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))"
+    ), {'name': PARENT_TABLE}).scalar())
+
+
+def _create_parent(connection, id_column="id SERIAL NOT NULL"):
+    connection.execute(text(
+        f"CREATE TABLE {PARENT_TABLE} ({id_column},{PARTITIONED_COLUMNS}) PARTITION BY RANGE (\"timestamp\")"
+    ))
+    for statement in PARENT_INDEXES:
+        connection.execute(text(statement))
+
+
+def partition_on_create(table, connection, **kw):
+    """
+    after_create hook of RideLocation: on Postgres the plain table create_all just made (empty)
+    is replaced by a table partitioned by day. Other databases keep the plain layout
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(f"DROP TABLE {PARENT_TABLE}"))
+    _create_parent(connection)
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+    today = _today()
+    ensure_partitions(connection, today - timedelta(days=1), today + timedelta(days=RIDE_LOCATION_PREMAKE_DAYS))
+    logging.info("Created ride_location partitioned by day")
+
+
+def ensure_partitions(connection, first_day, last_day):
+    """Create the daily partitions for first_day..last_day that do not exist yet. Returns names created"""
+    existing = {name for name, _ in _list_partitions(connection)}
+    created = []
+    day = first_day
+    while day <= last_day:
+        name = partition_name(day)
+        if name not in existing:
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+                        f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+                    ))
+                created.append(name)
+            except Exception as e:
+                # Range already covered (legacy partition) or rows for that day waiting in the default partition
+                logging.warning(f"Could not create partition {name}: {str(e)}")
+        day += timedelta(days=1)
+    return created
+
+
+def _list_partitions(connection):
+    """(name, exclusive upper bound or None for DEFAULT) of every ride_location partition"""
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:name) ORDER BY c.relname"
+    ), {'name': PARENT_TABLE}).all()
+    partitions = []
+    for name, bound in rows:
+        match = _UPPER_BOUND.search(bound or '')
+        partitions.append((name, datetime.fromisoformat(match.group(1)) if match else None))
+    return partitions
+
+
+def drop_expired_partitions(connection, cutoff):
+    """
+    Drop partitions whose whole range is older than cutoff. The DEFAULT partition has no range, so its
+    expired rows are deleted instead
+    Returns: (names dropped, rows deleted from the DEFAULT partition)
+    """
+    dropped = []
+    deleted = 0
+    for name, upper in _list_partitions(connection):
+        if upper is None:
+            deleted += connection.execute(
+                text(f"DELETE FROM {name} WHERE \"timestamp\" < :cutoff"), {'cutoff': cutoff}
+            ).rowcount
+        elif upper <= cutoff:
+            connection.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped, deleted
+
+
+def delete_expired_rows(connection, cutoff, batch_size=SQLITE_DELETE_BATCH):
+    """Fallback for databases without partitioning: chunked range DELETE on the timestamp index"""
+    deleted = 0
+    while True:
+        result = connection.execute(text(
+            f"DELETE FROM {PARENT_TABLE} WHERE id IN "
+            f"(SELECT id FROM {PARENT_TABLE} WHERE \"timestamp\" < :cutoff LIMIT :limit)"
+        ), {'cutoff': cutoff, 'limit': batch_size})
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+def ride_location_window(ride):
+    """
+    Timestamp range that contains every ride_location row of a ride. Filtering on it lets Postgres
+    skip partitions outside the ride's lifetime instead of probing each one's index
+    Returns: list of filter conditions for RideLocation queries
+    """
+    from models import RideLocation
+    from utils.tracking import GPS_MAX_POINT_AGE_SECONDS, GPS_MAX_CLOCK_SKEW_SECONDS
+    
+    conditions = []
+    if ride.created_at is not None:
+        # Uploaded points may be up to GPS_MAX_POINT_AGE_SECONDS old when received
+        conditions.append(RideLocation.timestamp >= _naive(ride.created_at) - timedelta(seconds=GPS_MAX_POINT_AGE_SECONDS))
+    finished_at = ride.completed_at or ride.cancelled_at
+    if finished_at is not None and ride.status in ('completed', 'cancelled'):
+        conditions.append(RideLocation.timestamp <= _naive(finished_at) + timedelta(seconds=GPS_MAX_CLOCK_SKEW_SECONDS))
+    return conditions
+
+
+class RideLocationPartitions:
+    """
+    Keeps ride_location storage bounded. On Postgres the table is partitioned by day: partitions are
+    created ahead of time and expired days are dropped whole (no row-level DELETE, no vacuum debt).
+    On other databases expired rows are deleted in chunks instead.
+    Finished rides are compacted into ride_trail before their raw points expire.
+    """
+    
+    def __init__(self, retention_days=RIDE_LOCATION_RETENTION_DAYS, premake_days=RIDE_LOCATION_PREMAKE_DAYS,
+                 interval_seconds=PARTITION_MAINTENANCE_SECONDS):
+        self.retention_days = retention_days
+        self.premake_days = premake_days
+        self.interval_seconds = interval_seconds
+        self.runs = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.rows_deleted = 0
+        self.last_run = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def start(self, app):
+        """Run maintenance now and then every interval_seconds in the background"""
+        if self.interval_seconds <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='ride-location-maintenance', daemon=True)
+            self._thread.start()
+    
+    def _run(self, app):
+        from app import db
+        
+        while True:
+            with app.app_context():
+                try:
+                    self.maintain()
+                except Exception as e:
+                    logging.error(f"Error in ride_location maintenance: {str(e)}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            time.sleep(self.interval_seconds)
+    
+    def maintain(self, today=None):
+        """
+        Compact finished rides whose points are about to expire, create upcoming partitions and
+        drop/delete expired points
+        Returns: summary dict, or None if another worker holds the maintenance lock
+        """
+        from app import db
+        
+        if db.engine.dialect.name != 'postgresql':
+            return self._maintain(today)
+        
+        # Session-level lock on a connection of its own (autocommit, so it holds no transaction open):
+        # compaction commits per ride, which would release a transaction-level lock after the first ride
+        lock_connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            got_lock = lock_connection.execute(
+                text("SELECT pg_try_advisory_lock(:lock_id)"), {'lock_id': PARTITION_MAINTENANCE_LOCK_ID}
+            ).scalar()
+            if not got_lock:
+                return None
+            try:
+                return self._maintain(today)
+            finally:
+                lock_connection.execute(
+                    text("SELECT pg_advisory_unlock(:lock_id)"), {'lock_id': PARTITION_MAINTENANCE_LOCK_ID}
+                )
+        finally:
+            lock_connection.close()
+    
+    def _maintain(self, today):
+        from app import db, get_ist_time
+        from utils.trails import compact_trails
+        
+        started = time.perf_counter()
+        today = today or _today()
+        cutoff = datetime.combine(today - timedelta(days=self.retention_days), datetime.min.time())
+        
+        compacted_rides = 0
+        if self.retention_days > 0:
+            # Keep the route of finished rides before their raw points go (commits per ride)
+            compacted_rides, _ = compact_trails(_naive(get_ist_time()), points_before=cutoff)
+        
+        connection = db.session.connection()
+        partitioned = is_partitioned(connection)
+        created = []
+        dropped = deleted = 0
+        if partitioned:
+            created = ensure_partitions(connection, today - timedelta(days=1), today + timedelta(days=self.premake_days))
+        if self.retention_days > 0:
+            if partitioned:
+                dropped_names, deleted = drop_expired_partitions(connection, cutoff)
+                dropped = len(dropped_names)
+            else:
+                deleted = delete_expired_rows(connection, cutoff)
+        db.session.commit()
+        
+        self.runs += 1
+        self.partitions_created += len(created)
+        self.partitions_dropped += dropped
+        self.rows_deleted += deleted
+        self.last_run = {
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'partitioned': partitioned,
+            'partitions_created': len(created),
+            'partitions_dropped': dropped,
+            'rows_deleted': deleted,
+            'rides_compacted': compacted_rides,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+        if created or dropped or deleted:
+            logging.info(f"ride_location maintenance: {self.last_run}")
+        return self.last_run
+    
+    def stats(self):
+        return {
+            'retention_days': self.retention_days,
+            'premake_days': self.premake_days,
+            'runs': self.runs,
+            'partitions_created': self.partitions_created,
+            'partitions_dropped': self.partitions_dropped,
+            'rows_deleted': self.rows_deleted,
+            'last_run': self.last_run
+        }
+
+
+ride_location_partitions = RideLocationPartitions()
+
+
+def convert_to_partitioned(connection, today):
+    """
+    One-off conversion of an existing plain ride_location table on Postgres. The old table becomes
+    the partition for everything before tomorrow (no rows are copied) and is dropped by retention
+    once all of it has expired; daily partitions take over from tomorrow
+    """
+    tomorrow = today + timedelta(days=1)
+    connection.execute(text(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_PARTITION}"))
+    
+    # The old table keeps its indexes under their names; free every name for the new parent's indexes
+    index_names = connection.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table"
+    ), {'table': LEGACY_PARTITION}).scalars().all()
+    for name in index_names:
+        suffix = name[len(PARENT_TABLE) + 1:] if name.startswith(f"{PARENT_TABLE}_") else name
+        connection.execute(text(f'ALTER INDEX "{name}" RENAME TO "{LEGACY_PARTITION}_{suffix}"'))
+    
+    statements = [
+        # Matching unique index and range check up front so ATTACH does not rescan the table under its lock
+        f"CREATE UNIQUE INDEX {LEGACY_PARTITION}_id_timestamp ON {LEGACY_PARTITION} (id, \"timestamp\")",
+        f"ALTER TABLE {LEGACY_PARTITION} ADD CONSTRAINT {LEGACY_PARTITION}_bound "
+        f"CHECK (\"timestamp\" < '{tomorrow.isoformat()}') NOT VALID",
+        f"ALTER TABLE {LEGACY_PARTITION} VALIDATE CONSTRAINT {LEGACY_PARTITION}_bound",
+    ]
+    for statement in statements:
+        connection.execute(text(statement))
+    
+    # Keep numbering ids from the old sequence
+    _create_parent(connection, id_column=f"id INTEGER NOT NULL DEFAULT nextval('{PARENT_TABLE}_id_seq')")
+    connection.execute(text(f"ALTER SEQUENCE {PARENT_TABLE}_id_seq OWNED BY {PARENT_TABLE}.id"))
+    connection.execute(text(
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {LEGACY_PARTITION} "
+        f"FOR VALUES FROM (MINVALUE) TO ('{tomorrow.isoformat()}')"
+    ))
+    connection.execute(text(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT {LEGACY_PARTITION}_bound"))
+    connection.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+    ensure_partitions(connection, tomorrow, today + timedelta(days=RIDE_LOCATION_PREMAKE_DAYS))
+
+
+@click.command('partition-ride-locations')
+@with_appcontext
+def partition_ride_locations_command():
+    """Convert an existing ride_location table to daily partitions (Postgres, run in a maintenance window)"""
+    from app import db
+    
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        click.echo("Partitioning needs Postgres; this database keeps the plain table with row-level retention")
+        return
+    if is_partitioned(connection):
+        click.echo("ride_location is already partitioned")
+        return
+    
+    started = time.perf_counter()
+    convert_to_partitioned(connection, _today())
+    db.session.commit()
+    click.echo(f"ride_location partitioned by day in {time.perf_counter() - started:.1f}s")
+
+
+@click.command('maintain-ride-locations')
+@with_appcontext
+def maintain_ride_locations_command():
+    """Create upcoming ride_location partitions and apply the retention policy now"""
+    summary = ride_location_partitions.maintain()
+    if summary is None:
+        click.echo("Another worker is running maintenance")
+    else:
+        click.echo(f"ride_location maintenance: {summary}")
@@ -0,0 +1,27 @@
+from collections import namedtuple
+from sqlalchemy import select
+
+
+class Projection:
+    """
+    Read-only rows for list endpoints: SELECT only the named columns and wrap each result row in a
+    namedtuple. No ORM instances are built and nothing is added to the session's identity map, so a
+    page costs the columns it shows rather than full Ride objects.
+    
+    Fields are keyword arguments, field name -> column expression, e.g.
+        Projection('RideRow', ride_id=Ride.id, driver_name=Driver.name)
+    """
+    
+    def __init__(self, name, **columns):
+        self.record = namedtuple(name, columns.keys())
+        self.columns = [column.label(field) for field, column in columns.items()]
+    
+    def select(self):
+        """SELECT of the projected columns; add joins, filters, ordering and limits to it"""
+        return select(*self.columns)
+    
+    def all(self, statement):
+        """Run statement (built from select()) and return its rows as records"""
+        from app import db
+        
+        return list(map(self.record._make, db.session.execute(statement)))
@@ -0,0 +1,121 @@
+import os
+import heapq
+import threading
+import time
+import logging
+from types import SimpleNamespace
+from utils.geo_index import GridIndex
+from utils.events import event_bus
+
+# Each worker keeps its own copy, updated from ride events of every worker (see utils/events.py).
+# Events missed while the bus was down are picked up by the next refresh; stale entries are
+# harmless because incoming_rides re-checks status in the database
+RIDE_INDEX_REFRESH_SECONDS = float(os.environ.get("RIDE_INDEX_REFRESH_SECONDS", 30))
+
+
+class PendingRideIndex:
+    """Pending rides keyed by pickup grid cell, partitioned by ride_type"""
+    
+    def __init__(self, cell_size_deg=0.01, refresh_seconds=RIDE_INDEX_REFRESH_SECONDS):
+        self.grid = GridIndex(cell_size_deg)
+        self.refresh_seconds = refresh_seconds
+        self.loaded_at = None
+        # Rides booked by address only cannot be placed on the grid
+        self._unlocated = {}    # ride_type -> set of ride_ids
+        self._lock = threading.Lock()
+    
+    def add(self, ride):
+        """Index a ride if it is pending and unassigned, otherwise drop it"""
+        if ride.status != 'pending' or ride.driver_id is not None or not ride.ride_type:
+            self.remove(ride.id)
+            return
+        
+        with self._lock:
+            if ride.pickup_lat is not None and ride.pickup_lng is not None:
+                self._drop_unlocated(ride.id)
+                self.grid.upsert(ride.ride_type, ride.id, ride.pickup_lat, ride.pickup_lng)
+            else:
+                self.grid.remove(ride.id)
+                self._unlocated.setdefault(ride.ride_type, set()).add(ride.id)
+    
+    def remove(self, ride_id):
+        with self._lock:
+            self.grid.remove(ride_id)
+            self._drop_unlocated(ride_id)
+    
+    def _drop_unlocated(self, ride_id):
+        for ride_ids in self._unlocated.values():
+            ride_ids.discard(ride_id)
+    
+    def clear(self):
+        with self._lock:
+            self.grid.clear()
+            self._unlocated.clear()
+    
+    def load(self):
+        """Rebuild from the database (requires app context)"""
+        from app import db
+        from models import Ride
+        
+        rides = db.session.query(Ride.id, Ride.ride_type, Ride.pickup_lat, Ride.pickup_lng).filter(
+            Ride.status == 'pending',
+            Ride.driver_id.is_(None)
+        ).all()
+        
+        with self._lock:
+            self.grid.clear()
+            self._unlocated.clear()
+            for ride_id, ride_type, pickup_lat, pickup_lng in rides:
+                if not ride_type:
+                    continue
+                if pickup_lat is not None and pickup_lng is not None:
+                    self.grid.upsert(ride_type, ride_id, pickup_lat, pickup_lng)
+                else:
+                    self._unlocated.setdefault(ride_type, set()).add(ride_id)
+            self.loaded_at = time.time()
+        
+        logging.debug(f"Pending ride index loaded with {len(rides)} rides")
+    
+    def ensure_fresh(self):
+        if self.loaded_at is None or time.time() - self.loaded_at >= self.refresh_seconds:
+            self.load()
+    
+    def nearby(self, ride_type, lat, lng, radius_km, limit=None):
+        """
+        Pending ride ids of a ride_type within radius_km of the driver, nearest first,
+        followed by address-only rides (newest first) that cannot be placed on the map,
+        at most limit in all
+        Returns: list of (distance_km or None, ride_id)
+        """
+        self.ensure_fresh()
+        results = self.grid.nearby(ride_type, lat, lng, radius_km, limit)
+        
+        slots = None if limit is None else limit - len(results)
+        if slots is None or slots > 0:
+            with self._lock:
+                unlocated = list(self._unlocated.get(ride_type, ()))
+            unlocated = sorted(unlocated, reverse=True) if slots is None else heapq.nlargest(slots, unlocated)
+            results.extend((None, ride_id) for ride_id in unlocated)
+        return results
+    
+    def __len__(self):
+        return len(self.grid) + sum(len(ride_ids) for ride_ids in self._unlocated.values())
+
+
+pending_ride_index = PendingRideIndex()
+
+
+def on_ride_event(topic, payload):
+    """Rides booked or back in the pool are indexed, rides that leave the pool are dropped"""
+    ride = payload['ride']
+    pending_ride_index.add(SimpleNamespace(
+        id=ride['id'],
+        status=ride['status'],
+        driver_id=payload.get('driver_id'),
+        ride_type=ride['ride_type'],
+        pickup_lat=ride['pickup_lat'],
+        pickup_lng=ride['pickup_lng']
+    ))
+
+
+event_bus.subscribe('ride.', on_ride_event)
@@ -0,0 +1,78 @@
+from collections import namedtuple
+from sqlalchemy import select, update
+from sqlalchemy.orm import aliased
+from utils.events import publish_ride_event
+
+# to_status: Ride.status afterwards; from_statuses: where the move is allowed from
+# timestamp: column set to the time of the move; clears: columns reset to NULL
+# event: ride.<event> published with the change
+Transition = namedtuple('Transition', ['to_status', 'from_statuses', 'timestamp', 'clears', 'event'])
+
+TRANSITIONS = {
+    'accept': Transition('accepted', ('pending',), 'accepted_at', (), 'accepted'),
+    'arrive': Transition('arrived', ('accepted',), 'arrived_at', (), 'arrived'),
+    'start': Transition('started', ('arrived',), 'started_at', (), 'started'),
+    'complete': Transition('completed', ('started',), 'completed_at', (), 'completed'),
+    # Driver backs out before the trip starts: the ride goes back to the pending pool
+    'requeue': Transition('pending', ('accepted', 'arrived'), None, ('driver_id', 'accepted_at', 'arrived_at'), 'requeued'),
+    # Customers can cancel until the driver has arrived
+    'cancel': Transition('cancelled', ('pending', 'accepted'), 'cancelled_at', (), 'cancelled'),
+    # Admins can cancel any unfinished ride
+    'force_cancel': Transition('cancelled', ('pending', 'accepted', 'arrived', 'started'), 'cancelled_at', (), 'cancelled'),
+}
+
+
+def apply_transition(name, ride_id=None, conditions=(), values=None, event_data=None, now=None, **filters):
+    """
+    Move one ride along a TRANSITIONS edge with a single guarded UPDATE (no commit) and publish its
+    ride event. The status guard is part of the UPDATE, so of two concurrent moves on the same ride
+    only the first applies; the other matches no row.
+    
+    The ride is picked by ride_id, or as the first ride matching filters (column=value, e.g.
+    driver_id=3) whose status allows the move. conditions are extra WHERE clauses on Ride, values
+    extra columns to set, event_data extra fields for the event payload (or a function of the
+    updated ride returning them).
+    Returns: the updated Ride (RETURNING where the database supports it), or None if no ride could move
+    """
+    from app import db, get_ist_time
+    from models import Ride
+    
+    transition = TRANSITIONS[name]
+    changes = {'status': transition.to_status}
+    if transition.timestamp:
+        changes[transition.timestamp] = now or get_ist_time()
+    changes.update({column: None for column in transition.clears})
+    changes.update(values or {})
+    
+    if ride_id is None:
+        candidate = aliased(Ride)
+        target = select(candidate.id).where(
+            candidate.status.in_(transition.from_statuses),
+            *[getattr(candidate, column) == value for column, value in filters.items()]
+        ).order_by(candidate.id).limit(1)
+        if db.engine.dialect.update_returning:
+            ride_id = target.scalar_subquery()
+        else:
+            ride_id = db.session.execute(target).scalar()
+            if ride_id is None:
+                return None
+    
+    statement = update(Ride).where(
+        Ride.id == ride_id,
+        Ride.status.in_(transition.from_statuses),
+        *conditions
+    ).values(**changes)
+    
+    if db.engine.dialect.update_returning:
+        ride = db.session.scalars(
+            statement.returning(Ride).execution_options(populate_existing=True)
+        ).first()
+    else:
+        result = db.session.execute(statement.execution_options(synchronize_session=False))
+        ride = db.session.get(Ride, ride_id, populate_existing=True) if result.rowcount == 1 else None
+    
+    if ride is not None:
+        if callable(event_data):
+            event_data = event_data(ride)
+        publish_ride_event(transition.event, ride, **(event_data or {}))
+    return ride
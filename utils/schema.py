@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+# create_all() only creates missing tables, so indexes declared on existing tables have to be added
+# with `flask create-indexes`, which builds them CONCURRENTLY on Postgres. Set this to true to build
+# them at startup instead (small/dev databases only: every worker runs a write-blocking CREATE INDEX)
+SCHEMA_AUTO_INDEXES = os.environ.get("SCHEMA_AUTO_INDEXES", "false").lower() == "true"
+
+
+def _applies_to(index, dialect_name):
+    """Indexes declared with .ddl_if(dialect=...) only exist on that database"""
+    ddl_if = index._ddl_if
+    return ddl_if is None or ddl_if.dialect is None or ddl_if.dialect == dialect_name
+
+
+def missing_indexes(connection):
+    """Indexes declared in models.py that the database does not have yet (tables that exist only)"""
+    from app import db
+    
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(
+            index for index in sorted(table.indexes, key=lambda index: index.name)
+            if index.name not in existing and _applies_to(index, connection.dialect.name)
+        )
+    return missing
+
+
+def report_missing_indexes():
+    """Log the declared indexes the database lacks; a missing unique index is an error (its guard is off)"""
+    from app import db
+    
+    with db.engine.connect() as connection:
+        indexes = missing_indexes(connection)
+        connection.rollback()
+    
+    for index in indexes:
+        if index.unique:
+            logging.error(f"Unique index {index.name} on {index.table.name} is missing and not enforced - run `flask create-indexes`")
+        else:
+            logging.warning(f"Index {index.name} on {index.table.name} is missing - run `flask create-indexes`")
+    return [index.name for index in indexes]
+
+
+def create_index(connection, index, concurrently=False):
+    """CREATE INDEX IF NOT EXISTS; concurrently builds it without blocking writes (Postgres, outside a transaction)"""
+    options = index.dialect_options['postgresql']
+    previous = options['concurrently']
+    options['concurrently'] = concurrently and connection.dialect.name == 'postgresql'
+    try:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+    finally:
+        options['concurrently'] = previous
+
+
+def ensure_indexes(concurrently=False):
+    """
+    Create every missing declared index, each on its own. An index that cannot be built is logged
+    and skipped - as an error for a unique index (e.g. over rows that violate it), whose guard stays off
+    Returns: (names created, names failed)
+    """
+    from app import db
+    
+    created, failed = [], []
+    with db.engine.connect() as connection:
+        indexes = missing_indexes(connection)
+        connection.rollback()
+    
+    for index in indexes:
+        started = time.perf_counter()
+        try:
+            if concurrently and db.engine.dialect.name == 'postgresql':
+                with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    create_index(connection, index, concurrently=True)
+            else:
+                with db.engine.begin() as connection:
+                    create_index(connection, index)
+        except Exception as e:
+            failed.append(index.name)
+            if index.unique:
+                logging.error(f"Could not create unique index {index.name} on {index.table.name}, it is not enforced: {str(e)}")
+            else:
+                logging.warning(f"Could not create index {index.name} on {index.table.name}: {str(e)}")
+            if concurrently and db.engine.dialect.name == 'postgresql':
+                # A failed concurrent build leaves an INVALID index behind; drop it so the next run retries
+                with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+            continue
+        created.append(index.name)
+        logging.info(f"Created index {index.name} on {index.table.name} in {time.perf_counter() - started:.1f}s")
+    return created, failed
+
+
+@click.command('create-indexes')
+@click.option('--dry-run', is_flag=True, help="Only list the missing indexes")
+@with_appcontext
+def create_indexes_command(dry_run):
+    """Add indexes declared in models.py to existing tables (CONCURRENTLY on Postgres)"""
+    from app import db
+    
+    if dry_run:
+        with db.engine.connect() as connection:
+            for index in missing_indexes(connection):
+                click.echo(f"{index.table.name}.{index.name}: {CreateIndex(index).compile(dialect=connection.dialect)}")
+        return
+    
+    started = time.perf_counter()
+    created, failed = ensure_indexes(concurrently=True)
+    click.echo(f"Created {len(created)} indexes in {time.perf_counter() - started:.1f}s")
+    if failed:
+        raise click.ClickException(f"Could not create: {', '.join(failed)} (see the log; fix the offending rows and run again)")
@@ -0,0 +1,81 @@
+import os
+import time
+import logging
+import threading
+from datetime import timedelta
+
+# Dashboard counts are recomputed at most this often per worker, however many admin tabs poll
+ADMIN_STATS_TTL_SECONDS = float(os.environ.get("ADMIN_STATS_TTL_SECONDS", 10))
+
+ACTIVE_RIDE_STATUSES = ('accepted', 'arrived', 'started')
+
+
+def compute_dashboard_stats():
+    """
+    Dashboard counts in two statements: rides per status in one GROUP BY pass, and customers,
+    drivers and today's rides as scalar subqueries. Today is an IST created_at range so
+    ix_ride_created_at serves it (func.date() on the column cannot use an index)
+    """
+    from app import db, get_ist_time
+    from models import Customer, Driver, Ride
+    
+    by_status = dict(db.session.query(Ride.status, db.func.count()).group_by(Ride.status).all())
+    
+    today_start = get_ist_time().replace(hour=0, minute=0, second=0, microsecond=0)
+    today_end = today_start + timedelta(days=1)
+    totals = db.session.query(
+        db.session.query(db.func.count(Customer.id)).scalar_subquery(),
+        db.session.query(db.func.count(Driver.id)).scalar_subquery(),
+        db.session.query(db.func.count(Ride.id)).filter(
+            Ride.created_at >= today_start, Ride.created_at < today_end
+        ).scalar_subquery()
+    ).one()
+    
+    return {
+        'total_customers': totals[0],
+        'total_drivers': totals[1],
+        'total_rides': sum(by_status.values()),
+        'today_rides': totals[2],
+        'pending_rides': by_status.get('pending', 0),
+        'active_rides': sum(by_status.get(status, 0) for status in ACTIVE_RIDE_STATUSES),
+        'completed_rides': by_status.get('completed', 0),
+        'cancelled_rides': by_status.get('cancelled', 0),
+    }
+
+
+class DashboardStatsCache:
+    """
+    Short-TTL copy of compute_dashboard_stats() shared by the dashboard page and /admin/api/stats.
+    One thread recomputes an expired entry; concurrent requests wait for it instead of each running
+    the counts.
+    """
+    
+    def __init__(self, ttl_seconds=ADMIN_STATS_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._value = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self):
+        """Current counts (requires app context)"""
+        if self._value is not None and time.time() < self._expires_at:
+            return dict(self._value)
+        
+        with self._lock:
+            if self._value is not None and time.time() < self._expires_at:
+                return dict(self._value)
+            
+            started = time.perf_counter()
+            value = compute_dashboard_stats()
+            logging.debug(f"Dashboard stats computed in {(time.perf_counter() - started) * 1000:.1f}ms")
+            self._value = value
+            self._expires_at = time.time() + self.ttl_seconds
+            return dict(value)
+    
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._expires_at = 0.0
+
+
+dashboard_stats = DashboardStatsCache()
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import queue
+import threading
+from utils.events import event_bus
+
+# Comment line sent when nothing happened so proxies keep the connection open and dead clients are noticed
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get("STREAM_HEARTBEAT_SECONDS", 15))
+# Streams are closed after this long; EventSource reconnects on its own
+STREAM_MAX_SECONDS = float(os.environ.get("STREAM_MAX_SECONDS", 900))
+# Events waiting per subscriber. A slow client loses its oldest events rather than growing the queue
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 100))
+# Client reconnect delay sent with the first message
+STREAM_RETRY_MS = 3000
+
+FINISHED_RIDE_STATUSES = ('completed', 'cancelled')
+
+
+def format_sse(event, data):
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class StreamHub:
+    """
+    Per-worker fan-out of events to streaming clients. Each subscriber owns a bounded queue;
+    publish() puts the event on every queue of the key without touching the database.
+    """
+    
+    def __init__(self, name, queue_size=STREAM_QUEUE_SIZE):
+        self.name = name
+        self.queue_size = queue_size
+        self._subscribers = {}     # key -> set of queue.Queue
+        self._lock = threading.Lock()
+        
+        self.connections = 0
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+    
+    def subscribe(self, key, subscriber=None):
+        """Queue receiving the events of key. Pass an existing subscriber to add another key to it"""
+        with self._lock:
+            if subscriber is None:
+                subscriber = queue.Queue(maxsize=self.queue_size)
+                self.connections += 1
+            self._subscribers.setdefault(key, set()).add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, key, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[key]
+    
+    def publish(self, key, event, data):
+        """Queue an event for every subscriber of key. Returns the number of subscribers reached"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+            self.published += 1
+        
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # Make room by dropping the oldest event; positions are superseded by newer ones anyway
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait((event, data))
+                except (queue.Empty, queue.Full):
+                    pass
+                self.dropped += 1
+        self.delivered += len(subscribers)
+        return len(subscribers)
+    
+    def subscriber_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._subscribers.get(key, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+    
+    def stream(self, keys, subscriber, initial_events=(), is_final=None, accept=None,
+               heartbeat_seconds=STREAM_HEARTBEAT_SECONDS, max_seconds=STREAM_MAX_SECONDS):
+        """
+        Generator of SSE text for a subscriber from subscribe(). Sends initial_events first, then
+        everything published for keys until is_final(event, data) is true or max_seconds pass.
+        accept(event, data) can filter out events meant for other subscribers of the same key
+        """
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            for event, data in initial_events:
+                yield format_sse(event, data)
+                if is_final and is_final(event, data):
+                    return
+            
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event, data = subscriber.get(timeout=min(heartbeat_seconds, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if accept and not accept(event, data):
+                    continue
+                yield format_sse(event, data)
+                if is_final and is_final(event, data):
+                    return
+        finally:
+            for key in keys:
+                self.unsubscribe(key, subscriber)
+    
+    def stats(self):
+        with self._lock:
+            keys = len(self._subscribers)
+            subscribers = sum(len(subscribers) for subscribers in self._subscribers.values())
+        return {
+            'keys': keys,
+            'subscribers': subscribers,
+            'connections': self.connections,
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped
+        }
+
+
+ride_stream_hub = StreamHub('ride')
+# Drivers subscribe to their vehicle type (open rides) and to themselves (offers, rejections)
+offer_stream_hub = StreamHub('offers')
+
+
+def location_event(ride_id, latitude, longitude, timestamp):
+    return {
+        'ride_id': ride_id,
+        'latitude': latitude,
+        'longitude': longitude,
+        'timestamp': timestamp.isoformat() if hasattr(timestamp, 'isoformat') else timestamp
+    }
+
+
+def is_ride_finished(event, data):
+    return event == 'status' and data.get('status') in FINISHED_RIDE_STATUSES
+
+
+def ride_type_key(ride_type):
+    return f"type:{ride_type}"
+
+
+def driver_key(driver_id):
+    return f"driver:{driver_id}"
+
+
+def is_driver_offline(event, data):
+    return event == 'offline'
+
+
+# Event bus handlers: every worker pushes to the clients connected to it, whichever worker made the change
+
+def on_ride_event(topic, payload):
+    """Status to the ride's subscribers; rides entering or leaving the pool to drivers of its type"""
+    ride = payload['ride']
+    action = topic.split('.', 1)[1]
+    ride_stream_hub.publish(ride['id'], 'status', ride)
+    
+    type_key = ride_type_key(ride['ride_type'])
+    if action in ('created', 'requeued'):
+        # Rides handled by nearest-driver dispatch reach drivers as offers instead
+        if payload.get('broadcast', True):
+            offer_stream_hub.publish(type_key, 'ride_added', ride)
+    elif action in ('accepted', 'cancelled'):
+        offer_stream_hub.publish(type_key, 'ride_removed', {'ride_id': ride['id'], 'reason': action})
+
+
+def on_location_event(topic, payload):
+    ride_stream_hub.publish(payload['ride_id'], 'location', payload)
+
+
+def on_offer_event(topic, payload):
+    """Targeted offers from nearest-driver dispatch, and rides gone for one driver (rejected, expired)"""
+    if topic == 'offer.created':
+        ride = payload['ride']
+        for driver_id, distance_km, expires_at in payload['offers']:
+            offer_stream_hub.publish(driver_key(driver_id), 'ride_added', dict(
+                ride, distance_to_pickup_km=distance_km, offer_expires_at=expires_at
+            ))
+    elif topic == 'offer.removed':
+        offer_stream_hub.publish(driver_key(payload['driver_id']), 'ride_removed', {
+            'ride_id': payload['ride_id'],
+            'reason': payload['reason']
+        })
+
+
+def on_driver_event(topic, payload):
+    if topic == 'driver.offline':
+        offer_stream_hub.publish(driver_key(payload['driver_id']), 'offline', payload)
+
+
+event_bus.subscribe('ride.', on_ride_event)
+event_bus.subscribe('location.', on_location_event)
+event_bus.subscribe('offer.', on_offer_event)
+event_bus.subscribe('driver.', on_driver_event)
+
+
+def get_stream_stats():
+    """Streaming connection statistics for this worker"""
+    return {
+        'rides': ride_stream_hub.stats(),
+        'offers': offer_stream_hub.stats(),
+        'heartbeat_seconds': STREAM_HEARTBEAT_SECONDS,
+        'max_seconds': STREAM_MAX_SECONDS
+    }
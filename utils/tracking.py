@@ -0,0 +1,307 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from utils.estimator import haversine_km
+
+GPS_BATCH_MAX_POINTS = int(os.environ.get("GPS_BATCH_MAX_POINTS", 1000))
+# Client clocks drift; points claiming to be from the future or older than this are dropped
+GPS_MAX_CLOCK_SKEW_SECONDS = float(os.environ.get("GPS_MAX_CLOCK_SKEW_SECONDS", 300))
+GPS_MAX_POINT_AGE_SECONDS = float(os.environ.get("GPS_MAX_POINT_AGE_SECONDS", 86400))
+
+# History rows are skipped while the driver has moved less than this since the last stored point
+# and the last stored point is younger than GPS_MIN_INTERVAL_SECONDS (0 meters = store everything)
+GPS_MIN_MOVE_METERS = float(os.environ.get("GPS_MIN_MOVE_METERS", 10))
+GPS_MIN_INTERVAL_SECONDS = float(os.environ.get("GPS_MIN_INTERVAL_SECONDS", 30))
+
+# Rides not heard from for this long are forgotten by the movement filter
+FILTER_RETENTION_SECONDS = 3600
+
+LocationPoint = namedtuple('LocationPoint', ['latitude', 'longitude', 'timestamp'])
+
+
+def naive_timestamp(timestamp):
+    """Stored DateTime columns come back without tzinfo"""
+    return timestamp.replace(tzinfo=None) if timestamp.tzinfo is not None else timestamp
+
+
+def _upsert_insert(model):
+    """Dialect INSERT supporting ON CONFLICT, or None when the database has no upsert"""
+    from app import db
+    
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    if dialect == 'sqlite':
+        return sqlite.insert(model)
+    return None
+
+
+def upsert_latest_location(ride_id, latitude, longitude, timestamp):
+    """
+    Insert or overwrite the latest position of a ride in a single statement (caller commits)
+    A point older than the stored one (late delivery) leaves the stored one in place
+    """
+    from app import db, get_ist_time
+    from models import RideLatestLocation
+    
+    values = {
+        'ride_id': ride_id,
+        'latitude': latitude,
+        'longitude': longitude,
+        'timestamp': timestamp,
+        'updated_at': get_ist_time()
+    }
+    
+    insert = _upsert_insert(RideLatestLocation)
+    if insert is None:
+        # No ON CONFLICT support: read-modify-write
+        latest = db.session.get(RideLatestLocation, ride_id)
+        if latest is None:
+            db.session.add(RideLatestLocation(**values))
+        elif naive_timestamp(latest.timestamp) <= naive_timestamp(timestamp):
+            for key, value in values.items():
+                setattr(latest, key, value)
+        return
+    
+    stmt = insert.values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['ride_id'],
+        set_={
+            'latitude': stmt.excluded.latitude,
+            'longitude': stmt.excluded.longitude,
+            'timestamp': stmt.excluded.timestamp,
+            'updated_at': stmt.excluded.updated_at
+        },
+        where=RideLatestLocation.timestamp <= stmt.excluded.timestamp
+    )
+    db.session.execute(stmt)
+
+
+class MovementFilter:
+    """
+    Decides which GPS points are worth a history row. A point within min_move_meters of the ride's
+    last stored point and less than min_interval_seconds after it is skipped - the latest position
+    is refreshed either way, so the customer's map does not change.
+    
+    State is per worker: the first point of a ride a worker sees is always stored
+    """
+    
+    def __init__(self, min_move_meters=GPS_MIN_MOVE_METERS, min_interval_seconds=GPS_MIN_INTERVAL_SECONDS):
+        self.min_move_meters = min_move_meters
+        self.min_interval_seconds = min_interval_seconds
+        self._last_stored = {}  # ride_id -> (lat, lng, epoch_seconds, time.time() of last use)
+        self._lock = threading.Lock()
+        self._calls = 0
+        self.stored = 0
+        self.skipped = 0
+    
+    @property
+    def enabled(self):
+        return self.min_move_meters > 0
+    
+    def select(self, ride_id, latitudes, longitudes, epoch_seconds):
+        """
+        Points of one ride (oldest first) that should be stored
+        Returns: boolean numpy mask
+        """
+        count = len(latitudes)
+        if not self.enabled:
+            return np.ones(count, dtype=bool)
+        
+        keep = np.zeros(count, dtype=bool)
+        with self._lock:
+            last = self._last_stored.get(ride_id)
+            # Each decision depends on the previous stored point, so this walks the batch in order
+            for i in range(count):
+                if last is not None:
+                    moved_meters = haversine_km(last[0], last[1], latitudes[i], longitudes[i]) * 1000
+                    if moved_meters < self.min_move_meters and epoch_seconds[i] - last[2] < self.min_interval_seconds:
+                        continue
+                keep[i] = True
+                last = (float(latitudes[i]), float(longitudes[i]), float(epoch_seconds[i]))
+            
+            if last is not None:
+                self._last_stored[ride_id] = (last[0], last[1], last[2], time.time())
+            
+            stored = int(keep.sum())
+            self.stored += stored
+            self.skipped += count - stored
+            
+            self._calls += 1
+            if self._calls % 1000 == 0:
+                self._prune()
+        return keep
+    
+    def forget(self, ride_id):
+        with self._lock:
+            self._last_stored.pop(ride_id, None)
+    
+    def _prune(self):
+        cutoff = time.time() - FILTER_RETENTION_SECONDS
+        for ride_id in [ride_id for ride_id, entry in self._last_stored.items() if entry[3] < cutoff]:
+            del self._last_stored[ride_id]
+    
+    def stats(self):
+        total = self.stored + self.skipped
+        return {
+            'min_move_meters': self.min_move_meters,
+            'min_interval_seconds': self.min_interval_seconds,
+            'stored': self.stored,
+            'skipped': self.skipped,
+            'skip_rate': round(self.skipped / total, 4) if total else None,
+            'tracked_rides': len(self._last_stored)
+        }
+
+
+movement_filter = MovementFilter()
+
+
+def record_location(ride_id, latitude, longitude, timestamp=None):
+    """
+    Append a GPS point to the ride history (unless the movement filter skips it) and refresh the
+    latest position (caller commits). Constant work per ping, regardless of how long the ride is
+    With GPS_INGEST_MODE=write_behind the point is queued instead and nothing touches the session
+    Returns: LocationPoint
+    """
+    from app import db, get_ist_time
+    from models import RideLocation
+    from utils.gps_buffer import gps_buffer
+    
+    timestamp = timestamp or get_ist_time()
+    store = bool(movement_filter.select(ride_id, [latitude], [longitude], [timestamp.timestamp()])[0])
+    
+    if gps_buffer.enabled:
+        gps_buffer.add_many(ride_id, [(latitude, longitude, timestamp)], [store])
+    else:
+        if store:
+            db.session.add(RideLocation(ride_id=ride_id, latitude=latitude, longitude=longitude, timestamp=timestamp))
+        upsert_latest_location(ride_id, latitude, longitude, timestamp)
+    return LocationPoint(latitude, longitude, timestamp)
+
+
+def get_latest_location(ride_id):
+    """
+    Latest position of a ride: this worker's write-behind buffer first, then the primary key lookup
+    Returns: LocationPoint, RideLatestLocation or None
+    """
+    from app import db
+    from models import RideLatestLocation
+    from utils.gps_buffer import gps_buffer
+    
+    if gps_buffer.enabled:
+        buffered = gps_buffer.latest(ride_id)
+        if buffered is not None:
+            return buffered
+    return db.session.get(RideLatestLocation, ride_id)
+
+
+def _epoch_seconds(value):
+    """Client timestamp (epoch seconds, epoch milliseconds or ISO 8601) as epoch seconds, NaN if unusable"""
+    if isinstance(value, bool) or value is None:
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return np.nan
+        if parsed.tzinfo is None:
+            from app import IST
+            parsed = IST.localize(parsed)
+        return parsed.timestamp()
+    return np.nan
+
+
+def _coordinate(value):
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_points(points, now=None):
+    """
+    Validate a batch of {lat, lng, ts} points with vectorized checks
+    Returns: (latitudes, longitudes, epoch_seconds, rejected_count), valid points sorted by time
+    """
+    now = now if now is not None else datetime.now().timestamp()
+    
+    rows = [point if isinstance(point, dict) else {} for point in points]
+    latitudes = np.array([_coordinate(row.get('lat')) for row in rows], dtype=float)
+    longitudes = np.array([_coordinate(row.get('lng')) for row in rows], dtype=float)
+    timestamps = np.array([_epoch_seconds(row.get('ts')) for row in rows], dtype=float)
+    
+    # Epoch milliseconds (Android/JS clocks) to seconds
+    timestamps = np.where(timestamps > 1e11, timestamps / 1000.0, timestamps)
+    
+    valid = (
+        np.isfinite(latitudes) & np.isfinite(longitudes) & np.isfinite(timestamps)
+        & (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+        & ~((latitudes == 0) & (longitudes == 0))   # GPS fix not acquired yet
+        & (timestamps <= now + GPS_MAX_CLOCK_SKEW_SECONDS)
+        & (timestamps >= now - GPS_MAX_POINT_AGE_SECONDS)
+    )
+    
+    order = np.argsort(timestamps[valid], kind='stable')
+    return (
+        latitudes[valid][order],
+        longitudes[valid][order],
+        timestamps[valid][order],
+        int(len(rows) - valid.sum())
+    )
+
+
+def record_locations(ride_id, latitudes, longitudes, epoch_seconds):
+    """
+    Bulk-append GPS points that pass the movement filter to the ride history in one INSERT and move
+    the latest position to the newest point (caller commits), or queue them with GPS_INGEST_MODE=write_behind
+    Returns: ((latitude, longitude, timestamp) of the newest point, history rows written, history rows
+    queued for the write-behind buffer), or None for an empty batch
+    """
+    from app import db, IST
+    from models import RideLocation
+    from utils.gps_buffer import gps_buffer
+    
+    if len(latitudes) == 0:
+        return None
+    
+    timestamps = [datetime.fromtimestamp(float(ts), IST) for ts in epoch_seconds]
+    newest = int(np.argmax(epoch_seconds))
+    latest = (float(latitudes[newest]), float(longitudes[newest]), timestamps[newest])
+    store = movement_filter.select(ride_id, latitudes, longitudes, epoch_seconds)
+    
+    if gps_buffer.enabled:
+        dropped = gps_buffer.add_many(ride_id, [
+            (float(lat), float(lng), timestamp) for lat, lng, timestamp in zip(latitudes, longitudes, timestamps)
+        ], store.tolist())
+        # A full buffer drops the rest of the batch
+        return latest, 0, int(store[:len(store) - dropped].sum())
+    
+    rows = [
+        {'ride_id': ride_id, 'latitude': float(latitudes[i]), 'longitude': float(longitudes[i]), 'timestamp': timestamps[i], 'is_latest': False}
+        for i in np.flatnonzero(store)
+    ]
+    if rows:
+        db.session.execute(insert(RideLocation), rows)
+    upsert_latest_location(ride_id, *latest)
+    return latest, len(rows), 0
+
+
+def get_gps_stats():
+    """GPS ingestion statistics for this worker"""
+    from utils.gps_buffer import gps_buffer
+    from utils.partitions import ride_location_partitions
+    
+    return {
+        'buffer': gps_buffer.stats(),
+        'movement_filter': movement_filter.stats(),
+        'storage': ride_location_partitions.stats()
+    }
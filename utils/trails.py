@@ -0,0 +1,287 @@
+import os
+import time
+import logging
+from datetime import timedelta
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from utils.estimator import EARTH_RADIUS_KM
+
+# Points closer than this to the simplified line are dropped (GPS noise is ~5-10m anyway)
+TRAIL_TOLERANCE_METERS = float(os.environ.get("TRAIL_TOLERANCE_METERS", 5))
+# Compact as soon as a ride completes or is cancelled (otherwise only via `flask compact-trails`)
+TRAIL_COMPACT_ON_FINISH = os.environ.get("TRAIL_COMPACT_ON_FINISH", "true").lower() == "true"
+
+FINISHED_RIDE_STATUSES = ('completed', 'cancelled')
+
+
+def _project(latitudes, longitudes):
+    """Local equirectangular projection to meters (accurate at city scale). Returns: (x, y) arrays"""
+    meters_per_radian = EARTH_RADIUS_KM * 1000
+    y = np.radians(latitudes) * meters_per_radian
+    x = np.radians(longitudes) * meters_per_radian * np.cos(np.radians(latitudes.mean()))
+    return x, y
+
+
+def simplify_trail(latitudes, longitudes, tolerance_meters=TRAIL_TOLERANCE_METERS):
+    """
+    Douglas-Peucker simplification. Distances of all points in a segment to its chord (the segment
+    between its ends, not the line through them, so out-and-back legs survive) are computed in one
+    vectorized step on a local equirectangular projection (accurate at city scale)
+    Returns: boolean numpy mask of points to keep (first and last always kept)
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    count = len(latitudes)
+    keep = np.zeros(count, dtype=bool)
+    if count == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    if count < 3:
+        return keep
+    
+    x, y = _project(latitudes, longitudes)
+    
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        px = x[start + 1:end] - x[start]
+        py = y[start + 1:end] - y[start]
+        chord_squared = dx * dx + dy * dy
+        if chord_squared == 0:
+            # Closed loop (returned to the start): distance to the point itself
+            distances = np.hypot(px, py)
+        else:
+            # Nearest point of the chord segment: its projection, clamped to the ends
+            t = np.clip((px * dx + py * dy) / chord_squared, 0, 1)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_meters:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    
+    return keep
+
+
+def spread_timestamps(points, started_at, ended_at):
+    """
+    Approximate times for the points of a stored trail, which keeps only its first and last
+    timestamp: spread between them by distance travelled (constant speed)
+    """
+    if len(points) < 2:
+        return [started_at] * len(points)
+    latitudes, longitudes = np.asarray(points, dtype=float).T
+    x, y = _project(latitudes, longitudes)
+    travelled = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    if travelled[-1] > 0:
+        fractions = travelled / travelled[-1]
+    else:
+        fractions = np.linspace(0, 1, len(points))
+    return [started_at + (ended_at - started_at) * float(fraction) for fraction in fractions]
+
+
+def encode_polyline(points, precision=5):
+    """Google encoded polyline for a sequence of (lat, lng)"""
+    factor = 10 ** precision
+    encoded = []
+    previous_lat = previous_lng = 0
+    for lat, lng in points:
+        lat_e5 = int(round(lat * factor))
+        lng_e5 = int(round(lng * factor))
+        for delta in (lat_e5 - previous_lat, lng_e5 - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous_lat, previous_lng = lat_e5, lng_e5
+    return ''.join(encoded)
+
+
+def decode_polyline(encoded, precision=5):
+    """Inverse of encode_polyline. Returns list of (lat, lng)"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            result = shift = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+def compact_ride_trail(ride_id, tolerance_meters=TRAIL_TOLERANCE_METERS):
+    """
+    Replace a finished ride's ride_location rows with one simplified, encoded RideTrail (commits).
+    Running it again merges rows that arrived after the previous compaction
+    Returns: RideTrail, or None if the ride has no raw points
+    """
+    from app import db, get_ist_time
+    from models import Ride, RideLocation, RideTrail
+    from utils.gps_buffer import gps_buffer
+    from utils.partitions import ride_location_window
+    
+    # Points of this ride may still be queued in this worker
+    if gps_buffer.enabled:
+        gps_buffer.flush()
+        gps_buffer.forget(ride_id)
+    
+    ride = db.session.get(Ride, ride_id)
+    window = ride_location_window(ride) if ride is not None else []
+    rows = db.session.query(RideLocation.latitude, RideLocation.longitude, RideLocation.timestamp).filter(
+        RideLocation.ride_id == ride_id, *window
+    ).order_by(RideLocation.timestamp, RideLocation.id).all()
+    if not rows:
+        return None
+    
+    latitudes = [row.latitude for row in rows]
+    longitudes = [row.longitude for row in rows]
+    started_at = rows[0].timestamp
+    ended_at = rows[-1].timestamp
+    raw_count = len(rows)
+    
+    trail = db.session.get(RideTrail, ride_id)
+    if trail is not None:
+        # Late rows: merge with the already simplified trail and sort by time, since they may fall
+        # before, after or anywhere within it (trail points first on equal times)
+        previous = decode_polyline(trail.polyline)
+        previous_started = trail.started_at or started_at
+        previous_ended = trail.ended_at or previous_started
+        merged = sorted(
+            list(zip(spread_timestamps(previous, previous_started, previous_ended), previous)) +
+            [(row.timestamp, (row.latitude, row.longitude)) for row in rows],
+            key=lambda point: point[0]
+        )
+        latitudes = [lat for _, (lat, _) in merged]
+        longitudes = [lng for _, (_, lng) in merged]
+        started_at = min(started_at, previous_started)
+        ended_at = max(ended_at, previous_ended)
+        raw_count += trail.raw_point_count or 0
+    
+    keep = simplify_trail(latitudes, longitudes, tolerance_meters)
+    points = [(lat, lng) for lat, lng, kept in zip(latitudes, longitudes, keep) if kept]
+    
+    if trail is None:
+        trail = RideTrail(ride_id=ride_id)
+        db.session.add(trail)
+    trail.polyline = encode_polyline(points)
+    trail.point_count = len(points)
+    trail.raw_point_count = raw_count
+    trail.tolerance_meters = tolerance_meters
+    trail.started_at = started_at
+    trail.ended_at = ended_at
+    trail.compacted_at = get_ist_time()
+    
+    RideLocation.query.filter(RideLocation.ride_id == ride_id, *window).delete(synchronize_session=False)
+    db.session.commit()
+    
+    logging.info(f"Trail of ride {ride_id} compacted: {raw_count} points -> {len(points)}")
+    return trail
+
+
+def compact_finished_ride(ride_id):
+    """Hook for complete/cancel routes: compaction failures are logged, never raised"""
+    if not TRAIL_COMPACT_ON_FINISH:
+        return
+    from app import db
+    
+    try:
+        compact_ride_trail(ride_id)
+    except Exception as e:
+        logging.error(f"Error compacting trail of ride {ride_id}: {str(e)}")
+        db.session.rollback()
+
+
+def compact_trails(finished_before, limit=None, tolerance_meters=TRAIL_TOLERANCE_METERS, points_before=None):
+    """
+    Compact every completed/cancelled ride finished before a timestamp that still has raw points
+    points_before: only rides with points older than this (scans just those partitions)
+    Returns: (rides compacted, raw points removed)
+    """
+    from app import db
+    from models import Ride, RideLocation
+    
+    with_points = db.session.query(RideLocation.ride_id)
+    if points_before is not None:
+        with_points = with_points.filter(RideLocation.timestamp < points_before)
+    
+    finished_at = db.func.coalesce(Ride.completed_at, Ride.cancelled_at)
+    query = db.session.query(Ride.id).filter(
+        Ride.status.in_(FINISHED_RIDE_STATUSES),
+        finished_at < finished_before,
+        Ride.id.in_(with_points)
+    ).order_by(Ride.id)
+    if limit:
+        query = query.limit(limit)
+    ride_ids = [row[0] for row in query.all()]
+    
+    rides = points = 0
+    for ride_id in ride_ids:
+        try:
+            raw_before = RideLocation.query.filter_by(ride_id=ride_id).count()
+            if compact_ride_trail(ride_id, tolerance_meters) is not None:
+                rides += 1
+                points += raw_before
+        except Exception as e:
+            logging.error(f"Error compacting trail of ride {ride_id}: {str(e)}")
+            db.session.rollback()
+    return rides, points
+
+
+def get_trail(ride_id):
+    """
+    Trail of a ride as (lat, lng) points: the compacted polyline, or the raw rows if not compacted yet
+    Returns: (encoded_polyline, points, compacted) or None if there is no GPS data
+    """
+    from app import db
+    from models import Ride, RideLocation, RideTrail
+    from utils.partitions import ride_location_window
+    
+    ride = db.session.get(Ride, ride_id)
+    window = ride_location_window(ride) if ride is not None else []
+    trail = db.session.get(RideTrail, ride_id)
+    raw = db.session.query(RideLocation.latitude, RideLocation.longitude).filter(
+        RideLocation.ride_id == ride_id, *window
+    ).order_by(RideLocation.timestamp, RideLocation.id).all()
+    
+    if trail is not None and not raw:
+        return trail.polyline, decode_polyline(trail.polyline), True
+    points = (decode_polyline(trail.polyline) if trail is not None else []) + [(row[0], row[1]) for row in raw]
+    if not points:
+        return None
+    return encode_polyline(points), points, False
+
+
+@click.command('compact-trails')
+@click.option('--older-than-minutes', default=10, show_default=True, help="Only rides finished at least this long ago")
+@click.option('--limit', default=0, help="Maximum rides to compact (0 = all)")
+@click.option('--tolerance-meters', default=TRAIL_TOLERANCE_METERS, show_default=True)
+@with_appcontext
+def compact_trails_command(older_than_minutes, limit, tolerance_meters):
+    """Simplify GPS trails of finished rides and delete their raw ride_location rows"""
+    from app import get_ist_time
+    
+    started = time.perf_counter()
+    rides, points = compact_trails(
+        get_ist_time() - timedelta(minutes=older_than_minutes), limit or None, tolerance_meters
+    )
+    click.echo(f"Compacted {rides} rides, removed {points} raw points in {time.perf_counter() - started:.1f}s")